@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Alert engine: the alerts table compiled into arrays of trip points,
+comparison operators, status, and notice times, evaluated as PV values
+arrive, and reporting only changes of alarm status.
+"""
+import time
+import numpy as np
+
+OPCODES = ('eq', 'ne', 'le', 'lt', 'ge', 'gt')
+
+OPFUNCS = {'eq': np.equal, 'ne': np.not_equal,
+           'le': np.less_equal, 'lt': np.less,
+           'ge': np.greater_equal, 'gt': np.greater}
+
+STR_OPS = {'eq':'__eq__', 'ne':'__ne__',  'le':'__le__',
+           'lt':'__lt__', 'ge':'__ge__', 'gt':'__gt__'}
+
+def as_str(val):
+    if isinstance(val, bytes):
+        val = val.decode('utf-8')
+    return str(val)
+
+def as_float(val):
+    try:
+        return float(as_str(val))
+    except ValueError:
+        return np.nan
+
+def is_number(val):
+    return isinstance(val, (int, float, np.number)) and not isinstance(val, bool)
+
+
+class AlertEngine:
+    """compiled alert table
+
+    Arguments
+    ----------
+    alerts     list of dicts, one per row of the alerts table
+    previous   AlertEngine to carry 'last_notice' times over from [None]
+
+    Notes
+    -----
+    An alert is in alarm when `value <compare> trippoint` is True.
+    Numeric values are compared against float trip points with one
+    vectorized comparison per operator; other values are compared as
+    strings.  Mail should be sent for an ok->alarm transition only if
+    `timeout` seconds have passed since the last notice.
+    """
+    def __init__(self, alerts, previous=None):
+        self.alerts = [dict(a) for a in alerts]
+        nalerts = len(self.alerts)
+        self.ids = np.array([a['id'] for a in self.alerts], dtype=int)
+        self.opcode = np.array([OPCODES.index(a['compare']) for a in self.alerts],
+                               dtype=int)
+        self.trip = np.array([as_float(a['trippoint']) for a in self.alerts],
+                             dtype=np.float64)
+        self.trip_str = [as_str(a['trippoint']) for a in self.alerts]
+        self.active = np.array([a['active'] != 'no' for a in self.alerts], dtype=bool)
+        self.ok = np.array([a['status'] != 'alarm' for a in self.alerts], dtype=bool)
+        self.timeout = np.array([float(a['timeout'] or 0) for a in self.alerts],
+                                dtype=np.float64)
+        self.last_notice = np.zeros(nalerts, dtype=np.float64)
+        if previous is not None:
+            old = {aid: i for i, aid in enumerate(previous.ids)}
+            for i, aid in enumerate(self.ids):
+                if aid in old:
+                    self.last_notice[i] = previous.last_notice[old[aid]]
+
+        self.bypv = {}
+        for i, alert in enumerate(self.alerts):
+            alert['last_notice'] = self.last_notice[i]
+            if self.active[i]:
+                self.bypv.setdefault(alert['pvname'], []).append(i)
+
+    def __contains__(self, pvname):
+        return pvname in self.bypv
+
+    def evaluate(self, values, now=None):
+        """evaluate alerts for a dict of {pvname: value}
+
+        Returns
+        -------
+        transitions  list of (alert, value, status) for alerts changing
+                     status, with status 'ok' or 'alarm'
+        notices      list of (alert, value) for ok->alarm transitions
+                     that are outside the alert timeout
+        """
+        if now is None:
+            now = time.time()
+        idx, vals = [], []
+        for pvname, value in values.items():
+            for i in self.bypv.get(pvname, ()):
+                idx.append(i)
+                vals.append(value)
+        if len(idx) == 0:
+            return [], []
+        idx = np.array(idx, dtype=int)
+        numeric = np.array([is_number(v) for v in vals], dtype=bool)
+        fvals = np.array([float(v) if n else np.nan for v, n in zip(vals, numeric)],
+                         dtype=np.float64)
+        numeric &= ~np.isnan(self.trip[idx])
+
+        alarm = np.zeros(len(idx), dtype=bool)
+        opcode = self.opcode[idx]
+        for code, op in enumerate(OPCODES):
+            sel = numeric & (opcode == code)
+            if sel.any():
+                alarm[sel] = OPFUNCS[op](fvals[sel], self.trip[idx[sel]])
+        for j in np.where(~numeric)[0]:
+            i = idx[j]
+            cmp = STR_OPS[OPCODES[opcode[j]]]
+            alarm[j] = getattr(as_str(vals[j]), cmp)(self.trip_str[i])
+
+        transitions, notices = [], []
+        changed = np.where(self.ok[idx] == alarm)[0]
+        for j in changed:
+            i = idx[j]
+            alert = self.alerts[i]
+            if alarm[j]:
+                self.ok[i] = False
+                alert['status'] = 'alarm'
+                transitions.append((alert, vals[j], 'alarm'))
+                if now > self.timeout[i] + self.last_notice[i]:
+                    self.last_notice[i] = alert['last_notice'] = now
+                    notices.append((alert, vals[j]))
+            else:
+                self.ok[i] = True
+                alert['status'] = 'ok'
+                transitions.append((alert, vals[j], 'ok'))
+        return transitions, notices
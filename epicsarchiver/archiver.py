@@ -5,7 +5,8 @@ import os
 import logging
 from decimal import Decimal
 from pathlib import Path
-from sqlalchemy import MetaData, create_engine, engine, text, and_
+from sqlalchemy import (MetaData, create_engine, engine, text, and_, select,
+                        func, bindparam, inspect)
 from sqlalchemy.orm import Session
 import numpy as np
 import hashlib, base64
@@ -13,14 +14,25 @@ import epics
 from epics.utils import str2bytes
 
 import zarr
+from tabulate import tabulate
 
-from .util import (normalize_pvname, get_force_update_time, tformat,
+from .util import (normalize_pvname, tformat,
                    clean_bytes, clean_string, SEC_DAY,
                    DatabaseConnection, None_or_one,
                    MAX_EPOCH, valid_pvname, motor_fields,
                    get_config, row2dict)
 
 from .cache import Cache
+from .pvstate import PVState, as_float, COMPRESSION, SWINGING_DOOR
+from . import schema
+from .spool import Spool, spool_status
+from .zarrstore import ZarrFiles, parse_levels, level_points
+from .zarrcodecs import CODECS
+from .export import (read_table, read_tables, table_counts, ExportProgress,
+                     ZarrSidecar)
+from .rollup import (has_rollups, rollup_for, update_rollups, rollup_query,
+                     rollup_stats, aggregate_records, compare_rollups,
+                     delete_rollups, upsert_stmt)
 
 def hashname(name):
     h = hashlib.sha256()
@@ -37,12 +49,62 @@ def clean_value(val):
 
     try:
         val = float(val)
-    except ValueError:
+    except (TypeError, ValueError):
         # some values are stored like this:
-        if val.startswith("b'") and val.endswith("'"):
-            val = float(val[2:-1])
+        if isinstance(val, str) and val.startswith("b'") and val.endswith("'"):
+            val = val[2:-1]
+            try:
+                val = float(val)
+            except ValueError:
+                pass
     return val
 
+def data_query(dtab):
+    """query for values of a PV in a data table over a time range, with
+    parameters _pvid, _tmin, _tmax, and _dmin, _dmax (days, for pruning
+    partitions of partitioned tables)"""
+    query = select(dtab.c.time, dtab.c.value).where(dtab.c.pv_id==bindparam('_pvid'))
+    query = query.where(dtab.c.time>=bindparam('_tmin'))
+    query = query.where(dtab.c.time<=bindparam('_tmax'))
+    if 'tday' in dtab.c:
+        query = query.where(dtab.c.tday>=bindparam('_dmin'))
+        query = query.where(dtab.c.tday<=bindparam('_dmax'))
+    return query.order_by(dtab.c.time)
+
+def value_before_query(dtab):
+    """query for the last value of a PV in a data table before a time,
+    with parameters _pvid, _tmin, and _dmax (day, for partitioned tables)"""
+    query = select(dtab.c.time, dtab.c.value).where(dtab.c.pv_id==bindparam('_pvid'))
+    query = query.where(dtab.c.time<bindparam('_tmin'))
+    if 'tday' in dtab.c:
+        query = query.where(dtab.c.tday<=bindparam('_dmax'))
+    return query.order_by(dtab.c.time.desc()).limit(1)
+
+def as_array(values):
+    "array of float values if possible, else of objects"
+    try:
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        out = np.empty(len(values), dtype=object)
+        out[:] = values
+        return out
+
+def decode_rows(rows, kind='double'):
+    """(times, values) arrays for rows of (time, value) from a data table
+    of kind 'double', 'int' or 'string' (see schema.data_table_kind)"""
+    if len(rows) == 0:
+        return np.zeros(0), np.zeros(0)
+    if kind != 'string':
+        # typed tables: convert all at once, with NULL as nan
+        dat = np.array(rows, dtype=np.float64).reshape(-1, 2)
+        return dat[:, 0], dat[:, 1]
+    times = np.fromiter((row[0] for row in rows), dtype=np.float64, count=len(rows))
+    values = [row[1] for row in rows]
+    try:
+        return times, np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return times, as_array([clean_value(val) for val in values])
+
 class Archiver:
     MIN_TIME = 100
     sql_insert  = "insert into %s (pv_id,time,value) values (%i,%f,%s)"
@@ -53,7 +115,17 @@ class Archiver:
         self.dbname = None
         self.force_checktime = 0
         self.last_collect = 0
+        self.last_seq = self.cache.get_last_seq()
         self.dtime_limbo = {}
+        self.capture_pvs = set()
+        self.insert_stmts = {}
+        self.batch_size = int(self.config.archive_batch_size)
+        self.rollups = self.config.archive_rollups.lower().startswith('y')
+        self.spool = None
+        self.next_replay = 0
+        self.zarr_files = ZarrFiles(self.config.zarrdir,
+                                    maxsize=int(self.config.zarr_cache_size))
+        self.reset_stats()
         self.use_archivedb()
 
     def use_archivedb(self, dbname=None):
@@ -61,9 +133,190 @@ class Archiver:
             dbname = self.cache.get_info(process='archive').db
         self.dbname = dbname
         self.db = DatabaseConnection(self.dbname, self.config)
+        self.check_pv_schema()
+        self.typed = schema.is_typed(self.db.tables)
+        if self.spool is not None and self.spool.dbname != dbname:
+            self.spool.new_segment(dbname)
+        self.insert_stmts = {}
         self.pvinfo = {}
+        self.pvnames = {}
+        self.door_held = {}
+        self.state = PVState(max_hold=float(self.config.archive_max_hold))
         self.refresh_pvinfo()
 
+    def check_pv_schema(self):
+        """upgrade archive database from earlier versions, adding the
+        'compression' and 'tolerance' columns to the pv table and the
+        rollup tables (if archive_rollups is set) if needed.  New rollup
+        tables are filled from the values archived so far, before any new
+        values are written"""
+        refresh = False
+        if 'compression' not in self.db.tables['pv'].c:
+            self.log(f"adding compression columns to pv table of {self.dbname}")
+            self.db.sql_execute(schema.pv_add_compression)
+            refresh = True
+        if self.rollups and not has_rollups(self.db.tables):
+            self.log(f"adding rollup tables to {self.dbname}, with rollups of archived values")
+            self.check_rollups(self.dbname, rebuild=True)
+            refresh = True
+        if refresh:
+            self.db = DatabaseConnection(self.dbname, self.config, refresh=True)
+
+    def reset_stats(self):
+        "reset counters for archive writes, reported by mainloop"
+        self.stats = {'rows': 0, 'statements': 0, 'commits': 0,
+                      'commit_time': 0.0, 'max_commit_time': 0.0,
+                      'max_commit_rows': 0}
+
+    def report_stats(self):
+        "string summarizing archive writes per statement and commit latency"
+        st = self.stats
+        nstmt = max(1, st['statements'])
+        ncommit = max(1, st['commits'])
+        return (f"{st['commits']} commits of {st['rows']/ncommit:.1f} rows mean, "
+                f"{st['max_commit_rows']} max, {st['rows']/nstmt:.1f} rows/statement, "
+                f"commit latency {1000*st['commit_time']/ncommit:.1f} ms mean, "
+                f"{1000*st['max_commit_time']:.1f} ms max")
+
+    def insert_stmt(self, tablename):
+        "insert statement for a data table, created once per table"
+        stmt = self.insert_stmts.get(tablename, None)
+        if stmt is None:
+            stmt = self.insert_stmts[tablename] = self.db.tables[tablename].insert()
+        return stmt
+
+    def write_rows(self, rows, db=None):
+        """write rows to data tables, in one transaction with one
+        executemany per table, adding numeric values to the rollup tables
+
+        Arguments
+        ----------
+        rows   dict of {data_table: list of dicts with pv_id, time, value}
+        db     DatabaseConnection [None, current archive database]
+        """
+        if db is None or db is self.db:
+            db, insert_stmt = self.db, self.insert_stmt
+        else:
+            insert_stmt = lambda tablename: db.tables[tablename].insert()
+        t0 = time.monotonic()
+        nrows, nstmt = 0, 0
+        with Session(db.engine) as session, session.begin():
+            for tablename, trows in rows.items():
+                stmt = insert_stmt(tablename)
+                for i in range(0, len(trows), self.batch_size):
+                    session.execute(stmt, trows[i:i+self.batch_size])
+                    nstmt += 1
+                nrows += len(trows)
+            if self.rollups and has_rollups(db.tables):
+                update_rollups(session, db, rows)
+                nstmt += len(schema.ROLLUPS)
+        dt = time.monotonic() - t0
+        st = self.stats
+        st['rows'] += nrows
+        st['statements'] += nstmt
+        st['commits'] += 1
+        st['commit_time'] += dt
+        st['max_commit_time'] = max(dt, st['max_commit_time'])
+        st['max_commit_rows'] = max(nrows, st['max_commit_rows'])
+        return nrows
+
+    def open_spool(self):
+        "open write-ahead spool, if configured"
+        spooldir = self.config.archive_spool_dir
+        if spooldir not in (None, '') and self.spool is None:
+            self.spool = Spool(spooldir, self.dbname,
+                               segment_size=int(self.config.archive_spool_segment_size))
+            nheld = self.spool.restore_held()
+            if nheld > 0:
+                self.log(f"returned {nheld} file(s) of held values to spool, to replay")
+
+    def data_tables(self, dbname, refresh=False):
+        """dict of {pv_id: data_table} for an archive database, read
+        from its pv table if refresh is True or not the current database"""
+        if dbname == self.dbname and not refresh:
+            return {info['id']: info['data_table'] for info in self.pvinfo.values()}
+        db = self.db if dbname == self.dbname else DatabaseConnection(dbname, self.config)
+        return {row.id: row.data_table for row in db.get_rows('pv')}
+
+    def replay_spool(self):
+        """write batches left in the spool (not acknowledged as written)
+        to their archive databases, returns number of rows written.
+        Values for PVs not in the pv table of their database are set aside
+        (see Spool.set_aside), to be replayed when the archiver restarts."""
+        if self.spool is None:
+            return 0
+        t0 = time.monotonic()
+        nrows = 0
+        tables, dbs, refreshed = {}, {}, set()
+        group, tokens, ngroup, group_db = {}, [], 0, None
+        unknown = []
+
+        def write_group():
+            if len(tokens) == 0:
+                return 0
+            if group_db not in dbs:
+                dbs[group_db] = self.db
+                if group_db != self.dbname:
+                    dbs[group_db] = DatabaseConnection(group_db, self.config)
+            n = self.write_rows(group, db=dbs[group_db])
+            if len(unknown) > 0:
+                heldfile = self.spool.set_aside(group_db, unknown)
+                npvs = len({rec[0] for rec in unknown})
+                self.log(f"{len(unknown)} spooled values for {npvs} PVs not in {group_db}"
+                         f" set aside in {heldfile}", level='warn')
+            for token in tokens:
+                self.spool.ack(token)
+            return n
+
+        for dbname, token, records in self.spool.pending():
+            if dbname != group_db or ngroup >= self.batch_size:
+                nrows += write_group()
+                group, tokens, ngroup, group_db = {}, [], 0, dbname
+                unknown = []
+            if dbname not in tables:
+                tables[dbname] = self.data_tables(dbname)
+            dtables = tables[dbname]
+            if (dbname not in refreshed and
+                any(pvid not in dtables for pvid, ts, value in records)):
+                # PVs added since the pv table was read?
+                refreshed.add(dbname)
+                dtables = tables[dbname] = self.data_tables(dbname, refresh=True)
+            for pvid, ts, value in records:
+                tablename = dtables.get(pvid, None)
+                if tablename is None:
+                    unknown.append((pvid, ts, value))
+                else:
+                    group.setdefault(tablename, []).append(
+                        {'pv_id': pvid, 'time': ts,
+                         'value': schema.data_value(tablename, value)})
+            tokens.append(token)
+            ngroup += len(records)
+        nrows += write_group()
+        self.spool.save_acks(force=True)
+        if nrows > 0:
+            dt = time.monotonic() - t0
+            self.spool.save_replay_stats(nrows, dt)
+            self.log(f"replayed {nrows} values from spool in {dt:.2f} sec")
+        return nrows
+
+    def show_spool_status(self):
+        "print status of write-ahead spool"
+        spooldir = self.config.archive_spool_dir
+        if spooldir in (None, ''):
+            print("Archive spool: not configured")
+            return
+        stat = spool_status(spooldir)
+        replay = stat['replay']
+        last, rate = 'never', ''
+        if replay is not None:
+            last = f"{tformat(replay['time'])}, {replay['rows']} values"
+            rate = f"{replay['rows']/max(1.e-3, replay['seconds']):.1f}"
+        tab = [["Spool Directory", "Segments", "Size (kB)", "Not Written (kB)",
+                "Held (kB)", "Last Replay", "Replay Rate (values/sec)"],
+               [spooldir, stat['segments'], f"{stat['bytes']/1024:.1f}",
+                f"{stat['unacked']/1024:.1f}", f"{stat['held']/1024:.1f}", last, rate]]
+        print(tabulate(tab, headers='firstrow', tablefmt='simple_grid'))
+
     def refresh_pvinfo(self):
         """
         refresh the 'self.pvinfo' dictionary by re-reading the
@@ -71,14 +324,25 @@ class Archiver:
         may also add pvs to the .pvs dict
         """
         for pvdata in self.db.get_rows('pv'):
-            name = pvdata.name
-            if name in self.pvinfo:
-                self.pvinfo[name].update(row2dict(pvdata))
-            else:
-                dat = row2dict(pvdata)
-                dat.update({'last_ts': 0,'last_value':None,
-                            'force_time': get_force_update_time()})
-                self.pvinfo[name] = dat
+            self.set_pvinfo(pvdata)
+        # PVs in capture mode are archived by the cache process
+        self.capture_pvs = set(self.cache.get_capture_settings().keys())
+
+    def set_pvinfo(self, pvdata):
+        """set pvinfo data and archive state for a pv from its
+        row of the pv table"""
+        dat = row2dict(pvdata)
+        name = dat['name']
+        if name in self.pvinfo:
+            self.pvinfo[name].update(dat)
+        else:
+            self.pvinfo[name] = dat
+        self.pvnames[dat['id']] = name
+        self.state.configure(dat['id'], dat['deadtime'], dat['deadband'],
+                             dat['type'], dat['active'],
+                             compression=dat.get('compression', 'deadband'),
+                             tolerance=dat.get('tolerance', None))
+        return self.pvinfo[name]
 
     def get_pvinfo(self, pvname):
         """return pvinfo data (a dict) for a pv, and also ensures that it
@@ -88,17 +352,15 @@ class Archiver:
             return
         if pvname not in self.pvinfo:
             dat = self.db.get_rows('pv', where={'name': pvname},
-                                 none_if_empty=True)
+                                   limit_one=True)
             if dat is None:
                 self.add_pv(pvname)
                 time.sleep(0.05)
                 dat = self.db.get_rows('pv', where={'name': pvname},
-                                       none_if_empty=True)
+                                       limit_one=True)
                 if dat is None:
                     return None
-            dat.update({'last_ts': 0,'last_value':None,
-                        'force_time': get_force_update_time()})
-            self.pvinfo[pvname] = dat
+            self.set_pvinfo(dat)
         return self.pvinfo[pvname]
 
     def dbs_for_time(self, t0=None, t1=None):
@@ -112,25 +374,71 @@ class Archiver:
     def get_value_at_time(self, pvname, t):
         """
         return (time, value) for an archived value of a pv at one time
-        time will be a float timestamp, and value will be a string.
+        time will be a float timestamp.
 
         returns None, None if not found or error
         """
         pvname = normalize_pvname(pvname)
         if pvname not in self.pvinfo:
             self.log("pv %s not found" % (pvname), level='warn')
+        out = self.get_value_before(pvname, t+1.e-4)
+        if out is None:
+            return None, None
+        return out
+
+    def archive_pvrow(self, db, pvname):
+        "row of the pv table of an archive database for a PV, or None"
+        pvtab = db.tables['pv']
+        query = db.statement('pv_by_name', lambda: pvtab.select().where(
+            pvtab.c.name==bindparam('_name')))
+        return db.execute(query, params={'_name': pvname}).fetchone()
+
+    def get_value_before(self, pvname, t, use_zarr=True, max_runs=5):
+        """(time, value) for the last archived value of a PV before time t,
+        looking back through up to max_runs runs, or None if not found"""
+        runs = [run for run in self.cache.get_runs() if run.start_time < t]
+        runs.sort(key=lambda run: run.start_time, reverse=True)
+        for run in runs[:max_runs]:
+            zser = self.zarr_files.series(run.db, pvname) if use_zarr else None
+            if zser is not None:
+                out = zser.before(t)
+                if out is not None:
+                    return out
+                continue
+            sidecar = self.zarr_files.sidecar_series(run.db, pvname) if use_zarr else None
+            if sidecar is not None and t <= sidecar[1]:
+                out = sidecar[0].before(t)
+                if out is not None:
+                    return out
+                continue
+            db = DatabaseConnection(run.db, self.config)
+            pvrow = self.archive_pvrow(db, pvname)
+            if pvrow is None:
+                continue
+            query = db.statement(('value_before', pvrow.data_table),
+                                 lambda: value_before_query(db.tables[pvrow.data_table]))
+            row = db.execute(query, params={'_pvid': pvrow.id, '_tmin': t,
+                                            '_dmax': int(t//SEC_DAY)}).fetchone()
+            if row is not None:
+                tx, vals = decode_rows([row], schema.data_table_kind(pvrow.data_table))
+                return float(tx[0]), vals.tolist()[0]
+        return None
 
-        tdat, vdat = self.get_data(pvname, tmin=(t-60), tmax=(t+1))
-        print("Get Value At Time ", t, len(tdat))
-        for tout, vout in zip(tdat, vdat):
-            if tout < t+1.e-4:
-                if isinstance(vout, bytes):
-                    vout = clean_value(vout)
-        return tout, vout
-
-    def get_data(self, pvname, tmin=None, tmax=None, with_current=None, use_zarr=True):
+    def get_data(self, pvname, tmin=None, tmax=None, with_current=None, use_zarr=True,
+                 resolution=None):
         """
         get data for a PV over a time range, optionally including the current value
+
+        The last value archived before tmin is included as the first value.
+        With a resolution (sec), data from zarr files is read from the coarsest
+        aggregated level no coarser than resolution, when available: the first,
+        min, max and last value of each time bucket.  Data from archive
+        databases is likewise read from their rollup tables, if these have
+        buckets for the PV in the time range, with buckets still open when
+        the next run started read from that run.  Otherwise, values of an archive
+        database being exported are read from its sidecar store up to the
+        time they have been exported to, and only later values are read from
+        the database.
         """
         pvname_raw = pvname
         pvname = normalize_pvname(pvname)
@@ -145,82 +453,90 @@ class Archiver:
         if with_current is None:
             with_current = False
 
-        timevals, datavals = [], []
-        dbnames = self.dbs_for_time(tmin-SEC_DAY, tmax+5)
-        for dbname in reversed(dbnames):
-            has_data = False
-            zpath = Path(self.config.zarrdir, f'{dbname}_zarr.zip').absolute()
-            if use_zarr and zpath.exists():
-                try:
-                    zroot = zarr.open(zpath.as_posix(), mode='r')
-                    time_all = zroot[f'pvarch/{pvname}/ts'][()]
-                    torder   = time_all.argsort()
-                    time_all = time_all[torder]
-                    data_all = zroot[f'pvarch/{pvname}/data'][torder]
-                    try:
-                        i0 = max(np.where(time_all<tmin)[0])
-                    except:
-                        i0 = 1
-                    if i0 > 0:
-                        i0 -= 1
-                    try:
-                        i1 = max(np.where(time_all<tmax)[0])
-                    except:
-                        i1 = len(time_all)
-
-                    timevals.extend(time_all[i0:i1+1].tolist())
-                    datavals.extend(data_all[i0:i1+1].tolist())
-                    has_data = True
-                except:
-                    has_data = False
-
-            if not has_data:
-                db = DatabaseConnection(dbname, self.config)
-                pvrow = db.get_rows('pv', where={'name': pvname}, limit_one=True,
-                                    none_if_empty=True)
-
-                if pvrow is None:
-                    self.log("no data table for  %s" % (pvname), level='warn')
+        tparts, vparts = [], []
+        early = self.get_value_before(pvname, tmin, use_zarr=use_zarr)
+        if early is None:
+            logging.warn("could not get 'early value' for %s" % pvname)
+        else:
+            tparts.append(np.array([early[0]]))
+            vparts.append(as_array([early[1]]))
+
+        runs = sorted(self.cache.get_runs(start_time=tmin, stop_time=tmax+5),
+                      key=lambda run: run.start_time)
+        for irun, run in enumerate(runs):
+            dbname = run.db
+            # start of the next run, which holds the buckets open at rollover
+            next_start = MAX_EPOCH
+            if irun + 1 < len(runs):
+                next_start = float(runs[irun+1].start_time)
+            zser = self.zarr_files.series(dbname, pvname) if use_zarr else None
+            if zser is not None:
+                times, values = zser.range(tmin, tmax, resolution=resolution)
+                tparts.append(times)
+                vparts.append(values)
+                continue
+            db = DatabaseConnection(dbname, self.config)
+            pvrow = self.archive_pvrow(db, pvname)
+            if pvrow is None:
+                self.log("no data table for  %s" % (pvname), level='warn')
+                continue
+            rollup = None
+            if resolution is not None and has_rollups(db.tables):
+                rollup = rollup_for(resolution)
+            if rollup is not None:
+                rname, width = rollup
+                query = db.statement(('get_rollup', rname),
+                                     lambda: rollup_query(db.tables[rname]))
+                rows = db.execute(query, params={'_pvid': pvrow.id,
+                                                 '_tmin': tmin - width,
+                                                 '_tmax': min(tmax, next_start - width)}
+                                  ).fetchall()
+                if len(rows) > 0:
+                    times, values = level_points(*rollup_stats(rows), width)
+                    tparts.append(times)
+                    vparts.append(values)
+                    continue
+            tstart = tmin
+            sidecar = self.zarr_files.sidecar_series(dbname, pvname) if use_zarr else None
+            if sidecar is not None:
+                zser, tdone = sidecar
+                times, values = zser.range(tmin, min(tmax, tdone))
+                tparts.append(times)
+                vparts.append(values)
+                if tdone >= tmax:
                     continue
-                dtab = db.tables[pvrow.data_table]
-                query = dtab.select().where(dtab.c.pv_id==pvrow.id)
-                query = query.where(dtab.c.time>=Decimal(tmin-SEC_DAY))
-                query = query.where(dtab.c.time<=Decimal(tmax+0.5))
-                query = query.order_by(dtab.c.time)
-                rows = db.execute(query).fetchall()
-
-                if len(datavals) == 0:  # include 1 datapoint before tmin
-                    early_times = []
-                    early_vals = []
-                    for row in rows:
-                        thistime = float(row.time)
-                        if thistime < tmin:
-                            early_times.append(thistime)
-                            early_vals.append(clean_value(row.value))
-                    if len(early_times) <= 0:
-                        logging.warn("could not get 'early value' for %s" % pvname)
-                    else:
-                        early_times = np.array(early_times)
-                        imaxtime = early_times.argsort()[-1]
-                        timevals = [early_times[imaxtime]]
-                        datavals = [early_vals[imaxtime]]
-                for row in rows:
-                    rtime = float(row.time)
-                    if rtime >= tmin and rtime <= tmax:
-                        timevals.append(float(row.time))
-                        datavals.append(clean_value(row.value))
+                tstart = max(tmin, np.nextafter(tdone, np.inf))
+            query = db.statement(('get_data', pvrow.data_table),
+                                 lambda: data_query(db.tables[pvrow.data_table]))
+            rows = db.execute(query, params={'_pvid': pvrow.id,
+                                             '_tmin': tstart, '_tmax': tmax,
+                                             '_dmin': int(tstart//SEC_DAY),
+                                             '_dmax': int(tmax//SEC_DAY)}).fetchall()
+            times, values = decode_rows(rows, schema.data_table_kind(pvrow.data_table))
+            tparts.append(times)
+            vparts.append(values)
+
         if with_current:
             cur = self.cache.get_full(pvname)
             if cur is None:
                 cur = self.cache.get_full(pvname_raw)
             if cur is not None:
-                timevals.append(float(time.time()))
-                datavals.append(clean_value(cur.value))
-
-        # sort time/data by time values
-        timevals = np.array(timevals)
-        torder   = timevals.argsort()
-        return (timevals[torder].tolist(), np.array(datavals)[torder].tolist())
+                tparts.append(np.array([time.time()]))
+                vparts.append(as_array([clean_value(cur.value)]))
+
+        if len(tparts) == 0:
+            return [], []
+        timevals = np.concatenate(tparts)
+        if all(part.dtype.kind in 'fiub' for part in vparts):
+            datavals = np.concatenate(vparts)
+        else:
+            datavals = np.empty(len(timevals), dtype=object)
+            datavals[:] = [val for part in vparts for val in part.tolist()]
+        # runs may overlap: sort by time only if needed
+        if len(timevals) > 1 and (np.diff(timevals) < 0).any():
+            torder = timevals.argsort(kind='stable')
+            timevals, datavals = timevals[torder], datavals[torder]
+        return timevals.tolist(), datavals.tolist()
 
 
     def add_pv(self, name, description=None, graph={}, deadtime=None, deadband=None):
@@ -246,7 +562,7 @@ class Archiver:
             pv.get(timeout=5)
             pv.get_ctrlvars()
             typ = pv.type
-            count = pv.count
+            count = pv.count or 1
             prec  = pv.precision
             connected = pv.connected
         except:
@@ -265,8 +581,9 @@ class Archiver:
         elif pvtype in ('double', 'float'):
             dtype = 'double'
 
-        # determine data table
-        table = "pvdat%3.3i" % (hashname(pvname)+1)
+        # determine data table: arrays are held as strings
+        table = schema.data_table_name(dtype if count == 1 else 'string',
+                                       hashname(pvname)+1, typed=self.typed)
 
         # determine descrption (don't try too hard!)
         if description is None:
@@ -334,11 +651,7 @@ class Archiver:
                         graph_type=gr['type'])
         time.sleep(0.01)
         pvdata = self.db.get_rows('pv', where={'name': pvname}, limit_one=True)
-
-        dat = row2dict(pvdata)
-        dat.update({'last_ts': 0,'last_value':None,
-                    'force_time': get_force_update_time()})
-        self.pvinfo[name] = dat
+        self.set_pvinfo(pvdata)
         self.update_value(pvname, time.time(), pv.value)
 
 
@@ -352,115 +665,166 @@ class Archiver:
         if name not in self.pvinfo:
             self.refresh_pvinfo()
         info = self.pvinfo[name]
-        self.pvinfo[name]['last_ts'] =  float(ts)
-        self.pvinfo[name]['last_value'] =  val
-
-        info = self.pvinfo[name]
-        self.db.insert(info['data_table'], pv_id=info['id'],
-                       time=ts, value=clean_bytes(val))
+        self.state.archived(np.array([info['id']]), float(ts), as_float(val))
+        self.db.insert(info['data_table'], pv_id=info['id'], time=ts,
+                       value=schema.data_value(info['data_table'], val))
+
+    def set_compression(self, pvname, compression, tolerance=None):
+        """set compression policy for a PV
+
+        Arguments
+        ----------
+        pvname       name of PV
+        compression  one of 'none', 'deadband', 'swinging_door'
+        tolerance    tolerance for 'swinging_door' [None, use deadband]
+        """
+        pvname = normalize_pvname(pvname)
+        if compression not in COMPRESSION:
+            raise ValueError(f"compression must be one of {', '.join(COMPRESSION)}")
+        if pvname not in self.pvinfo:
+            raise ValueError(f"PV '{pvname}' is not in the archive")
+        self.db.update('pv', where={'name': pvname}, compression=compression,
+                       tolerance=tolerance)
+        pvdata = self.db.get_rows('pv', where={'name': pvname}, limit_one=True)
+        self.set_pvinfo(pvdata)
 
     def collect(self):
         """ one pass of collecting new values, deciding what to archive"""
-        newvals, forced = {},{}
+        newvals = {}
         tnow = time.time()
-        dt  =  5.0*(tnow - self.last_collect)
-        ctab = self.cache.tables['cache']
-        new_data = self.cache.db.execute(ctab.select().where(
-                      ctab.c.ts>Decimal(tnow-dt))).fetchall()
+        new_data, self.last_seq = self.cache.changes_since(self.last_seq)
         self.last_collect = tnow
+        names, ids, tstamps, fvals, vals = [], [], [], [], []
         for dat in new_data:
             name  = dat.pvname
             if name not in self.pvinfo:
                 name  = normalize_pvname(name)
                 if name not in self.pvinfo:
                     self.add_pv(name)
-            if dat.active == 'no':
+            if dat.active == 'no' or name in self.capture_pvs:
+                continue
+            if name not in self.pvinfo:
+                self.log(f"PV {name} could not be added, not archived", level='debug')
                 continue
             val = dat.cvalue
+            fval = np.nan
             if 'enum' in dat.type:
                 val = dat.value
                 if isinstance(val, int):
                     val = "%d" % val
-            ts  = float(dat.ts)
-
-            if name not in self.pvinfo:
-                print("PV not in pvinfo?  ", name)
-                continue
-            info = self.pvinfo[name]
-            do_save = ts > float(info['last_ts'])+float(info['deadtime'])
-            if do_save:
-                if 'double' in dat.type or 'float' in dat.type:
-                    last_val  = self.pvinfo[name]['last_value']
-                    try:
-                        v, o = float(dat.value), float(last_val)
-                        do_save = abs(v-o) > abs(info['deadband'])
-                    except:
-                        do_save = True
-
-            if do_save:
-                newvals[name] = (ts, val)
-                if name in self.dtime_limbo:
-                    self.dtime_limbo.pop(name)
-            elif ts > (0.001 + float(info['last_ts'])):
-                # pv changed, but inside 'deadtime': put it in limbo!
-                self.dtime_limbo[name] = (ts, val)
-
-        # now look through the "limbo list" and insert the most recent change
-        # iff the last insert was longer ago than the deadtime:
-        for name in list(self.dtime_limbo.keys()):
-            info = self.pvinfo[name]
-            if (info['active'] == 'yes' and
-                tnow > (float(info['last_ts']) + float(info['deadtime']))):
-                newvals[name] = self.dtime_limbo.pop(name)
+            elif 'double' in dat.type or 'float' in dat.type:
+                fval = as_float(dat.value)
+            names.append(name)
+            ids.append(self.pvinfo[name]['id'])
+            tstamps.append(float(dat.ts))
+            fvals.append(fval)
+            vals.append(val)
+
+        # swinging door: archive values held for longer than archive_max_hold,
+        # each starting a new segment, before deciding on new values
+        for pvid in self.state.due_held(tnow):
+            name = self.pvnames.get(pvid, None)
+            if name in self.door_held:
+                newvals[name] = self.door_held.pop(name)
+
+        if len(ids) > 0:
+            ids = np.array(ids, dtype=np.int64)
+            tstamps = np.array(tstamps, dtype=np.float64)
+            fvals = np.array(fvals, dtype=np.float64)
+            save, limbo, held = self.state.decide(ids, tstamps, fvals)
+            # swinging door: archive the value held from before, if needed,
+            # and hold on to the new value
+            for i in np.where(held)[0]:
+                if names[i] in self.door_held:
+                    newvals[names[i]] = self.door_held[names[i]]
+            door = (self.state.policy[ids] == SWINGING_DOOR) & ~np.isnan(fvals)
+            for i in np.where(door & ~save)[0]:
+                self.door_held[names[i]] = (tstamps[i], vals[i], fvals[i])
+            self.state.add_held(ids[door & ~save])
+            for i in np.where(save)[0]:
+                name = names[i]
+                newvals[name] = (tstamps[i], vals[i], fvals[i])
+                self.dtime_limbo.pop(name, None)
+            # changed, but inside 'deadtime': put it in limbo!
+            for i in np.where(limbo)[0]:
+                self.dtime_limbo[names[i]] = (tstamps[i], vals[i], fvals[i])
+            self.state.add_limbo(ids[limbo])
+
+        # insert the most recent change for PVs in limbo for which
+        # the last insert was longer ago than the deadtime:
+        state = self.state
+        for pvid in state.due_limbo(tnow):
+            name = self.pvnames.get(pvid, None)
+            if name in self.dtime_limbo:
+                data = self.dtime_limbo.pop(name)
+                if state.active[pvid]:
+                    newvals[name] = data
 
         n_new     = len(newvals)
-        n_forced  = 0
-        # check for stale values and re-read db settings every 5 minutes
+        # write current values of PVs that have not been archived
+        # for a long time (see get_force_update_time)
+        forced = []
+        for pvid in state.due_forced(tnow):
+            name = self.pvnames.get(pvid, None)
+            if (name is None or name in newvals or name in self.capture_pvs
+                or not state.active[pvid]):
+                continue
+            forced.append(name)
+        n_forced = 0
+        if len(forced) > 0:
+            for name, row in self.cache.get_full_many(forced).items():
+                newvals[name] = tnow, row.value, as_float(row.value)
+                n_forced = n_forced + 1
+
+        # re-read db settings every 5 minutes
         if tnow > (self.force_checktime + 300):
-            # print('looking for stale values %s'  %time.ctime() )
             self.force_checktime = tnow
             self.refresh_pvinfo()
             for p in self.cache.get_pvnames():
                 if p not in self.pvinfo:
                     self.add_pv(p)
-            fullcache = {}
-            for row in self.cache.db.get_rows('cache'):
-                fullcache[row.pvname] = row.ts, row.value
 
-            for name, info in self.pvinfo.items():
-                if info['active'] == 'no':
-                    continue
-                try:
-                    force = tnow > (float(info['last_ts']) +float(info['force_time']))
-                except:
-                    force = False
-                if force and name in fullcache and name not in newvals:
-                    newvals[name] = time.time(), fullcache[name][1]
-                    info['force_time'] = get_force_update_time()
-                    n_forced = n_forced + 1
-
-        #for name, data in newvals.items():
-        #    self.update_value(name, data[0], data[1])
-        if len(newvals) > 0:
-            with Session(self.db.engine) as session, session.begin():
-                ex = session.execute
-                for name, data in newvals.items():
-                    ts, val = data
-                    if val is None or name not in self.pvinfo:
-                        continue
-                    if ts is None or ts < self.MIN_TIME:
-                        ts = time.time()
-
-                    info = self.pvinfo[name]
-                    self.pvinfo[name]['last_ts'] =  float(ts)
-                    self.pvinfo[name]['last_value'] =  val
-
-                    info = self.pvinfo[name]
-                    dtab = self.db.tables[info['data_table']]
-                    pv_id = info['id']
-                    ex(dtab.insert().values(pv_id=info['id'],
-                                            time=ts, value=clean_bytes(val)))
-                session.flush()
+        # group values by data table, to be written with one
+        # executemany (multi-row insert) per table
+        rows = {}
+        ids, tstamps, fvals = [], [], []
+        for name, data in newvals.items():
+            ts, val, fval = data
+            if val is None or name not in self.pvinfo:
+                continue
+            if ts is None or ts < self.MIN_TIME:
+                ts = time.time()
+            info = self.pvinfo[name]
+            tablename = info['data_table']
+            ids.append(info['id'])
+            tstamps.append(ts)
+            fvals.append(fval)
+            if schema.data_table_kind(tablename) == 'double':
+                val = fval
+            rows.setdefault(tablename, []).append(
+                {'pv_id': info['id'], 'time': ts,
+                 'value': schema.data_value(tablename, val)})
+
+        if len(rows) > 0:
+            self.state.archived(np.array(ids, dtype=np.int64),
+                                np.array(tstamps, dtype=np.float64),
+                                np.array(fvals, dtype=np.float64))
+            if self.spool is None:
+                self.write_rows(rows)
+            else:
+                # spool the batch first.  If earlier batches are still
+                # waiting in the spool, this one will be written after
+                # them by replay_spool().
+                behind = self.spool.backlog()
+                token = self.spool.append([(r['pv_id'], r['time'], r['value'])
+                                           for trows in rows.values() for r in trows])
+                if not behind:
+                    try:
+                        self.write_rows(rows)
+                        self.spool.ack(token)
+                    except Exception as exc:
+                        self.log(f"could not write to archive, spooling: {exc}",
+                                 level='warn')
         #
         needs_pvinfo = False
         for name, data in newvals.items():
@@ -480,19 +844,213 @@ class Archiver:
         """
         time_ago = time.time()-minutes*60.0
         n = 0
-        for i in range(1, 129):
-            tab = self.db.tables['pvdat%3.3d' % i]
-            q = tab.select().where(tab.c.time > time_ago)
-            n += len(self.db.execute(q).fetchall())
+        for tabname in schema.data_tables(self.db.tables):
+            tab = self.db.tables[tabname]
+            q = select(func.count()).select_from(tab).where(tab.c.time > time_ago)
+            n += self.db.execute(q).scalar()
         return n
 
+    def migrate_archive(self, dbname=None, chunk=10000, keep=False):
+        """convert the data tables of an archive database to the layout
+        set by archive_time_index and archive_partition_days, while
+        archiving continues (MariaDB and MySQL, or sqlite).
+
+        Each table is copied to a new table, in statements of at most
+        `chunk` values of one PV, read with committed reads so that the
+        archiver can keep inserting.  Values inserted to the table during
+        the copy are also written by a trigger to a delta table, and are
+        not copied from the table itself.  The tables are then swapped
+        with one atomic rename, and the delta table is copied to the new
+        table.  The old table is dropped only if it holds as many values
+        as were copied, and is otherwise kept as '<table>_old'.
+
+        Arguments
+        ----------
+        dbname   name of archive database [None, current database]
+        chunk    max number of values copied per statement [10000]
+        keep     whether to keep old tables, as '<table>_old' [False]
+        """
+        if dbname is None:
+            dbname = self.dbname
+        db = DatabaseConnection(dbname, self.config)
+        dialect = db.engine.dialect.name
+        if dialect not in ('mysql', 'mariadb', 'sqlite'):
+            raise ValueError(f"cannot migrate archive tables with {dialect}: "
+                             "use MariaDB or MySQL")
+        tnow = time.time()
+        tmin, tmax = tnow - 365*SEC_DAY, tnow + 365*SEC_DAY
+        run = self.cache.db.get_rows('runs', where={'db': dbname}, limit_one=True,
+                                     none_if_empty=True)
+        if run is not None and run.start_time > 1:
+            tmin = float(run.start_time)
+            tmax = max(tmin, min(float(run.stop_time), tmax))
+        options = schema.data_table_options(self.config, tmin, tmax)
+
+        conn = db.engine.connect()
+        if dialect != 'sqlite':
+            conn = conn.execution_options(isolation_level='READ COMMITTED')
+        def execute(sql, **kws):
+            result = conn.execute(text(sql), kws)
+            conn.commit()
+            return result
+
+        existing = set(inspect(db.engine).get_table_names())
+        tables = schema.data_tables(db.tables)
+        for itab, tabname in enumerate(tables):
+            t0 = time.time()
+            newtab, oldtab = f'{tabname}_new', f'{tabname}_old'
+            delta, trigger = f'{tabname}_delta', f'{tabname}_migrate'
+            if oldtab in existing:
+                print(f"{dbname}.{oldtab} exists: drop it to migrate {tabname}")
+                continue
+            execute(f"drop trigger if exists {trigger}")
+            for tab in (newtab, delta):
+                execute(f"drop table if exists {tab}")
+            db.sql_execute(schema.data_table_create(tabname, name=newtab, **options))
+            db.sql_execute(schema.data_table_create(tabname, name=delta))
+            execute(schema.migrate_trigger.format(trigger=trigger, table=tabname,
+                                                  delta=delta))
+            ncopied = 0
+            ids = execute(f"select distinct pv_id from {tabname}").fetchall()
+            for pvid in sorted(row[0] for row in ids):
+                ncopied += self._copy_pv_values(execute, tabname, newtab, delta,
+                                                pvid, chunk)
+
+            if dialect == 'sqlite':
+                with db.engine.begin() as swap:
+                    swap.execute(text(f"alter table {tabname} rename to {oldtab}"))
+                    swap.execute(text(f"alter table {newtab} rename to {tabname}"))
+            else:
+                execute(f"rename table {tabname} to {oldtab}, {newtab} to {tabname}")
+            execute(f"drop trigger if exists {trigger}")
+            execute(f"""insert into {tabname} (pv_id, time, value)
+            select pv_id, time, value from {delta}""")
+            ndelta = execute(f"select count(*) from {delta}").scalar()
+            nold = execute(f"select count(*) from {oldtab}").scalar()
+            if ncopied + ndelta != nold:
+                print(f"{dbname}.{tabname}: {nold} values in {oldtab}, but "
+                      f"{ncopied+ndelta} copied: keeping {oldtab} and {delta}")
+            elif not keep:
+                execute(f"drop table {oldtab}")
+                execute(f"drop table {delta}")
+            print(f"migrated {dbname}.{tabname} ({itab+1}/{len(tables)}): "
+                  f"{len(ids)} PVs, {ncopied} values copied, {ndelta} values "
+                  f"caught up, {time.time()-t0:.1f} sec")
+        conn.close()
+        # reflect the new tables
+        db = DatabaseConnection(dbname, self.config, refresh=True)
+        if dbname == self.dbname:
+            self.db = db
+            self.insert_stmts = {}
+
+    def _copy_pv_values(self, execute, tabname, newtab, delta, pvid, chunk):
+        """copy values of a PV to a new data table, in ranges of at most
+        chunk values, except values also in the delta table.  returns the
+        number of values copied"""
+        ncopied, tlo = 0, None
+        while True:
+            after = '' if tlo is None else 'and time > :tlo'
+            thi = execute(f"""select time from {tabname} where pv_id = :pvid {after}
+            order by time limit 1 offset :offset""",
+                          pvid=pvid, tlo=tlo, offset=chunk-1).scalar()
+            trange = '' if tlo is None else 'and t.time > :tlo'
+            if thi is not None:
+                trange = f'{trange} and t.time <= :thi'
+            res = execute(f"""insert into {newtab} (pv_id, time, value)
+            select t.pv_id, t.time, t.value from {tabname} t
+            where t.pv_id = :pvid {trange} and not exists (select 1 from {delta} d
+            where d.pv_id = t.pv_id and d.time = t.time)""", pvid=pvid, tlo=tlo, thi=thi)
+            ncopied += max(0, res.rowcount)
+            if thi is None:
+                return ncopied
+            tlo = thi
+
+    def check_rollups(self, dbname=None, rebuild=False, chunk=100):
+        """compare the rollup tables of an archive database with rollups
+        computed from its data tables, and optionally rebuild the rollups
+        of PVs that differ (creating the rollup tables if needed).
+
+        Values archived while the current database is rebuilt may be
+        counted twice or not at all: check again to verify.  Buckets open
+        when the run started, which hold values of the previous run copied
+        at rollover, are not checked.
+
+        Arguments
+        ----------
+        dbname   name of archive database [None, current database]
+        rebuild  whether to rebuild rollups of PVs that differ [False]
+        chunk    number of PVs read per query [100]
+        """
+        if dbname is None:
+            dbname = self.dbname
+        db = DatabaseConnection(dbname, self.config)
+        if not has_rollups(db.tables):
+            if not rebuild:
+                print(f"{dbname} has no rollup tables: use 'rollup rebuild' to create them")
+                return
+            for name, width in schema.ROLLUPS:
+                if name not in db.tables:
+                    db.sql_execute(schema.rollup_init.format(name=name))
+            db = DatabaseConnection(dbname, self.config, refresh=True)
+        dialect = db.engine.dialect.name
+        run = self.cache.db.get_rows('runs', where={'db': dbname}, limit_one=True,
+                                     none_if_empty=True)
+        tstart = None
+        if run is not None and run.start_time > 1:
+            tstart = float(run.start_time)
+        counts = {name: [0, 0, 0] for name, width in schema.ROLLUPS}
+        for tabname in schema.data_tables(db.tables):
+            dtab = db.tables[tabname]
+            rows = db.execute(select(dtab.c.pv_id).distinct()).fetchall()
+            ids = sorted(row[0] for row in rows)
+            for i in range(0, len(ids), chunk):
+                cids = ids[i:i+chunk]
+                rows = db.execute(select(dtab.c.pv_id, dtab.c.time, dtab.c.value).where(
+                    dtab.c.pv_id.in_(cids))).fetchall()
+                pvids = np.array([row[0] for row in rows], dtype=np.int64)
+                times = np.array([row[1] for row in rows], dtype=np.float64)
+                values = np.array([as_float(clean_value(row[2])) for row in rows],
+                                  dtype=np.float64)
+                good = np.isfinite(values)
+                pvids, times, values = pvids[good], times[good], values[good]
+                for name, width in schema.ROLLUPS:
+                    rtab = db.tables[name]
+                    expected = aggregate_records(pvids, times, values, width)
+                    found = [row2dict(row) for row in db.execute(
+                        rtab.select().where(rtab.c.pv_id.in_(cids))).fetchall()]
+                    topen = None
+                    if tstart is not None:
+                        topen = np.floor(tstart/width)*width
+                        carried = {r['pv_id'] for r in found if r['tbucket'] == topen}
+                        found = [r for r in found if r['tbucket'] != topen]
+                        expected = [r for r in expected if r['tbucket'] != topen
+                                    or r['pv_id'] not in carried]
+                    bad = compare_rollups(expected, found)
+                    counts[name][0] += len(set(pvids.tolist()))
+                    counts[name][1] += len(bad)
+                    if rebuild and len(bad) > 0:
+                        upsert = db.statement(('rollup_upsert', name),
+                                              lambda: upsert_stmt(rtab, dialect))
+                        records = [r for r in expected if r['pv_id'] in bad]
+                        with Session(db.engine) as session, session.begin():
+                            session.execute(delete_rollups(rtab, sorted(bad), keep=topen))
+                            if len(records) > 0:
+                                session.execute(upsert, records)
+                        counts[name][2] += len(bad)
+        out = [['Rollup Table', 'PVs checked', 'PVs differing', 'PVs rebuilt']]
+        for name, width in schema.ROLLUPS:
+            out.append([f'{dbname}.{name}', *counts[name]])
+        print(tabulate(out, headers='firstrow', tablefmt='simple_grid'))
+
     def mainloop(self,verbose=False):
         t0 = time.time()
         self.log('connecting to archive database')
         self.use_archivedb()
         self.last_collect = t0
+        self.last_seq = self.cache.get_last_seq()
         self.pid = os.getpid()
         self.cache.set_info(process='archive', pid=self.pid, status='running')
+        self.open_spool()
 
         collecting = True
         n_changed = n_forced = n_loop = last_report = 0
@@ -514,8 +1072,17 @@ class Archiver:
                 n_loop = n_loop + 1
 
                 tnow = time.time()
+                if (self.spool is not None and tnow > self.next_replay
+                    and self.spool.backlog()):
+                    try:
+                        self.replay_spool()
+                    except Exception as exc:
+                        self.log(f"could not replay spool: {exc}", level='warn')
+                        self.next_replay = tnow + 10.0
                 if tnow > last_report + float(self.config.archive_report_period):
                     self.log(msg % (n_changed, n_forced, n_loop))
+                    self.log(self.report_stats())
+                    self.reset_stats()
                     n_changed = n_forced = n_loop = 0
                     last_report = tnow
                 if tnow > last_info + 2.0:
@@ -527,82 +1094,118 @@ class Archiver:
                 self.log('Interrupted by user.', level='warn')
                 collecting = False
                 break
+            except Exception as exc:
+                # with a spool, values decided so far are kept: wait
+                # for the database to come back
+                if self.spool is None:
+                    raise
+                self.log(f"Exception while archiving: {exc}", level='warn')
+                time.sleep(1.0)
+                continue
 
             pid, status = self.cache.get_pidstatus(process='archive')
             if status in ('stopping', 'offline') or pid != self.pid:
                 logging.debug('no longer main archiving program, exiting.')
                 collecting = False
 
+        if self.spool is not None:
+            self.spool.close()
+            self.spool = None
         self.cache.set_info(process='archive', status='offline')
         return None
 
     def shutdown(self):
         self.cache.set_info(process='archive', status='stopping')
 
-    def save_zarr(self, dbname=None, install=False):
+    def save_zarr(self, dbname=None, install=False, workers=None, live=False,
+                  codec=None):
         """save database to zipped zarr file for
-        simpler and faster data extraction"""
+        simpler and faster data extraction
+
+        Values are first exported to a sidecar store, '<dbname>_zarr.sqlite',
+        with the time up to which each PV has been exported, so that an
+        interrupted export continues where it stopped.  When all values are
+        exported, the number of values for each PV is checked against the
+        database (values of PVs that differ are read again), the zip file
+        is written, and the sidecar store is removed.
+
+        With live=True, as for the current archive database, only values
+        more than zarr_live_lag seconds old are exported, and the sidecar
+        store is kept (in zarrdir) for get_data and for later exports.
+
+        Arguments
+        ----------
+        dbname   name of archive database [None, current database]
+        install  whether to write to zarrdir, replacing any earlier file [False]
+        workers  number of processes reading data tables [None, zarr_export_workers]
+        live     whether to export values so far to the sidecar store only [False]
+        codec    codec pipeline for the zip file, 'gzip', 'shuffle' or 'xor'
+                 (see zarrcodecs.py) [None, zarr_codec]
+        """
         if dbname is None:
             dbname = self.dbname
+        if workers is None:
+            workers = int(self.config.zarr_export_workers)
+        if codec is None:
+            codec = self.config.zarr_codec
+        if codec not in CODECS:
+            raise ValueError(f"unknown zarr codec '{codec}': use one of {CODECS}")
         db = DatabaseConnection(dbname, self.config)
 
-        if install:
-            tfile = Path(self.config.zarrdir, f'tmp_zarr.zip').absolute()
-            zfile = Path(self.config.zarrdir, f'{dbname}_zarr.zip').absolute()
-        else:
-            tfile = Path(f'tmp_zarr.zip').absolute()
-            zfile = Path(f'{dbname}_zarr.zip').absolute()
-
-        store = zarr.ZipStore(tfile.as_posix(), mode='w')
-        zroot = zarr.group(store=store)
-        zpv = zroot.create_group('pvarch')
-
-        pvrows = db.get_rows('pv')
-        nreport = 500
-        print(f" writing to file {tfile}: {len(pvrows)} pvs")
-        for i, pvrow in enumerate(pvrows):
-            if i > 10 and (i % nreport  == 0):
-                print(f"{i}", end=", ", flush=True)
-            grp = zpv.create_group(pvrow.name)
-            try:
-                graph_hi = float(pvrow.graph_hi)
-            except:
-                graph_hi = ''
-            try:
-                graph_lo = float(pvrow.graph_lo)
-            except:
-                graph_lo = ''
-
-            grp.attrs.update( {'description': pvrow.description,
-                               'type': pvrow.type,
-                               'deadtime': float(pvrow.deadtime),
-                               'deadband': float(pvrow.deadband),
-                               'graph_hi': graph_hi,
-                               'graph_lo': graph_lo,
-                               'graph_type': pvrow.graph_type})
-
-            dbvals = db.get_rows(pvrow.data_table, where={'pv_id': pvrow.id})
-            times, values = [], []
-            is_float = True
-
-            for tx, pid, vx in dbvals:
-                times.append(float(tx))
-                if is_float:
-                    try:
-                        val = float(vx)
-                    except ValueError:
-                        is_float = False
-                        val = str2bytes(vx)
-                else:
-                    val = str2bytes(vx)
-                values.append(val)
-            times = np.array(times)
-            values = np.array(values)
-            ndat = len(times)
-            grp.create_dataset('ts', data=times,  compression='gzip')
-            grp.create_dataset('data', data=values, compression='gzip')
-        # finally, rename to the final file name
-        print(" done")
+        folder = Path(self.config.zarrdir) if (install or live) else Path('.')
+        sfile = Path(folder, f'{dbname}_zarr.sqlite').absolute()
+        tfile = Path(folder, f'{dbname}_zarr.zip.tmp').absolute()
+        zfile = Path(folder, f'{dbname}_zarr.zip').absolute()
+
+        exported_to = MAX_EPOCH
+        if live:
+            exported_to = time.time() - float(self.config.zarr_live_lag)
+        tabnames = schema.data_tables(db.tables)
+        pvrows = {}
+        for pvrow in db.get_rows('pv'):
+            if pvrow.data_table in tabnames:
+                pvrows.setdefault(pvrow.data_table, []).append(pvrow)
+
+        sidecar = ZarrSidecar(sfile.as_posix(), chunk_size=int(self.config.zarr_chunk_size))
+        checkpoints = sidecar.checkpoints()
+        ranges = {}
+        for tabname, trows in pvrows.items():
+            tdone = [checkpoints.get(pvrow.name, None) for pvrow in trows]
+            tmin = None if None in tdone else min(tdone)
+            if tmin is None or tmin < exported_to:
+                ranges[tabname] = (tmin, exported_to)
+        print(f" exporting to {sfile}: {sum(len(r) for r in pvrows.values())} pvs, "
+              f"{len(ranges)} of {len(pvrows)} tables, {workers} workers")
+        progress = ExportProgress(len(ranges))
+        for tabname, nrows, series in read_tables(dbname, self.config, list(ranges),
+                                                  workers=workers, ranges=ranges):
+            sidecar.write_table(pvrows[tabname], series, checkpoints, exported_to)
+            progress.table_done(tabname, nrows, len(series))
+        if live:
+            sidecar.close()
+            return
+
+        # values written late (as from the spool) may have been missed
+        nfixed = 0
+        for tabname, trows in pvrows.items():
+            counts = table_counts(db, tabname)
+            redo = [pvrow for pvrow in trows
+                    if sidecar.npts(pvrow.name) != counts.get(pvrow.id, 0)]
+            if len(redo) > 0:
+                byid = {pvrow.id: pvrow for pvrow in redo}
+                tab, nrows, series = read_table(dbname, self.config, tabname,
+                                                pvids=list(byid.keys()))
+                found = {pvid: (times, values) for pvid, times, values in series}
+                for pvid, pvrow in byid.items():
+                    times, values = found.get(pvid, (np.zeros(0), np.zeros(0)))
+                    sidecar.rewrite(pvrow, times, values, exported_to)
+                nfixed += len(redo)
+        if nfixed > 0:
+            print(f" read values again for {nfixed} pvs")
+
+        print(f" writing to file {tfile}")
+        sidecar.write_zip(tfile.as_posix(), levels=parse_levels(self.config.zarr_levels),
+                          codec=codec)
         tfile.rename(zfile)
-        # zroot.close()
+        sidecar.remove()
         print(f"wrote {zfile}")
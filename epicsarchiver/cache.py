@@ -7,27 +7,36 @@ import re
 import json
 import time
 import logging
-from smtplib import SMTP
-from email.mime.text import MIMEText
+import threading
 from decimal import Decimal
 from datetime import datetime
+from pathlib import Path
 
 import psutil
 import numpy as np
+from sqlalchemy import func, select, bindparam
 from sqlalchemy.orm import Session
 from epics import get_pv
 from tabulate import tabulate
 from .util import (clean_bytes, normalize_pvname, tformat, valid_pvname,
                    clean_mail_message, DatabaseConnection, MAX_EPOCH,
-                   get_config, motor_fields, hformat, row2dict)
+                   get_config, motor_fields, hformat, row2dict, get_pvpair,
+                   SEC_DAY, get_registry)
 
 from . import schema
+from .shmcache import SharedCacheWriter, SharedCacheReader, CacheRow
+from .capture import RingBuffer
+from .spool import set_aside
+from .alerts import AlertEngine
+from .mailer import AlertMailer
+from .pairs import PairGraph, MAX_PAIR_SCORE
+from .pvstate import as_float
+from .rollup import has_rollups, update_rollups, copy_open_rollups
 
 logging.basicConfig(level=logging.INFO,
                     format='%(levelname)s [%(asctime)s]  %(message)s',
                     datefmt='%Y-%b-%d %H:%M:%S')
 
-MAX_PAIR_SCORE = 500000
 OPTOKENS = ('ne', 'eq', 'le', 'lt', 'ge', 'gt')
 OPSTRINGS = ('not equal to', 'equal to', 'less than or equal to',
              'less than', 'greater than or equal to', 'greater than')
@@ -36,6 +45,116 @@ OPS = {'eq':'__eq__', 'ne':'__ne__',  'le':'__le__',
        'lt':'__lt__', 'ge':'__ge__', 'gt':'__gt__'}
 
 
+def values_dict(rows):
+    """dict with pvnames as keys and dict of (id, value, cvalue, dtype, ts)
+    as values for rows of the cache table"""
+    out = {}
+    for row in rows:
+        out[row.pvname] = {'id': row.id, 'value': row.value,
+                           'cvalue': row.cvalue, 'dtype': row.type,
+                           'ts': float(row.ts)}
+    return out
+
+
+class PVRegistry:
+    """in-memory registry of PVs in the cache table, with dicts of
+    pvname -> cache id, type, and active status.
+
+    The registry is refreshed incrementally: adding, dropping, or
+    suspending a PV sets a new registry generation in the info table,
+    and only the (narrow) rows given a later generation than the last
+    refresh are read.  A drop causes a full reload, as does a refresh
+    more than `full_interval` seconds after the last reload.
+    """
+    def __init__(self, db, min_interval=1.0, full_interval=300.0):
+        self.db = db
+        self.min_interval = min_interval
+        self.full_interval = full_interval
+        self.ids, self.types, self.active = {}, {}, {}
+        self.generation = 0
+        self.last_refresh = self.last_reload = 0
+
+    def _query(self):
+        ctab = self.db.tables['cache']
+        return ctab, select(ctab.c.id, ctab.c.pvname, ctab.c.type,
+                            ctab.c.active)
+
+    def _update(self, rows):
+        new = []
+        for row in rows:
+            if row.pvname not in self.ids:
+                new.append(row.pvname)
+            self.ids[row.pvname] = row.id
+            self.types[row.pvname] = row.type
+            self.active[row.pvname] = row.active
+        return new
+
+    def get_generation(self):
+        """(generation, generation of last drop) of the registry,
+        from the info table"""
+        row = self.db.get_rows('info', where={'process': 'registry'},
+                               limit_one=True, none_if_empty=True)
+        if row is None:
+            return 0, 0
+        return int(row.ts), int(row.pid)
+
+    def next_generation(self):
+        """generation to give rows of the cache table that are added or
+        changed, before calling set_generation() once they are written"""
+        return self.get_generation()[0] + 1
+
+    def set_generation(self, generation, dropped=False):
+        """set registry generation, after rows given this generation are
+        written or, with `dropped=True`, after rows are deleted"""
+        kws = {'pid': generation} if dropped else {}
+        self.db.update('info', where={'process': 'registry'}, ts=generation, **kws)
+
+    def reload(self):
+        "reload full registry, returns list of new pvnames"
+        generation = self.get_generation()[0]
+        ctab, query = self._query()
+        rows = self.db.execute(query).fetchall()
+        current = set(row.pvname for row in rows)
+        for pvname in list(self.ids.keys()):
+            if pvname not in current:
+                self.remove(pvname)
+        self.generation = generation
+        self.last_refresh = self.last_reload = time.monotonic()
+        return self._update(rows)
+
+    def refresh(self, force=False):
+        """update registry from rows added or changed since the last refresh,
+        returns list of new pvnames.  Unless `force` is True, this does
+        nothing within `min_interval` seconds of the last refresh."""
+        now = time.monotonic()
+        if now > self.last_reload + self.full_interval:
+            return self.reload()
+        if not force and now < self.last_refresh + self.min_interval:
+            return []
+        generation, dropped = self.get_generation()
+        if dropped > self.generation:
+            return self.reload()
+        self.last_refresh = now
+        if generation <= self.generation:
+            return []
+        ctab, query = self._query()
+        rows = self.db.execute(query.where(ctab.c.regseq>self.generation)).fetchall()
+        self.generation = generation
+        return self._update(rows)
+
+    def remove(self, pvname):
+        "remove pvname from registry, returning its cache id"
+        self.types.pop(pvname, None)
+        self.active.pop(pvname, None)
+        return self.ids.pop(pvname, None)
+
+    def __contains__(self, pvname):
+        return pvname in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+
 class Cache:
     """interface to main/master pvarch database,
     used for running the caching process and for
@@ -58,11 +177,34 @@ class Cache:
         self.pidfile = os.path.join(self.config.logdir,  'pvcache.pid')
         self.db = DatabaseConnection(self.config.cache_db, self.config)
         self.tables  = self.db.tables
+        self.check_cache_schema()
+        self.shm = self.shm_writer = None
+        self.shm_retry = 0
         self.pid, _status = self.get_pidstatus()
+        self.seq = self.get_last_seq()
 
         self.pvs   = {}
         self.data  = {}
-        self.pvtypes = {}
+        self.data_cond = threading.Condition()
+        self.first_pending = None
+        self.batch_size = int(self.config.cache_batch_size)
+        self.flush_interval = float(self.config.cache_latency_budget or
+                                    self.config.cache_flush_interval)
+        self.registry = PVRegistry(self.db)
+        self.pvtypes = self.registry.types
+        self.pvids = self.registry.ids
+        self.alert_data = {}
+        self.alert_engine = None
+        self.mailer = None
+        self.pairs = PairGraph(self.db,
+                               flush_period=float(self.config.pair_flush_period))
+        self.capture = {}
+        self.archdb = None
+        self.archive_pvinfo = {}
+        self.capture_pending = {}
+        self.connect_start = time.monotonic()
+        self.connect_times = {}
+        self.reset_stats()
         pvnames = self.get_pvnames()
         time.sleep(0.01)
         self.read_alert_table()
@@ -78,6 +220,101 @@ class Cache:
         writer = self.log_writers.get(level, self.logger.info)
         writer(message)
 
+    def reset_stats(self):
+        "reset counters for cache writes, reported by mainloop"
+        self.stats = {'rows': 0, 'batches': 0, 'write_time': 0.0,
+                      'max_batch_time': 0.0, 'wakeups': 0, 'flushes': 0,
+                      'max_flush_rows': 0, 'latency': 0.0,
+                      'max_latency': 0.0, 'tstart': time.monotonic()}
+
+    def report_stats(self):
+        "string summarizing cache write rate and batch latency"
+        st = self.stats
+        elapsed = max(1.e-3, time.monotonic() - st['tstart'])
+        nbatch = max(1, st['batches'])
+        nflush = max(1, st['flushes'])
+        nrows = max(1, st['rows'])
+        return (f"{st['rows']/elapsed:.1f} rows/sec, {st['wakeups']} wakeups, "
+                f"{st['flushes']} flushes of {st['rows']/nflush:.1f} rows mean, "
+                f"{st['max_flush_rows']} max, {st['batches']} batches, "
+                f"batch latency {1000*st['write_time']/nbatch:.1f} ms mean, "
+                f"{1000*st['max_batch_time']:.1f} ms max, "
+                f"callback-to-commit {1000*st['latency']/nrows:.1f} ms mean, "
+                f"{1000*st['max_latency']:.1f} ms max")
+
+    def check_cache_schema(self):
+        """upgrade cache table from earlier versions, adding the
+        'seq' column for the change feed and the 'regseq' column and
+        'registry' info row for PV registries if needed"""
+        for column, sql in (('seq', schema.cache_add_seq),
+                            ('regseq', schema.cache_add_regseq)):
+            if column not in self.tables['cache'].c:
+                self.log(f"adding '{column}' column to cache table")
+                self.db.sql_execute(sql)
+                self.db = DatabaseConnection(self.config.cache_db, self.config,
+                                             refresh=True)
+                self.tables  = self.db.tables
+        if self.get_info(process='registry') is None:
+            self.db.sql_execute(schema.info_add_registry)
+
+    def shm_reader(self):
+        """return reader for the shared-memory cache published by the
+        cache process, or None if it is not available or not current"""
+        now = time.monotonic()
+        if self.shm is None and now > self.shm_retry:
+            self.shm_retry = now + 10.0
+            self.shm = SharedCacheReader.open(self.config.cache_shm_file,
+                                              fetch=self.get_rows_by_id)
+        if self.shm is None or not self.shm.check():
+            return None
+        return self.shm
+
+    def get_rows_by_id(self, ids):
+        "return rows of the cache table for a list of cache ids"
+        ctab = self.tables['cache']
+        return self.db.execute(ctab.select().where(ctab.c.id.in_(ids))).fetchall()
+
+    def get_last_seq(self):
+        "return the most recent sequence number written to the cache table"
+        shm = self.shm_reader()
+        if shm is not None:
+            return shm.seq
+        ctab = self.tables['cache']
+        seq = self.db.execute(func.max(ctab.c.seq).select()).scalar()
+        return 0 if seq is None else int(seq)
+
+    def changes_since(self, seq=0, limit=None):
+        """return rows of the cache table written since sequence number `seq`
+
+        Arguments
+        ----------
+        seq      sequence number cursor from a previous call [0]
+        limit    max number of rows to return [None, no limit]
+
+        Returns
+        -------
+        rows, cursor  rows ordered by sequence number, and the cursor
+                      to pass to the next call
+
+        Example
+        -------
+        >>> rows, cursor = cache.changes_since(cache.get_last_seq())
+        >>> while True:
+        ...     rows, cursor = cache.changes_since(cursor)
+        """
+        shm = self.shm_reader()
+        if shm is not None:
+            out = shm.changes_since(seq, limit=limit)
+            if out is not None:
+                return out
+        ctab = self.tables['cache']
+        query = ctab.select().where(ctab.c.seq>seq).order_by(ctab.c.seq)
+        if limit is not None:
+            query = query.limit(limit)
+        rows = self.db.execute(query).fetchall()
+        if len(rows) > 0:
+            seq = int(rows[-1].seq)
+        return rows, seq
 
     def create_next_archive(self, copy_pvs=True):
         """Create a pvdata database for archiving
@@ -100,48 +337,91 @@ class Cache:
         dbname = conf.dat_format % (conf.dat_prefix, current_index+1)
         self.log(f"creating database {dbname}")
         for sql_cmd in (f"drop database if exists {dbname:s};",
-                        f"create database {dbname:s};",
-                        f"use {dbname:s};",
-                        schema.pvdat_init_pv ):
+                        f"create database {dbname:s};"):
             self.db.sql_execute(sql_cmd)
-        for idat in range(1, 129):
-            self.db.sql_execute(schema.pvdat_init_dat.format(idat=idat))
+        get_registry(conf).remove(dbname)
+        tnow = time.time()
+        try:
+            self.fill_next_archive(dbname, current_dbname, copy_pvs=copy_pvs,
+                                   tstart=tnow)
+        except Exception:
+            # refuse to roll over to an incomplete database
+            self.log(f"could not create {dbname}, removing it", level='error')
+            self.db.sql_execute(f"drop database if exists {dbname:s};")
+            get_registry(conf).remove(dbname)
+            raise
+
+        # update run info
+        # add this new run to the runs table
+        notes = f"{tformat(tnow)} to {tformat(MAX_EPOCH)}"
+        self.db = DatabaseConnection(self.config.cache_db, self.config)
+        self.db.insert('runs', db=dbname, notes=notes,
+                       start_time=tnow, stop_time=MAX_EPOCH)
+
+        self.tables  = self.db.tables
+        itab = self.db.tables['info']
+        self.db.execute(itab.update().where(
+            itab.c.process=='archive').values(db=dbname))
+        return dbname
+
+    def fill_next_archive(self, dbname, current_dbname=None, copy_pvs=True,
+                          tstart=None):
+        """create tables of a new archive database, copying PVs and rollup
+        rows of buckets open at its start time tstart [None, now] from the
+        current archive database"""
+        conf = self.config
+        # create tables with a connection to the new database (pooled
+        # connections to the cache database must not 'use' another one)
+        nextdb = DatabaseConnection(dbname, self.config)
+        tnow = time.time()
+        options = schema.data_table_options(conf, tnow, tnow+365*SEC_DAY)
+        sql = [schema.pvdat_init_pv] + schema.data_table_sql(typed=True, **options)
+        if conf.archive_rollups.lower().startswith('y'):
+            sql.extend(schema.rollup_sql())
+        for sql_cmd in sql:
+            nextdb.sql_execute(sql_cmd)
+        nextdb = DatabaseConnection(dbname, self.config, refresh=True)
 
         time.sleep(0.25)
         if copy_pvs and current_dbname is not None:
-            print("copy pvs from ", current_dbname)
+            self.log(f"copying pvs from {current_dbname}")
             archdb = DatabaseConnection(current_dbname, self.config)
-            nextdb = DatabaseConnection(dbname, self.config)
 
             cur_pvdat = archdb.execute(archdb.tables['pv'].select()).fetchall()
+            cur_typed = schema.is_typed(archdb.tables)
+            cur_values = {}
+            if not cur_typed:
+                cur_values = {row.pvname: row.value for row in self.get_values(all=True)}
 
             npv_insert = nextdb.tables['pv'].insert()
             for pvdata in cur_pvdat:
+                data_table = pvdata.data_table
+                if not cur_typed:
+                    # move numeric PVs to typed tables, keeping
+                    # arrays (not a single number) in string tables
+                    pvtype = pvdata.type
+                    if pvtype == 'double' and np.isnan(as_float(cur_values.get(pvdata.name, 0))):
+                        pvtype = 'string'
+                    data_table = schema.data_table_name(pvtype, int(data_table[5:]))
                 q = npv_insert.values(name=pvdata.name,
                                  description=pvdata.description,
                                  type=pvdata.type,
-                                 data_table=pvdata.data_table,
+                                 data_table=data_table,
                                  deadtime=pvdata.deadtime,
                                  deadband=pvdata.deadband,
                                  graph_lo=pvdata.graph_lo,
                                  graph_hi=pvdata.graph_hi,
                                  graph_type=pvdata.graph_type,
-                                 active=pvdata.active)
+                                 active=pvdata.active,
+                                 compression=getattr(pvdata, 'compression', 'deadband'),
+                                 tolerance=getattr(pvdata, 'tolerance', None))
                 nextdb.execute(q)
-
-        # update run info
-        # add this new run to the runs table
-        tnow = time.time()
-        notes = f"{tformat(tnow)} to {tformat(MAX_EPOCH)}"
-        self.db = DatabaseConnection(self.config.cache_db, self.config)
-        self.db.insert('runs', db=dbname, notes=notes,
-                       start_time=tnow, stop_time=MAX_EPOCH)
-
-        self.tables  = self.db.tables
-        itab = self.db.tables['info']
-        self.db.execute(itab.update().where(
-            itab.c.process=='archive').values(db=dbname))
-        return dbname
+            # buckets still being filled carry on in the new database
+            if has_rollups(nextdb.tables) and has_rollups(archdb.tables):
+                if tstart is None:
+                    tstart = time.time()
+                nrows = copy_open_rollups(archdb, nextdb, tstart)
+                self.log(f"copied {nrows} rollup rows from {current_dbname}")
 
     def get_info(self, process='cache'):
         " get value from info table"
@@ -157,16 +437,51 @@ class Cache:
         # print("Set info ", process, kws)
         self.db.update('info', where={'process': process}, **kws)
 
-    def get_pvnames(self):
-        """ generate self.pvnames: a list of pvnames in the cache"""
-        pvnames = []
-        for row in self.db.get_rows('cache'):
-            if row.pvname not in pvnames:
-                pvnames.append(row.pvname)
-                self.pvtypes[row.pvname] = row.type
-            if row.pvname not in self.pvs and self.pvconnect:
-                self.pvs[row.pvname] = get_pv(row.pvname)
-        return pvnames
+    def get_pvnames(self, force=False):
+        """return list of pvnames in the cache, from the PV registry"""
+        self.refresh_registry(force=force)
+        return list(self.pvids.keys())
+
+    def refresh_registry(self, force=False):
+        """refresh the PV registry from rows added or changed in the
+        cache table, creating channels (if connecting to PVs) and
+        shared-memory slots (if running the cache) for new PVs.
+        returns list of new pvnames"""
+        new = self.registry.refresh(force=force)
+        if len(new) > 0:
+            if self.pvconnect:
+                for pvname in new:
+                    if pvname not in self.pvs:
+                        self.create_pv(pvname)
+            if self.shm_writer is not None:
+                self.shm_writer.register(self.get_rows_by_id([self.pvids[p] for p in new]))
+        return new
+
+    def create_pv(self, pvname):
+        """create channel for a PV, without waiting for it to connect.
+        The initial value will come from the first monitor callback."""
+        pv = get_pv(pvname, callback=self.onChanges,
+                    connection_callback=self.onConnect)
+        self.pvs[pvname] = pv
+        return pv
+
+    def wait_for_connections(self, pvs, timeout=None):
+        """wait for a list of PVs to connect, concurrently, with a single
+        overall timeout [config.cache_connect_timeout].
+        returns list of connected PVs"""
+        if timeout is None:
+            timeout = float(self.config.cache_connect_timeout)
+        tend = time.monotonic() + timeout
+        waiting = [pv for pv in pvs if not pv.connected]
+        while len(waiting) > 0 and time.monotonic() < tend:
+            time.sleep(0.05)
+            waiting = [pv for pv in waiting if not pv.connected]
+        return [pv for pv in pvs if pv.connected]
+
+    def onConnect(self, pvname=None, conn=None, **kws):
+        "connection callback: record time to first connection"
+        if conn and pvname not in self.connect_times:
+            self.connect_times[pvname] = time.monotonic() - self.connect_start
 
     def get_enum_strings(self):
         """
@@ -188,9 +503,8 @@ class Cache:
         for row in self.db.get_rows('pvextra', where={'notes': 'enum_strs'}):
             all_enumstrs[row.pv] = row.data
 
-        for row in self.db.get_rows('cache'):
-            pvname = row.pvname
-            if row.type == 'enum' and pvname in self.pvs:
+        for pvname, dtype in self.pvtypes.items():
+            if dtype == 'enum' and pvname in self.pvs:
                 if not self.pvs[pvname].connected:
                     continue
                 enumstrs = self.pvs[pvname].enum_strs
@@ -205,6 +519,154 @@ class Cache:
                                        where={'pv':pvname, 'notes': 'enum_strs'},
                                        data=enumstrs)
 
+    def get_capture_settings(self):
+        """return dict of PVs in capture mode, with a dict of
+        'size' and 'overflows' for each"""
+        out = {}
+        for row in self.db.get_rows('pvextra', where={'notes': 'capture'}):
+            out[row.pv] = json.loads(row.data)
+        return out
+
+    def set_capture(self, pvname, size=None):
+        """put a PV in capture mode, so that every monitor update is
+        archived, using a ring buffer of `size` updates between drains
+        [default: config.cache_capture_size].  Only numeric PVs can be
+        captured."""
+        pvname = normalize_pvname(pvname)
+        if size is None:
+            size = self.config.cache_capture_size
+        data = json.dumps({'size': int(size), 'overflows': 0})
+        if pvname in self.get_capture_settings():
+            self.db.update('pvextra', where={'pv': pvname, 'notes': 'capture'},
+                           data=data)
+        else:
+            self.db.insert('pvextra', pv=pvname, notes='capture', data=data)
+
+    def clear_capture(self, pvname):
+        "take a PV out of capture mode"
+        self.db.delete_rows('pvextra', where={'pv': normalize_pvname(pvname),
+                                              'notes': 'capture'})
+
+    def read_capture_settings(self):
+        """create, resize, or remove ring buffers for PVs in capture mode,
+        draining any buffers that are about to be replaced"""
+        settings = self.get_capture_settings()
+        stale = [p for p, buf in self.capture.items() if
+                 p not in settings or buf.size != int(settings[p].get('size', 0))]
+        if len(stale) > 0:
+            self.drain_captures()
+        with self.data_cond:
+            for pvname in stale:
+                self.capture.pop(pvname)
+            for pvname, conf in settings.items():
+                if pvname not in self.capture:
+                    if self.pvtypes.get(pvname, 'double') not in ('double', 'int', 'enum'):
+                        self.log(f"cannot capture non-numeric PV {pvname}", level='warn')
+                        continue
+                    size = conf.get('size', self.config.cache_capture_size)
+                    self.capture[pvname] = RingBuffer(int(size))
+
+    def get_archive_db(self):
+        "connection to the current archive database, as for capture buffers"
+        dbname = self.get_info(process='archive').db
+        if self.archdb is None or self.archdb.dbname != dbname:
+            self.archdb = DatabaseConnection(dbname, self.config)
+            self.archive_pvinfo = {}
+        return self.archdb
+
+    def drain_captures(self, final=False):
+        """write all updates held in capture buffers to the current
+        archive database, with one bulk insert per data table.  Updates
+        that cannot be written are kept, and written with the next drain.
+        With final=True, as when stopping, updates that still cannot be
+        written are set aside in the archiver's spool directory, to be
+        written by the archiver.  returns number of values written"""
+        with self.data_cond:
+            for pvname, buf in self.capture.items():
+                if len(buf) > 0:
+                    ts, vals, noverflow = buf.drain()
+                    if pvname in self.capture_pending:
+                        ots, ovals = self.capture_pending[pvname]
+                        ts, vals = np.concatenate((ots, ts)), np.concatenate((ovals, vals))
+                    self.capture_pending[pvname] = (ts, vals)
+        if len(self.capture_pending) == 0:
+            return 0
+        try:
+            nrows = self.write_captures(self.capture_pending)
+        except Exception as exc:
+            npend = sum(len(ts) for ts, vals in self.capture_pending.values())
+            self.log(f"could not write captured values, keeping {npend}: {exc}",
+                     level='warn')
+            if final:
+                self.set_aside_captures()
+            return 0
+        self.capture_pending = {}
+        return nrows
+
+    def write_captures(self, captured):
+        """write dict of {pvname: (times, values)} of captured updates to
+        the current archive database, in one transaction.
+        returns number of values written"""
+        archdb = self.get_archive_db()
+        tabrows = {}
+        for pvname, (ts, vals) in captured.items():
+            pvrow = self.archive_pvinfo.get(pvname, None)
+            if pvrow is None:
+                pvrow = archdb.get_rows('pv', where={'name': pvname},
+                                        limit_one=True, none_if_empty=True)
+                if pvrow is None:
+                    self.log(f"capture: PV {pvname} not in archive", level='warn')
+                    continue
+                self.archive_pvinfo[pvname] = pvrow
+            tabname = pvrow.data_table
+            fmt = '%d' if pvrow.type in ('int', 'enum') else '%.15g'
+            typed = schema.data_table_kind(tabname) != 'string'
+            rows = tabrows.setdefault(tabname, [])
+            for t, v in zip(ts.tolist(), vals.tolist()):
+                v = schema.data_value(tabname, v) if typed else fmt % v
+                rows.append({'pv_id': pvrow.id, 'time': t, 'value': v})
+
+        nrows = 0
+        with Session(archdb.engine) as session, session.begin():
+            for tabname, rows in tabrows.items():
+                session.execute(archdb.tables[tabname].insert(), rows)
+                nrows += len(rows)
+            if has_rollups(archdb.tables):
+                update_rollups(session, archdb, tabrows)
+            session.flush()
+        return nrows
+
+    def set_aside_captures(self):
+        """set aside captured updates not yet written, for PVs with known
+        ids in the current archive database, in the spool directory"""
+        spooldir = self.config.archive_spool_dir
+        if spooldir in (None, '') or self.archdb is None:
+            return
+        dbname = self.archdb.dbname
+        records = []
+        for pvname, (ts, vals) in list(self.capture_pending.items()):
+            pvrow = self.archive_pvinfo.get(pvname, None)
+            if pvrow is not None:
+                fmt = '%d' if pvrow.type in ('int', 'enum') else '%.15g'
+                records.extend((pvrow.id, t, fmt % v)
+                               for t, v in zip(ts.tolist(), vals.tolist()))
+                self.capture_pending.pop(pvname)
+        if len(records) > 0:
+            heldfile = set_aside(spooldir, dbname, records,
+                                 name=f'{Path(dbname).name}_capture')
+            self.log(f"set aside {len(records)} captured values in {heldfile}",
+                     level='warn')
+
+    def report_captures(self):
+        """log and save overflow counts for capture buffers"""
+        for pvname, buf in self.capture.items():
+            if buf.total_overflows > 0:
+                self.log(f"capture buffer for {pvname} (size {buf.size}) "
+                         f"overflowed {buf.total_overflows} times", level='warn')
+            data = json.dumps({'size': buf.size, 'overflows': buf.total_overflows})
+            self.db.update('pvextra', where={'pv': pvname, 'notes': 'capture'},
+                           data=data)
+
     def get_narchived(self, time_ago=60):
         """
         return the number of values archived by the archive in the past N seconds.
@@ -215,11 +677,12 @@ class Cache:
         archdbname = self.get_info(process='archive').db
         archdb = DatabaseConnection(archdbname, self.config)
 
-        start_time = Decimal(time.time() - time_ago)
-        for i in range(1, 129):
-            tab = archdb.tables[f'pvdat{i:03}']
-            q = tab.select().where(tab.c.time > start_time)
-            n += len(archdb.execute(q).fetchall())
+        start_time = time.time() - time_ago
+        for tabname in schema.data_tables(archdb.tables):
+            tab = archdb.tables[tabname]
+            q = archdb.statement(('count_since', tabname), lambda: select(func.count()).select_from(
+                tab).where(tab.c.time > bindparam('_time')))
+            n += archdb.execute(q, params={'_time': start_time}).scalar()
         return n
 
     def show_status(self, with_archive=True, cache_time=60, archive_time=60):
@@ -261,13 +724,14 @@ class Cache:
         if dbname == current_dbname:
             tmax = MAX_EPOCH - 1.0
         archdb = DatabaseConnection(dbname, self.config)
-        for i in range(1, 129):
-            tabname = f'pvdat{i:03}'
+        for tabname in schema.data_tables(archdb.tables):
             oldest = archdb.get_rows(tabname, order_by='time',
                                      order_desc=False, limit_one=True)
             newest = archdb.get_rows(tabname, order_by='time',
                                      order_desc=True, limit_one=True)
-            print("  info: ", dbname, i, tformat(oldest[0]), tformat(newest[0]))
+            if oldest is None or newest is None:
+                continue
+            print("  info: ", dbname, tabname, tformat(oldest[0]), tformat(newest[0]))
             try:
                 tmin = min(tmin, float(oldest.time))
                 tmax = max(tmax, float(newest.time))
@@ -287,37 +751,77 @@ class Cache:
         self.db.update('runs', where={'db': dbname},
                        notes=notes, start_time=tmin, stop_time=tmax)
 
-    def connect_pvs(self, verbose=False):
-        """connect to unconnected PVs, make sure callback is defined"""
+    def connect_pvs(self, verbose=False, timeout=None):
+        """make sure all PVs have a callback defined, and wait for
+        unconnected PVs to connect, all at once, for up to `timeout`
+        seconds [config.cache_connect_timeout].
+
+        Initial values come from the first monitor callback, not from
+        a separate get() for each PV."""
         nnew = 0
         if not self.pvconnect:
             return 0
         t0 = time.time()
         nall = len(self.pvs)
-        nconn = 0
+        nconn_before = len(self.connect_times)
         for pvname, pv in self.pvs.items():
-            if pv.connected:
-                nconn += 1
-                if len(pv.callbacks) < 1:
-                    nnew += 1
-                    cval = pv.get(as_string=True)
-                    pv.add_callback(self.onChanges)
-                    self.data[pvname] = (pv.value, cval, time.time())
-                    if pvname in self.alert_data:
-                        self.alert_data[pvname]['last_value'] = pv.value
-                        self.alert_data[pvname]['last_notice'] = time.time() - 30.0
-        # self.update_pvextra()
+            if len(pv.callbacks) < 1:
+                nnew += 1
+                # run_now seeds self.data if a value has already arrived
+                pv.add_callback(self.onChanges, run_now=True)
+                pv.connection_callbacks.append(self.onConnect)
+                if pv.connected:
+                    self.onConnect(pvname=pvname, conn=True)
+        unconnected = [pv for pv in self.pvs.values() if not pv.connected]
+        if len(unconnected) > 0:
+            self.wait_for_connections(unconnected, timeout=timeout)
+        nconn = len([pv for pv in self.pvs.values() if pv.connected])
+        nnew += len(self.connect_times) - nconn_before
         if nnew > 0 or verbose:
-            self.log(f"connect to pvs: {(time.time()-t0):.3f} sec, {nnew} new connection, ({nconn}/{nall}) PVs")
+            msg = f"connect to pvs: {(time.time()-t0):.3f} sec, {nnew} new connection, ({nconn}/{nall}) PVs"
+            if len(self.connect_times) > 0:
+                ctimes = np.array(list(self.connect_times.values()))
+                p50, p90, p99 = np.percentile(ctimes, (50, 90, 99))
+                msg = (f"{msg}; connect times (sec): 50%={p50:.3f}, 90%={p90:.3f}, "
+                       f"99%={p99:.3f}, max={ctimes.max():.3f}")
+            self.log(msg)
         return nnew
 
     def onChanges(self, pvname=None, value=None, char_value=None, timestamp=None, **kws):
         if value is not None and pvname is not None:
             if timestamp is None:
                 timestamp = time.time()
-            self.data[pvname] = (value, char_value, timestamp)
-            if pvname in self.alert_data:
-                self.alert_data[pvname]['last_value'] = value
+            with self.data_cond:
+                self.data[pvname] = (value, char_value, timestamp, time.monotonic())
+                if pvname in self.capture:
+                    self.capture[pvname].append(timestamp, value)
+                npending = len(self.data)
+                if npending == 1:
+                    self.first_pending = time.monotonic()
+                if npending == 1 or npending == self.batch_size:
+                    self.data_cond.notify()
+
+    def wait_for_changes(self, timeout=0.5):
+        """wait for PV changes to arrive, then collect changes until
+        either `cache_batch_size` are pending or `cache_flush_interval`
+        (or `cache_latency_budget`, if set) has passed since the first
+        pending change.
+
+        returns number of pending changes, possibly 0 after timeout
+        """
+        budget = self.flush_interval
+        with self.data_cond:
+            if len(self.data) == 0:
+                self.data_cond.wait(timeout=timeout)
+                self.stats['wakeups'] += 1
+            if len(self.data) > 0:
+                deadline = self.first_pending + budget
+                while len(self.data) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.data_cond.wait(timeout=remaining)
+            return len(self.data)
 
     def mainloop(self):
         "main loop"
@@ -335,29 +839,29 @@ class Cache:
 
         nconn = self.connect_pvs()
         self.update_pvextra()
+        if self.config.cache_shm_file not in ('', None):
+            self.shm_writer = SharedCacheWriter(self.config.cache_shm_file,
+                                                nslots=2*len(self.pvs))
+            self.shm_writer.register(self.db.get_rows('cache'))
 
         msg = f'{nconn}/{len(self.pvs)} pvs connected, ready to run.'
         self.log(f'{msg} Cache Process ID= {self.pid}')
 
-        for alert in self.alert_data.values():
-            if alert['last_value'] is None and alert['pvname'] in self.pvs:
-                pv = self.pvs[alert['pvname']]
-                if pv.connected:
-                    alert['last_value'] = pv.value
-
         for name, alert in self.alert_data.items():
             self.log(f"Add Alert: {name} / {alert['pvname']}", level='debug')
+        self.process_alerts()
 
-        status_str = '%d values cached since last notice %d loops (%.1f sec)'
+        self.read_capture_settings()
+        status_str = '%d values cached since last notice %d loops (%.1f sec): %s'
         ncached, nloop, last_report, last_info, last_request_process = 0, 0, 0, 0, 0
+        last_capture = time.time()
+        self.reset_stats()
         collecting = True
         while collecting:
             try:
-                if len(self.data) == 0:
-                    n = 0
-                else:
+                n = 0
+                if self.wait_for_changes(timeout=0.5) > 0:
                     n = self.update_cache()
-                time.sleep(0.001)
 
             except KeyboardInterrupt:
                 self.log('Interrupted by user.')
@@ -375,22 +879,34 @@ class Cache:
             tnow = time.time()
             if tnow > last_info + 2.0:
                 self.set_info(process='cache', ts=tnow, datetime=tformat(tnow))
+                if self.shm_writer is not None:
+                    self.shm_writer.heartbeat()
                 last_info = tnow
                 pid, status = self.get_pidstatus()
                 if status in ('stopping', 'offline') or  pid != self.pid:
                     self.log('no longer main cache program, exiting.')
                     collecting = False
                     last_report = last_request_process = time.time() + 1
-            # process alerts every 15 seconds:
+            # process requests every 15 seconds:
             if time.time() > last_request_process + float(self.config.cache_alert_period):
                 self.process_requests()
-                self.process_alerts()
+                self.read_capture_settings()
                 last_request_process = time.time()
+            if tnow > last_capture + float(self.config.cache_capture_period):
+                self.drain_captures()
+                last_capture = tnow
             # report and connect unconnected PVs once ever 5 minutes
             if tnow > last_report + float(self.config.cache_report_period):
-                self.log(status_str % (ncached, nloop, float(self.config.cache_report_period)))
+                self.log(status_str % (ncached, nloop, float(self.config.cache_report_period),
+                                       self.report_stats()))
+                self.reset_stats()
+                self.report_captures()
+                if self.mailer is not None:
+                    self.log(self.mailer.report())
+                    self.mailer.reset_stats()
                 last_report = tnow
                 self.read_alert_table()
+                self.process_alerts()
                 self.connect_pvs()
                 ncached = 0
                 nloop = 0
@@ -398,12 +914,14 @@ class Cache:
                 self.update_pvextra()
 
             if len(self.pvtypes) < len(self.pvs):
-                for row in self.db.get_rows('cache'):
-                    if row.pvname not in self.pvtypes:
-                        self.pvtypes[row.pvname] = row.type
-                #self.get_pvnames()
-                print("$ got pvs ", len(self.pvs), len(self.pvtypes))
+                self.refresh_registry()
+        self.drain_captures(final=True)
+        if self.mailer is not None:
+            self.mailer.stop()
         self.set_info(process='cache', status='offline')
+        if self.shm_writer is not None:
+            self.shm_writer.close()
+            self.shm_writer = None
         self.log("Cache is offline")
         time.sleep(0.25)
 
@@ -413,14 +931,39 @@ class Cache:
     def get_full(self, pvname, add=False):
         " return full information for a cached pv"
         pvname = normalize_pvname(pvname)
-        self.get_pvnames()
+        shm = self.shm_reader()
+        if shm is not None:
+            row = shm.get_full(pvname)
+            if row is not None or not add:
+                return row
+        if pvname not in self.pvids:
+            self.refresh_registry()
         if add and self.pvconnect and pvname not in self.pvs:
             self.add_pv(pvname)
             self.log(f'adding PV: {pvname}', level='debug')
             time.sleep(0.01)
             return self.get_full(pvname, add=False)
-        return self.db.get_rows('cache', where={'pvname': pvname},
-                                none_if_empty=True, limit_one=True)
+        cid = self.pvids.get(pvname, None)
+        if cid is None:
+            return None
+        rows = self.get_rows_by_id([cid])
+        return rows[0] if len(rows) > 0 else None
+
+    def get_full_many(self, pvnames):
+        """return full information for a list of cached pvs, as a dict
+        of {pvname: row} for the names given, with one query for all"""
+        names = {normalize_pvname(p): p for p in pvnames}
+        shm = self.shm_reader()
+        if shm is not None:
+            rows = shm.get_full_many(list(names.keys())).values()
+        else:
+            if any(p not in self.pvids for p in names):
+                self.refresh_registry()
+            ids = [self.pvids[p] for p in names if p in self.pvids]
+            rows = []
+            for i in range(0, len(ids), 1000):
+                rows.extend(self.get_rows_by_id(ids[i:i+1000]))
+        return {names[row.pvname]: row for row in rows if row.pvname in names}
 
     def get(self, pvname, add=False, use_char=True):
         " return cached value of pv"
@@ -431,39 +974,91 @@ class Cache:
         return getattr(ret, field)
 
     def update_cache(self):
-        # take new pvnames as of right now, and pop off the latest
-        # values for these pvs.
-        # Note: be careful to not set self.data = {}, which would
-        # blow away any changes that occur during this processing
+        # take the pending values as of right now, holding the lock
+        # only long enough to swap in an empty dict for new changes.
         #
-        # IMPORTANT NOTE: the data size might change during processing!
-        newpvs = list(self.data.keys())
-        if len(newpvs) == 0:
+        # Rows are written keyed by cache id as set-based updates of
+        # at most `cache_batch_size` rows per statement, which (unlike
+        # upserts) never re-create rows of PVs dropped meanwhile.  PVs
+        # without a known cache id fall back to an update by pvname.
+        with self.data_cond:
+            pending, self.data = self.data, {}
+        if len(pending) == 0:
             return 0
-        newdata = {}
-        for pvname in newpvs:
-            val, cval, tstamp = self.data.pop(pvname)
+        t0 = time.monotonic()
+        rows, newdata, arrivals, values = [], {}, [], {}
+        for pvname, (val, cval, tstamp, tarrive) in pending.items():
+            arrivals.append(tarrive)
+            if pvname in self.alert_engine:
+                values[pvname] = val
             if isinstance(val, np.ndarray):
                 val = val.tolist()
-            if self.pvtypes.get(pvname, '') == 'double':
+            dtype = self.pvtypes.get(pvname, '')
+            if dtype == 'double':
                 cval = hformat(val)
-            newdata[pvname] = {'ts': Decimal(tstamp),
-                               'value': clean_bytes(val),
-                               'cvalue': clean_bytes(cval)}
-
-        ctab = self.tables['cache']
-        # print("##### UPDATE CACHE ", len(newdata), time.ctime())
-        update_where = ctab.update().where
-        with Session(self.db.engine) as session, session.begin():
-            ex = session.execute
-            for pvname, dat in newdata.items():
-                ex(update_where(ctab.c.pvname==pvname).values(**dat))
-            session.flush()
-        return len(newdata)
+            dat = {'ts': Decimal(tstamp),
+                   'value': clean_bytes(val),
+                   'cvalue': clean_bytes(cval)}
+            cid = self.pvids.get(pvname, None)
+            if cid is None:
+                newdata[pvname] = dat
+            else:
+                dat.update({'id': cid, 'pvname': pvname, 'type': dtype})
+                rows.append(dat)
+
+        # sequence numbers are assigned in commit order: all rows
+        # updated by id are committed together, before any fallback updates.
+        for dat in rows:
+            self.seq += 1
+            dat['seq'] = self.seq
+        for dat in newdata.values():
+            self.seq += 1
+            dat['seq'] = self.seq
+
+        nbatch = self.db.update_many('cache', rows, ('value', 'cvalue', 'ts', 'seq'),
+                                     key='id', chunksize=self.batch_size)
+        if self.shm_writer is not None:
+            self.shm_writer.write(rows)
+
+        if len(newdata) > 0:
+            ctab = self.tables['cache']
+            update_where = ctab.update().where
+            with Session(self.db.engine) as session, session.begin():
+                ex = session.execute
+                for pvname, dat in newdata.items():
+                    ex(update_where(ctab.c.pvname==pvname).values(**dat))
+                session.flush()
+            if self.shm_writer is not None:
+                # publish these rows too: readers following sequence
+                # numbers in shared memory would otherwise skip them
+                self.shm_writer.register(self.db.execute(ctab.select().where(
+                    ctab.c.pvname.in_(list(newdata.keys())))).fetchall())
+
+        nrows = len(rows) + len(newdata)
+        tdone = time.monotonic()
+        dt = tdone - t0
+        latency = tdone - np.array(arrivals)
+        self.stats['flushes'] += 1
+        self.stats['max_flush_rows'] = max(nrows, self.stats['max_flush_rows'])
+        self.stats['latency'] += latency.sum()
+        self.stats['max_latency'] = max(latency.max(), self.stats['max_latency'])
+        self.stats['rows'] += nrows
+        self.stats['batches'] += nbatch
+        if len(newdata) > 0:
+            self.stats['batches'] += 1
+        self.stats['write_time'] += dt
+        self.stats['max_batch_time'] = max(dt, self.stats['max_batch_time'])
+        if len(values) > 0:
+            self.check_alerts(values)
+        return nrows
 
     def get_values(self, all=False, time_ago=60.0, time_order=False):
         """get recent values from cache
         """
+        shm = self.shm_reader()
+        if shm is not None:
+            return shm.get_values(all=all, time_ago=time_ago,
+                                  time_order=time_order)
         tab = self.tables['cache']
         query = tab.select()
         if not all:
@@ -480,12 +1075,8 @@ class Cache:
                  vdict.update(self.get_values_dict(time_ago=10)
                  time.sleep(1)
         """
-        out = {}
-        for row in self.get_values(all=all, time_ago=time_ago, time_order=False):
-            out[row.pvname] = {'id': row.id, 'value': row.value,
-                               'cvalue': row.cvalue, 'dtype': row.type,
-                               'ts': float(row.ts)}
-        return out
+        return values_dict(self.get_values(all=all, time_ago=time_ago,
+                                           time_order=False))
 
     def add_pv(self, pvlist, with_motor_fields=True):
         """ add a PV or list of PVs to the cache"""
@@ -493,73 +1084,82 @@ class Cache:
             pvlist = [pvlist]
 
         pvlist = [normalize_pvname(pvname) for pvname in pvlist]
-        current_pvnames = self.get_pvnames()
+        current_pvnames = self.get_pvnames(force=True)
         for pvname in pvlist:
             if pvname not in self.pvs:
-                self.pvs[pvname] = get_pv(pvname)
+                self.create_pv(pvname)
 
+        # wait for all PVs to connect at once
+        self.wait_for_connections([self.pvs[pvname] for pvname in pvlist])
         pvs_to_add = []
         for pvname in pvlist:
             thispv = self.pvs[pvname]
-            if not thispv.connected:
-                time.sleep(0.01)
-                for i in range(20):
-                    if not thispv.connected:
-                        time.sleep(0.01 + i/100.0)
             if (thispv.connected and pvname not in current_pvnames and
-                pvname not in pvs_to_add):
+                thispv not in pvs_to_add):
                 pvs_to_add.append(thispv)
-        time.sleep(0.01)
-        def make_insertfields(pv):
+
+        def get_dtype(pv):
             dtype = pv.type
             dtype = dtype.replace('ctrl_', '').replace('time_', '')
             dtype = dtype.replace('short', 'int').replace('long', 'int')
-            dtype = dtype.replace('float', 'double')
+            return dtype.replace('float', 'double')
+
+        def make_insertfields(pv):
             out = {'pvname': pv.pvname,
                     'value': pv.value,
                     'cvalue': pv.char_value,
                     'active': 'yes',
-                    'type': dtype,
-                    'ts': Decimal(time.time())}
+                    'type': get_dtype(pv),
+                    'ts': Decimal(time.time()),
+                    'regseq': generation}
             # if dtype == 'enum':
             #     out['enum_strs'] = pv.enum_strs
             return out
 
+        # probe .DESC and .RTYP fields for all new PVs at once
+        desc_pvs, rtyp_pvs = {}, {}
+        for pv in pvs_to_add:
+            if pv.pvname.endswith('.VAL'):
+                prefix = pv.pvname[:-4]
+                desc_pvs[pv.pvname] = get_pv(f"{prefix}.DESC")
+                if with_motor_fields and get_dtype(pv) == 'double':
+                    rtyp_pvs[pv.pvname] = get_pv(f"{prefix}.RTYP")
+        self.wait_for_connections(list(desc_pvs.values()) + list(rtyp_pvs.values()),
+                                  timeout=1.0)
+
+        # check if PVs are for motors, add motor fields
+        motor_pvs = {}
+        for pvname, rtype in rtyp_pvs.items():
+            if rtype.connected and 'motor' == rtype.get(timeout=1.0):
+                prefix = pvname[:-4]
+                m_names = [f"{prefix}{i}" for i in motor_fields]
+                m_names.extend([f"{prefix}.DESC"])
+                motor_pvs[pvname] = [get_pv(n) for n in m_names]
+        self.wait_for_connections([epv for m_pvs in motor_pvs.values() for epv in m_pvs],
+                                  timeout=1.0)
+
+        generation = self.registry.next_generation()
         idicts = []
         all_pairs = [[p.pvname for p in pvs_to_add]]
         for pv in pvs_to_add:
-            out = make_insertfields(pv)
-            idicts.append(out)
-            prefix = out['pvname']
-            if prefix.endswith('.VAL'):
-                dname = prefix.replace('.VAL', '.DESC')
-                dpv = get_pv(dname)
-                dpv.wait_for_connection(timeout=1)
-                if dpv.connected:
-                    self.pvs[dname] = dpv
-                    idicts.append(make_insertfields(dpv))
-                    all_pairs.append([prefix, dname])
-
-            # check if PV is for a motor, add motor fields
-            if (with_motor_fields and
-                prefix.endswith('.VAL') and
-                out['type'] == 'double'):
-                prefix = prefix[:-4]
-                rtype = get_pv(f"{prefix}.RTYP")
-                time.sleep(0.01)
-                if 'motor' == rtype.get():
-                    m_names = [f"{prefix}{i}" for i in motor_fields]
-                    m_names.extend([f"{prefix}.DESC"])
-                    m_pvs = [get_pv(n) for n in m_names]
-                    for epv in m_pvs:
-                        epv.wait_for_connection(timeout=1)
-                    for epv in m_pvs:
-                        if epv.connected and epv.pvname not in self.pvs:
-                            self.pvs[epv.pvname] = epv
-                            idicts.append(make_insertfields(epv))
-                    all_pairs.append(m_names)
+            idicts.append(make_insertfields(pv))
+            dpv = desc_pvs.get(pv.pvname, None)
+            if (dpv is not None and dpv.connected and dpv.pvname not in self.pvs):
+                self.pvs[dpv.pvname] = dpv
+                idicts.append(make_insertfields(dpv))
+                all_pairs.append([pv.pvname, dpv.pvname])
+
+            if pv.pvname in motor_pvs:
+                m_pvs = motor_pvs[pv.pvname]
+                for epv in m_pvs:
+                    if epv.connected and epv.pvname not in self.pvs:
+                        self.pvs[epv.pvname] = epv
+                        idicts.append(make_insertfields(epv))
+                all_pairs.append([epv.pvname for epv in m_pvs])
         print("PVs to ADD : ", len(idicts))
         self.db.insert_many('cache', idicts)
+        if len(idicts) > 0:
+            self.registry.set_generation(generation)
         for pairs in all_pairs:
             self.set_all_pairs(pairs, score=10)
         self.db.flush()
@@ -595,43 +1195,36 @@ class Cache:
         if pvname in self.pvs:
             thispv = self.pvs.pop(pvname)
             thispv.clear_callbacks()
-        if pvname in self.data:
-            self.data.pop(pvname)
+        with self.data_cond:
+            self.data.pop(pvname, None)
 
     def process_alerts(self):
-        "handling alerts"
-        for pvname, alert in self.alert_data.items():
-            now = time.time()
-            value = alert.get('last_value', None)
-            if alert['active'] == 'no' or value is None:
-                continue
-
-            # coerce values to strings or floats for comparisons
-            convert = str
-            if isinstance(value,(int, float)):
-                convert = float
-
-            value     = convert(value)
-            trippoint = convert(alert['trippoint'])
-            cmp       = OPS[alert['compare']]
-            was_ok    = 'ok' == alert['status']
-
-            # compute new alarm status: note form  'value.__ne__(trippoint)'
-            now_ok = not getattr(value, cmp)(trippoint)
-            status = 'ok' if now_ok else 'alarm'
-            self.db.update('alerts', where={'pvname': pvname}, status=status)
-            alert['status'] = status
-            if (was_ok and not now_ok and now > (alert['timeout'] + alert['last_notice'])):
-                self.send_alert_mail(alert, value)
-                self.log(f"Alert sent for PV={pvname}, Label={alert['name']}")
-                # an alter has been checked, so we can set 'last_value' to
-                # None so that the alert will not be checked until the value changes.
-                alert['last_notice'] = now
-            alert['last_value'] = None
+        "check all alerts against current PV values"
+        values = {}
+        for pvname in self.alert_engine.bypv:
+            pv = self.pvs.get(pvname, None)
+            if pv is not None and pv.connected and pv.value is not None:
+                values[pvname] = pv.value
+        self.check_alerts(values)
+
+    def check_alerts(self, values):
+        """check alerts for a dict of new {pvname: value}, writing
+        alert status only when it changes, and sending mail for
+        alerts going into alarm (at most once per alert timeout)"""
+        transitions, notices = self.alert_engine.evaluate(values)
+        for alert, value, status in transitions:
+            self.db.update('alerts', where=int(alert['id']), status=status)
+            if alert['pvname'] in self.alert_data:
+                self.alert_data[alert['pvname']]['status'] = status
+        for alert, value in notices:
+            self.send_alert_mail(alert, value)
+            self.log(f"Alert triggered for PV={alert['pvname']}, Label={alert['name']}")
 
     def send_alert_mail(self, alert, value):
         """ send an alert email from an alert dict holding
         the appropriate row of the alert table.
+
+        The message is queued for delivery by a background AlertMailer.
         """
         mail_to = alert['mailto']
         pvname = alert['pvname']
@@ -689,18 +1282,11 @@ class Cache:
         url = f"{conf.web_baseurl}{conf.web_url}/plot/1days/now"
         mlines.append(f"See {url}/{pvrow.pvname}")
 
-        mail_msg = MIMEText('\n'.join(mlines))
-        mail_msg["Subject"] = subject
-        mail_msg["From"] = conf.mail_from
-        mail_msg["To"] = mail_to
-
-        try:
-            with SMTP(conf.mail_server, 25) as mailserver:
-                mailserver.send_message(mail_msg)
-            self.log(f"send alert mail for '{pvname}' to: {mail_to}")
-        except:
-            self.log(f"Could not send alert mail for '{pvname}'.",
-                     level='warn')
+        if self.mailer is None:
+            self.mailer = AlertMailer(conf, log=self.log)
+        self.mailer.start()
+        if self.mailer.submit(mail_to, subject, '\n'.join(mlines)):
+            self.log(f"queued alert mail for '{pvname}' to: {mail_to}")
 
     def process_requests(self):
         " process requests for new PV's to be cached"
@@ -716,15 +1302,25 @@ class Cache:
                 if 'suspend' == action:
                     if pvname in self.pvs:
                         self.pvs[pvname].clear_callbacks()
-                        self.db.update('cache', where={'pvname': pvname}, active='no')
+                        generation = self.registry.next_generation()
+                        self.db.update('cache', where={'pvname': pvname},
+                                       active='no', regseq=generation)
+                        self.registry.set_generation(generation)
                         self.db.delete_rows('requests', where={'id': row.id})
                         msg = 'suspended'
                 elif 'drop' == action:
                     self.db.delete_rows('cache', where={'pvname': pvname})
+                    self.registry.set_generation(self.registry.next_generation(),
+                                                 dropped=True)
                     self.db.delete_rows('requests', where={'id': row.id})
                     if pvname in self.pvs:
                         self.pvs[pvname].clear_callbacks()
                         self.pvs.pop(pvname)
+                    cid = self.registry.remove(pvname)
+                    if cid is not None and self.shm_writer is not None:
+                        self.shm_writer.drop(cid)
+                    with self.data_cond:
+                        self.data.pop(pvname, None)
                     msg = 'dropped'
                 elif 'add' == action:
                     self.add_pv(pvname)
@@ -737,11 +1333,13 @@ class Cache:
                             val = pv.value
                             if isinstance(val, np.ndarray):
                                 val = val.tolist()
-                            self.db.insert('cache.', pvname=pvname, type=pv.type,
+                            generation = self.registry.next_generation()
+                            self.db.insert('cache', pvname=pvname, type=pv.type,
                                            ts=time.time(),
                                            value=clean_bytes(val),
                                            cvalue=clean_bytes(cval),
-                                           active='yes')
+                                           active='yes', regseq=generation)
+                            self.registry.set_generation(generation)
                             self.db.delete_rows('requests', where={'id': row.id})
                             msg = 'added'
                         else:
@@ -752,21 +1350,12 @@ class Cache:
         time.sleep(0.01)
 
     def read_alert_table(self):
+        rows = self.db.get_rows('alerts')
         self.alert_data = {}
-        for alert in self.db.get_rows('alerts'):
-            pvname = alert.pvname
-            if pvname not in self.alert_data:
-                self.alert_data[pvname] = row2dict(alert)
-            else:
-                self.alert_data[pvname].update(row2dict(alert))
-            if 'last_notice' not in self.alert_data[pvname]:
-                self.alert_data[pvname]['last_notice'] = 0
-            if self.alert_data[pvname].get('last_value', None) is None:
-                value = None
-                if pvname in self.pvs:
-                    value = self.pvs[pvname].value
-                self.alert_data[pvname]['last_value'] = value
-
+        for alert in rows:
+            self.alert_data[alert.pvname] = row2dict(alert)
+        self.alert_engine = AlertEngine([row2dict(a) for a in rows],
+                                        previous=self.alert_engine)
         return self.alert_data
 
     def get_alerts(self):
@@ -784,78 +1373,26 @@ class Cache:
 
     def get_related(self, pvname, limit=None):
         """get related PVs for the supplied pvname, a dictionary ordered by score"""
-
-        out = {}
-        if limit is None:
-            limit = 1.e99
-        a = self.db.get_rows('pairs', where={'pv1': pvname}, order_by='score')
-        b = self.db.get_rows('pairs', where={'pv2': pvname}, order_by='score')
-        for row in a + b:
-            other = row.pv1 if row.pv2 == pvname else row.pv2
-            out[other] = row.score
-        # sort by score descending
-        out = dict(sorted(out.items(), key=lambda i: -i[1]))
-
-        # maybe limit to top scores
-        if limit is not None and limit < len(out):
-            out = dict(list(out.items())[:limit])
-        return out
+        return self.pairs.related(normalize_pvname(pvname), limit=limit)
 
     def get_pair_score(self, pvname1, pvname2):
         "get pair score for 2 pvnames"
-        score = 0
-        nrows = 0
-        pvname1 = normalize_pvname(pvname1)
-        pvname2 = normalize_pvname(pvname2)
-        if pvname1 == pvname2:
-            return 0
-        pvname1, pvname2 = sorted([pvname1, pvname2])
-
-        # check reverse order, and then purge these
-        rows = self.db.get_rows('pairs', where={'pv1': pvname2, 'pv2': pvname1})
-        if len(rows) > 0:
-            for row in rows:
-                score = max(score, row.score)
-            self.db.delete_rows('pairs', where={'pv1': pvname2, 'pv2': pvname1})
-
-        # correct order
-        rows = self.db.get_rows('pairs', where={'pv1': pvname1, 'pv2': pvname2})
-        if len(rows) > 0:
-            for row in rows:
-                score = max(score, row.score)
-
-        score = min(MAX_PAIR_SCORE, score)
-        if score > 0:
-            if len(rows) > 1:
-                self.db.delete_rows('pairs', where={'pv1': pvname1, 'pv2': pvname2})
-                self.db.insert('pairs', pv1=pvname1, pv2=pvname2, score=score)
-            else:
-                self.db.update('pairs', where={'pv1': pvname1, 'pv2': pvname2},
-                               score=score)
-        return score
+        return self.pairs.get_score(*get_pvpair(pvname1, pvname2))
 
     def set_pair_score(self, pvname1, pvname2, score=None, increment=1):
-        "set pair score for 2 pvnames"
-        pvname1 = normalize_pvname(pvname1)
-        pvname2 = normalize_pvname(pvname2)
+        """set pair score for 2 pvnames.  With score=None, the score is
+        increased by increment.  Scores are written to the database
+        by a background thread."""
+        pvname1, pvname2 = get_pvpair(pvname1, pvname2)
         if pvname1 == pvname2:
             self.log(f"Cannot set pair score for PV with itself '{pvname1}'",
                      level='warn')
-        #if pvname1 not in self.pvs or pvname2 not in self.pvs:
-        #    self.log(f"Cannot set pair score for unknown PVS '{pvname1}' and '{pvname2}",
-        #             level='warn')
-
-        pvname1, pvname2 = sorted([pvname1, pvname2])
-        current_score = self.get_pair_score(pvname1, pvname2)
+            return
         if score is None:
-            score = increment + current_score
-
-        score = min(MAX_PAIR_SCORE, score)
-        if current_score > 0:
-            self.db.update('pairs', where={'pv1': pvname1, 'pv2': pvname2},
-                           score=score)
+            self.pairs.update(pvname1, pvname2, increment=increment)
         else:
-            self.db.insert('pairs', pv1=pvname1, pv2=pvname2, score=score)
+            current = self.pairs.get_score(pvname1, pvname2)
+            self.pairs.update(pvname1, pvname2, increment=score-current)
 
     def increment_pair_score(self, pv1, pv2, increment=1):
         """increase by the pair score for two pvs """
@@ -864,17 +1401,8 @@ class Cache:
     def set_all_pairs(self, pvlist, score=10):
         """for a list/tuple of pvs, set all pair scores
         to be at least the provided score"""
-        _pvlist = [normalize_pvname(p) for p in pvlist]
-        scores = []
+        _pvlist = sorted(set(normalize_pvname(p) for p in pvlist))
         for i, pvname1 in enumerate(_pvlist):
             for pvname2 in _pvlist[i+1:]:
-                p1, p2 = sorted([pvname1, pvname2])
-                if p1 == p2:
-                    continue
-                current_score = self.get_pair_score(p1, p2)
-                if current_score > 1:
-                    self.db.delete_rows('pairs', where={'pv1': p1, 'pv2': p2})
-                score = max(current_score, score)
-                scores.append({'pv1': p1, 'pv2': p2, 'score': score})
-
-        self.db.insert_many('pairs', scores)
+                self.pairs.update(pvname1, pvname2, minscore=score)
+        self.pairs.flush()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Ring buffers for lossless capture of every monitor update of a PV.
+
+PVs in 'capture' mode keep all updates (timestamp, value) between
+drains of the buffer, instead of only the latest value.  Buffers are
+preallocated and of fixed size: when full, the oldest update is
+overwritten and counted as an overflow.
+"""
+import numpy as np
+
+
+class RingBuffer:
+    """fixed-size buffer of (timestamp, value) pairs
+
+    Arguments
+    ----------
+    size    number of updates held between drains
+    """
+    def __init__(self, size=4096):
+        self.size = max(2, int(size))
+        self.ts = np.zeros(self.size, dtype=np.float64)
+        self.values = np.zeros(self.size, dtype=np.float64)
+        self.head = 0
+        self.count = 0
+        self.overflows = 0
+        self.total_overflows = 0
+        self.total = 0
+
+    def append(self, ts, value):
+        "add an update, returns False if value is not numeric"
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return False
+        self.ts[self.head] = ts
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.size
+        if self.count == self.size:
+            self.overflows += 1
+            self.total_overflows += 1
+        else:
+            self.count += 1
+        self.total += 1
+        return True
+
+    def drain(self):
+        """return (ts, values, overflows) for all updates since the last
+        drain, in time order, and empty the buffer"""
+        idx = (np.arange(self.count) + self.head - self.count) % self.size
+        out = (self.ts[idx], self.values[idx], self.overflows)
+        self.count = 0
+        self.overflows = 0
+        return out
+
+    def __len__(self):
+        return self.count
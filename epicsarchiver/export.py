@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+"""
+Export of archive databases to zarr files.
+
+Each data table is read once, ordered by (pv_id, time), in a pool of
+worker processes.  Rows are converted to arrays in bulk and split by PV,
+and the arrays for each table are sent back to the one process writing
+the zarr file.
+
+Values are first written to a sidecar store (see ZarrSidecar), with the
+time up to which each PV has been exported, so that an interrupted export
+continues where it stopped, and so that the current archive database can
+be exported as it grows, reading only values newer than the last export.
+"""
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import zarr
+from sqlalchemy import select, func
+from epics.utils import str2bytes
+
+from .util import DatabaseConnection
+from .zarrstore import (open_sidecar, write_series, append_series, write_arrays,
+                        sort_series, CHUNK_SIZE, LEVELS)
+from . import schema
+
+FETCH_SIZE = 50000
+
+
+def split_by_pv(pvids, times, values, kind):
+    """list of (pv_id, times, values) for arrays of rows sorted by pv_id,
+    with values converted for each PV: floats for typed tables (ints for
+    int tables with no NULL values), and for string tables floats if all
+    values of the PV are numbers, else bytes"""
+    out = []
+    if len(pvids) == 0:
+        return out
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(pvids)) + 1))
+    ends = np.append(starts[1:], len(pvids))
+    for i0, i1 in zip(starts, ends):
+        vals = values[i0:i1]
+        if kind == 'int' and not np.isnan(vals).any():
+            vals = vals.astype(np.int64)
+        elif kind == 'string':
+            try:
+                vals = np.array(vals.tolist(), dtype=np.float64)
+            except (TypeError, ValueError):
+                vals = np.array([str2bytes(val) for val in vals.tolist()])
+        out.append((int(pvids[i0]), times[i0:i1], vals))
+    return out
+
+def pv_attrs(pvrow):
+    "attributes of a zarr group for a PV, from its row of the pv table"
+    try:
+        graph_hi = float(pvrow.graph_hi)
+    except (TypeError, ValueError):
+        graph_hi = ''
+    try:
+        graph_lo = float(pvrow.graph_lo)
+    except (TypeError, ValueError):
+        graph_lo = ''
+    return {'description': pvrow.description,
+            'type': pvrow.type,
+            'deadtime': float(pvrow.deadtime),
+            'deadband': float(pvrow.deadband),
+            'graph_hi': graph_hi,
+            'graph_lo': graph_lo,
+            'graph_type': pvrow.graph_type}
+
+def read_table(dbname, config, tabname, tmin=None, tmax=None, pvids=None,
+               fetch_size=FETCH_SIZE):
+    """read a data table in one pass, ordered by (pv_id, time), optionally
+    only for tmin < time <= tmax and for a list of pv_ids.
+    returns (tabname, number of rows, list of (pv_id, times, values))"""
+    db = DatabaseConnection(dbname, config)
+    dtab = db.tables[tabname]
+    kind = schema.data_table_kind(tabname)
+    query = select(dtab.c.pv_id, dtab.c.time, dtab.c.value)
+    if tmin is not None:
+        query = query.where(dtab.c.time > tmin)
+    if tmax is not None:
+        query = query.where(dtab.c.time <= tmax)
+    if pvids is not None:
+        query = query.where(dtab.c.pv_id.in_(pvids))
+    query = query.order_by(dtab.c.pv_id, dtab.c.time)
+    pvids, times, values = [], [], []
+    with db.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True).execute(query)
+        for rows in result.partitions(fetch_size):
+            if kind != 'string':
+                dat = np.array(rows, dtype=np.float64).reshape(-1, 3)
+                pvids.append(dat[:, 0].astype(np.int64))
+                times.append(dat[:, 1])
+                values.append(dat[:, 2])
+            else:
+                pvids.append(np.fromiter((row[0] for row in rows), dtype=np.int64,
+                                         count=len(rows)))
+                times.append(np.fromiter((row[1] for row in rows), dtype=np.float64,
+                                         count=len(rows)))
+                vals = np.empty(len(rows), dtype=object)
+                vals[:] = [row[2] for row in rows]
+                values.append(vals)
+    if len(pvids) == 0:
+        return tabname, 0, []
+    pvids, times = np.concatenate(pvids), np.concatenate(times)
+    values = np.concatenate(values)
+    return tabname, len(pvids), split_by_pv(pvids, times, values, kind)
+
+def read_tables(dbname, config, tabnames, workers=1, ranges=None):
+    """iterate over results of read_table for data tables, as they are
+    read by a pool of worker processes (or in this process, for 1 worker),
+    with optional dict of {tabname: (tmin, tmax)}"""
+    if ranges is None:
+        ranges = {}
+    if workers <= 1:
+        for tabname in tabnames:
+            yield read_table(dbname, config, tabname, *ranges.get(tabname, (None, None)))
+        return
+    # keep up to 2 tables per worker read ahead of the writer
+    tabnames = list(tabnames)
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        pending = set()
+        while len(tabnames) > 0 or len(pending) > 0:
+            while len(tabnames) > 0 and len(pending) < 2*workers:
+                tabname = tabnames.pop(0)
+                pending.add(pool.submit(read_table, dbname, config, tabname,
+                                        *ranges.get(tabname, (None, None))))
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+def table_counts(db, tabname):
+    "dict of {pv_id: number of values} in a data table"
+    dtab = db.tables[tabname]
+    query = select(dtab.c.pv_id, func.count()).group_by(dtab.c.pv_id)
+    return {pvid: count for pvid, count in db.execute(query).fetchall()}
+
+class ExportProgress:
+    """throughput of an export, printed as tables are done
+
+    Arguments
+    ----------
+    ntables   number of tables to export
+    """
+    def __init__(self, ntables):
+        self.ntables = ntables
+        self.ndone = 0
+        self.nrows = 0
+        self.t0 = time.time()
+
+    def table_done(self, tabname, nrows, npvs):
+        self.ndone += 1
+        self.nrows += nrows
+        dt = max(1.e-3, time.time() - self.t0)
+        print(f"{tabname}: {nrows} rows, {npvs} PVs  [{self.ndone}/{self.ntables} tables, "
+              f"{self.nrows} rows in {dt:.1f} sec, {self.nrows/dt:.0f} rows/sec]",
+              flush=True)
+
+
+class ZarrSidecar:
+    """zarr store in an SQLite file for values of an archive database
+    exported so far.  Each PV group has 'ts', 'data' and 'tindex' arrays
+    (as in zarr files, but without levels), and the attribute 'exported_to',
+    the time up to which its values have been exported.  The values of
+    each data table are written in one transaction.
+
+    Arguments
+    ----------
+    fname       name of SQLite file
+    chunk_size  number of values per chunk [CHUNK_SIZE]
+    """
+    def __init__(self, fname, chunk_size=CHUNK_SIZE):
+        self.fname = fname
+        self.chunk_size = max(1, int(chunk_size))
+        self.store = open_sidecar(fname)
+        self.root = zarr.open_group(store=self.store, mode='a')
+        self.zpv = self.root.require_group('pvarch')
+
+    def checkpoints(self):
+        "dict of {pvname: exported_to} for exported PVs"
+        out = {}
+        for pvname, grp in self.zpv.groups():
+            tdone = grp.attrs.get('exported_to', None)
+            if tdone is not None:
+                out[pvname] = float(tdone)
+        return out
+
+    def npts(self, pvname):
+        "number of values exported for a PV"
+        if pvname not in self.zpv:
+            return 0
+        return self.zpv[pvname]['ts'].shape[0]
+
+    def write_table(self, pvrows, series, checkpoints, exported_to):
+        """append values for the PVs of one data table, and set their
+        checkpoints to exported_to
+
+        Arguments
+        ----------
+        pvrows       list of rows of the pv table for PVs in the data table
+        series       list of (pv_id, times, values) read from the data table
+        checkpoints  dict of {pvname: exported_to}, updated
+        exported_to  time up to which values have been read
+        """
+        byid = {pvid: (times, values) for pvid, times, values in series}
+        empty = (np.zeros(0), np.zeros(0))
+        self.store.db.execute('begin immediate')
+        try:
+            for pvrow in pvrows:
+                times, values = byid.get(pvrow.id, empty)
+                if pvrow.name not in self.zpv:
+                    grp = self.zpv.create_group(pvrow.name)
+                    grp.attrs.update(pv_attrs(pvrow))
+                    write_arrays(grp, np.zeros(0), np.zeros(0), chunk_size=self.chunk_size)
+                grp = self.zpv[pvrow.name]
+                append_series(grp, times, values, after=checkpoints.get(pvrow.name, None))
+                grp.attrs['exported_to'] = exported_to
+            self.store.db.execute('commit')
+        except:
+            self.store.db.execute('rollback')
+            raise
+        for pvrow in pvrows:
+            checkpoints[pvrow.name] = exported_to
+
+    def rewrite(self, pvrow, times, values, exported_to):
+        "write all values for a PV again"
+        self.store.db.execute('begin immediate')
+        try:
+            if pvrow.name in self.zpv:
+                del self.zpv[pvrow.name]
+            grp = self.zpv.create_group(pvrow.name)
+            grp.attrs.update(pv_attrs(pvrow))
+            write_arrays(grp, *sort_series(times, values), chunk_size=self.chunk_size)
+            grp.attrs['exported_to'] = exported_to
+            self.store.db.execute('commit')
+        except:
+            self.store.db.execute('rollback')
+            raise
+
+    def write_zip(self, fname, levels=LEVELS, codec='gzip'):
+        """write a zipped zarr file with all PVs, and their aggregated levels,
+        with a codec pipeline (see zarrcodecs.py)"""
+        store = zarr.ZipStore(fname, mode='w')
+        zroot = zarr.group(store=store)
+        zpv = zroot.create_group('pvarch')
+        for pvname, grp in self.zpv.groups():
+            attrs = dict(grp.attrs)
+            attrs.pop('exported_to', None)
+            write_series(zpv, pvname, grp['ts'][()], grp['data'][()], attrs=attrs,
+                         chunk_size=self.chunk_size, levels=levels, codec=codec)
+        store.close()
+
+    def close(self):
+        self.store.close()
+
+    def remove(self):
+        "close and delete the sidecar file"
+        self.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.fname + suffix):
+                os.unlink(self.fname + suffix)
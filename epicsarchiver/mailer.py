@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+"""
+Background delivery of alert mail.
+
+Messages are put on a bounded queue and sent from a worker thread over
+a single, reused SMTP connection, so that a slow or unreachable mail
+server does not hold up the cache process.  Mail to a recipient is sent
+at most once per `mail_digest_time` seconds: messages arriving in the
+meantime are held and then sent together as one digest.  Failed sends
+are retried with exponential backoff.
+"""
+import time
+import queue
+import logging
+import threading
+from smtplib import SMTP, SMTPException
+from email.mime.text import MIMEText
+
+
+class AlertMailer:
+    """send alert mail from a background thread
+
+    Arguments
+    ----------
+    config    Config, using mail_server, mail_port, mail_from, mail_queue_size,
+              mail_digest_time, mail_retries, mail_timeout
+    log       function to log messages [None, using logging.info]
+    """
+    def __init__(self, config, log=None):
+        self.config = config
+        self.server = config.mail_server
+        self.port = int(config.mail_port)
+        self.mail_from = config.mail_from
+        self.digest_time = float(config.mail_digest_time)
+        self.retries = int(config.mail_retries)
+        self.timeout = float(config.mail_timeout)
+        self.idle_time = 60.0
+        self.max_backoff = 600.0
+        self.log = log
+        if self.log is None:
+            self.log = lambda msg, level='info': logging.info(msg)
+        self.queue = queue.Queue(maxsize=int(config.mail_queue_size))
+        self.pending = {}   # recipient -> list of (subject, body, time submitted)
+        self.nheld = 0
+        self.last_sent = {}
+        self.retry_at = {}
+        self.attempts = {}
+        self.smtp = None
+        self.last_used = 0
+        self.running = False
+        self.thread = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'submitted': 0, 'sent': 0, 'mails': 0, 'digests': 0,
+                      'dropped': 0, 'failed': 0, 'retries': 0,
+                      'latency': 0.0, 'max_latency': 0.0, 'max_depth': 0}
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.running = True
+            self.thread = threading.Thread(target=self.run, daemon=True,
+                                           name='alert-mailer')
+            self.thread.start()
+
+    def stop(self, timeout=10.0):
+        "stop worker, trying to send all held messages first"
+        if self.thread is not None and self.thread.is_alive():
+            self.running = False
+            try:
+                self.queue.put(None, timeout=1.0)
+            except queue.Full:
+                pass
+            self.thread.join(timeout=timeout)
+        self.thread = None
+
+    def submit(self, mail_to, subject, body):
+        """queue a message for delivery, returns False if the queue is
+        full and the message was dropped"""
+        mail_to = mail_to.replace('\r','').replace('\n','').strip()
+        if mail_to in ('', None):
+            return False
+        try:
+            self.queue.put_nowait((mail_to, subject, body, time.time()))
+        except queue.Full:
+            self.stats['dropped'] += 1
+            self.log(f"alert mail queue full, dropping mail to {mail_to}",
+                     level='warn')
+            return False
+        self.stats['submitted'] += 1
+        self.stats['max_depth'] = max(self.stats['max_depth'], self.depth)
+        return True
+
+    @property
+    def depth(self):
+        "number of messages waiting to be sent"
+        return self.queue.qsize() + self.nheld
+
+    def report(self):
+        "summary of delivery statistics, for logging"
+        st = self.stats
+        lat = st['latency']/max(1, st['sent'])
+        return (f"alert mail: {st['submitted']} queued, {st['sent']} sent in "
+                f"{st['mails']} mails ({st['digests']} digests), depth {self.depth}"
+                f" (max {st['max_depth']}), {st['retries']} retries, "
+                f"{st['failed']} failed, {st['dropped']} dropped, latency "
+                f"mean {lat:.2f} sec, max {st['max_latency']:.2f} sec")
+
+    def run(self):
+        "worker thread loop"
+        done = False
+        while not done:
+            try:
+                item = self.queue.get(timeout=self.next_wait())
+            except queue.Empty:
+                item = False
+            while item is not False:
+                if item is None:
+                    done = True
+                else:
+                    mail_to, subject, body, tsub = item
+                    self.pending.setdefault(mail_to, []).append((subject, body, tsub))
+                    self.nheld += 1
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    item = False
+            self.deliver(flush=done)
+            if self.smtp is not None and time.time() > self.last_used + self.idle_time:
+                self.disconnect()
+        self.disconnect()
+
+    def next_wait(self):
+        "time to wait for new messages before the next delivery is due"
+        now = time.time()
+        wait = 1.0
+        for mail_to, msgs in self.pending.items():
+            if len(msgs) > 0:
+                wait = min(wait, self.due(mail_to) - now)
+        return max(0.01, wait)
+
+    def due(self, mail_to):
+        return max(self.last_sent.get(mail_to, 0) + self.digest_time,
+                   self.retry_at.get(mail_to, 0))
+
+    def deliver(self, flush=False):
+        "send held messages for all recipients that are due"
+        now = time.time()
+        for mail_to in list(self.pending.keys()):
+            msgs = self.pending[mail_to]
+            if len(msgs) == 0:
+                self.pending.pop(mail_to)
+                continue
+            if not flush and now < self.due(mail_to):
+                continue
+            if self.send(mail_to, msgs):
+                tnow = time.time()
+                self.pending.pop(mail_to)
+                self.nheld -= len(msgs)
+                self.last_sent[mail_to] = tnow
+                self.retry_at.pop(mail_to, None)
+                self.attempts.pop(mail_to, None)
+                latency = [tnow - tsub for _s, _b, tsub in msgs]
+                self.stats['sent'] += len(msgs)
+                self.stats['mails'] += 1
+                self.stats['latency'] += sum(latency)
+                self.stats['max_latency'] = max(self.stats['max_latency'], max(latency))
+                if len(msgs) > 1:
+                    self.stats['digests'] += 1
+            else:
+                ntries = self.attempts.get(mail_to, 0) + 1
+                if ntries > self.retries or flush:
+                    self.pending.pop(mail_to)
+                    self.nheld -= len(msgs)
+                    self.retry_at.pop(mail_to, None)
+                    self.attempts.pop(mail_to, None)
+                    self.stats['failed'] += len(msgs)
+                    self.log(f"giving up on {len(msgs)} alert mail(s) to {mail_to}",
+                             level='warn')
+                else:
+                    self.attempts[mail_to] = ntries
+                    self.retry_at[mail_to] = now + min(self.max_backoff, 2.0**ntries)
+                    self.stats['retries'] += 1
+
+    def compose(self, mail_to, msgs):
+        "build a single message or a digest of several messages"
+        if len(msgs) == 1:
+            subject, body, _tsub = msgs[0]
+        else:
+            subject = f"[Epics Alert] {len(msgs)} alerts"
+            parts = []
+            for subj, body, tsub in msgs:
+                tstr = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(tsub))
+                parts.append(f"{subj}  ({tstr})\n\n{body}")
+            body = f"\n\n{'-'*64}\n\n".join(parts)
+        mail_msg = MIMEText(body)
+        mail_msg["Subject"] = subject
+        mail_msg["From"] = self.mail_from
+        mail_msg["To"] = mail_to
+        return mail_msg
+
+    def connect(self):
+        if self.smtp is None:
+            self.smtp = SMTP(self.server, self.port, timeout=self.timeout)
+        return self.smtp
+
+    def disconnect(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (SMTPException, OSError):
+                pass
+            self.smtp = None
+
+    def send(self, mail_to, msgs):
+        """send messages to one recipient, reconnecting once if the
+        reused connection has gone away.  returns success"""
+        mail_msg = self.compose(mail_to, msgs)
+        for attempt in (0, 1):
+            try:
+                self.connect().send_message(mail_msg)
+                self.last_used = time.time()
+                self.log(f"sent alert mail ({len(msgs)} alerts) to: {mail_to}")
+                return True
+            except (SMTPException, OSError) as exc:
+                self.disconnect()
+                if attempt == 1:
+                    self.log(f"Could not send alert mail to {mail_to}: {exc}",
+                             level='warn')
+        return False
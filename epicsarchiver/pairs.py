@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""
+Related-PV graph: scores from the pairs table held in memory.
+
+Scores of pairs of PVs (increased each time PVs are plotted together)
+are kept as a weighted adjacency map, with the top-scoring neighbors of
+each PV computed only when its scores have changed.  Changes are kept
+as pending increments, and written to the pairs table in one
+transaction from a background thread, so that other processes writing
+the same table are not overwritten.  The thread (and a final write at
+exit) is started only by the first change, so that processes only
+reading scores do neither.
+"""
+import time
+import atexit
+import heapq
+import logging
+import threading
+
+from sqlalchemy import bindparam, select, or_
+from sqlalchemy.orm import Session
+
+MAX_PAIR_SCORE = 500000
+
+
+class PairGraph:
+    """pair scores for related PVs
+
+    Arguments
+    ----------
+    db              DatabaseConnection to cache database
+    topk            number of neighbors kept per PV [20]
+    flush_period    time (sec) between writes of changed scores [10]
+    reload_period   time (sec) between full reloads of the pairs table [900]
+    """
+    def __init__(self, db, topk=20, flush_period=10.0, reload_period=900.0):
+        self.db = db
+        self.topk = topk
+        self.flush_period = flush_period
+        self.reload_period = reload_period
+        self.lock = threading.RLock()
+        self.adj = {}        # pvname -> {other pvname: score}
+        self.top = {}        # pvname -> [(other, score)] for top-k neighbors
+        self.pending = {}    # (pv1, pv2) -> [increment, minimum score]
+        self.last_load = 0
+        self.loaded = False
+        self.thread = None
+        self.stats = {'flushes': 0, 'rows': 0, 'flush_time': 0.0}
+
+    def _set(self, pv1, pv2, score):
+        self.adj.setdefault(pv1, {})[pv2] = score
+        self.adj.setdefault(pv2, {})[pv1] = score
+        self.top.pop(pv1, None)
+        self.top.pop(pv2, None)
+
+    def load(self):
+        """read full pairs table, merging duplicate or reversed rows"""
+        tab = self.db.tables['pairs']
+        with Session(self.db.engine) as session:
+            rows = session.execute(select(tab.c.pv1, tab.c.pv2, tab.c.score)).all()
+        adj = {}
+        for pv1, pv2, score in rows:
+            if pv1 is None or pv2 is None or pv1 == pv2:
+                continue
+            score = min(MAX_PAIR_SCORE, score)
+            a = adj.setdefault(pv1, {})
+            b = adj.setdefault(pv2, {})
+            a[pv2] = b[pv1] = max(score, a.get(pv2, 0))
+        with self.lock:
+            self.adj = adj
+            self.top = {}
+            # re-apply changes not yet written
+            for (pv1, pv2), (incr, minscore) in self.pending.items():
+                score = self.adj.get(pv1, {}).get(pv2, 0) + incr
+                self._set(pv1, pv2, min(MAX_PAIR_SCORE, max(score, minscore)))
+            self.loaded = True
+            self.last_load = time.time()
+
+    def _check(self):
+        # processes writing scores reload from the flush thread
+        if not self.loaded or (self.thread is None and
+                               time.time() > self.last_load + self.reload_period):
+            self.load()
+
+    def start(self):
+        "start background thread for writing changes, also writing them at exit"
+        if self.thread is None:
+            atexit.register(self.flush)
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self.run, daemon=True,
+                                           name='pair-scores')
+            self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_period)
+            try:
+                self.flush()
+                if time.time() > self.last_load + self.reload_period:
+                    self.load()
+            except Exception as exc:
+                logging.warning(f"could not write pair scores: {exc}")
+
+    def get_score(self, pvname1, pvname2):
+        "score for a pair of PVs"
+        self._check()
+        return self.adj.get(pvname1, {}).get(pvname2, 0)
+
+    def update(self, pvname1, pvname2, increment=0, minscore=0):
+        """increase score for a pair of PVs by increment, and to be
+        at least minscore, to be written by the next flush()"""
+        if pvname1 == pvname2:
+            return
+        self._check()
+        pair = tuple(sorted((pvname1, pvname2)))
+        with self.lock:
+            score = self.adj.get(pair[0], {}).get(pair[1], 0) + increment
+            self._set(pair[0], pair[1], min(MAX_PAIR_SCORE, max(score, minscore)))
+            pend = self.pending.setdefault(pair, [0, 0])
+            pend[0] += increment
+            pend[1] = max(pend[1], minscore)
+        self.start()
+
+    def related(self, pvname, limit=None):
+        """PVs related to pvname, as dict ordered by score descending"""
+        self._check()
+        if limit is None or limit > self.topk:
+            with self.lock:
+                items = list(self.adj.get(pvname, {}).items())
+            items.sort(key=lambda i: -i[1])
+            return dict(items[:limit])
+        top = self.top.get(pvname, None)
+        if top is None:
+            with self.lock:
+                items = list(self.adj.get(pvname, {}).items())
+            top = heapq.nlargest(self.topk, items, key=lambda i: i[1])
+            self.top[pvname] = top
+        return dict(top[:limit])
+
+    def flush(self):
+        """write pending changes to the pairs table, in one transaction,
+        applying them to the scores currently in the table"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if len(pending) == 0:
+            return 0
+        t0 = time.time()
+        tab = self.db.tables['pairs']
+        pv1s = sorted({pair[0] for pair in pending})
+        try:
+            with Session(self.db.engine) as session, session.begin():
+                current = {}
+                for i in range(0, len(pv1s), 500):
+                    names = pv1s[i:i+500]
+                    query = select(tab.c.id, tab.c.pv1, tab.c.pv2, tab.c.score).where(
+                        or_(tab.c.pv1.in_(names), tab.c.pv2.in_(names)))
+                    for rid, pv1, pv2, score in session.execute(query):
+                        pair = tuple(sorted((pv1, pv2)))
+                        # keep the highest-scoring of any duplicate rows
+                        if pair in pending and score > current.get(pair, (0, -1))[1]:
+                            current[pair] = (rid, score)
+                updates, inserts = [], []
+                for pair, (incr, minscore) in pending.items():
+                    rid, score = current.get(pair, (None, 0))
+                    score = min(MAX_PAIR_SCORE, max(score + incr, minscore))
+                    if rid is None:
+                        inserts.append({'pv1': pair[0], 'pv2': pair[1], 'score': score})
+                    else:
+                        updates.append({'_id': rid, '_pv1': pair[0],
+                                        '_pv2': pair[1], '_score': score})
+                if len(updates) > 0:
+                    stmt = tab.update().where(tab.c.id==bindparam('_id'))
+                    stmt = stmt.values(pv1=bindparam('_pv1'), pv2=bindparam('_pv2'),
+                                       score=bindparam('_score'))
+                    session.execute(stmt, updates)
+                if len(inserts) > 0:
+                    session.execute(tab.insert(), inserts)
+        except Exception:
+            # keep changes for the next attempt
+            with self.lock:
+                for pair, (incr, minscore) in pending.items():
+                    pend = self.pending.setdefault(pair, [0, 0])
+                    pend[0] += incr
+                    pend[1] = max(pend[1], minscore)
+            raise
+        with self.lock:
+            for row in updates:
+                if (row['_pv1'], row['_pv2']) not in self.pending:
+                    self._set(row['_pv1'], row['_pv2'], row['_score'])
+            for row in inserts:
+                if (row['pv1'], row['pv2']) not in self.pending:
+                    self._set(row['pv1'], row['pv2'], row['score'])
+        self.stats['flushes'] += 1
+        self.stats['rows'] += len(pending)
+        self.stats['flush_time'] += time.time() - t0
+        return len(pending)
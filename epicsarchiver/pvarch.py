@@ -12,6 +12,7 @@ from tabulate import tabulate
 
 from . import Cache, Archiver, tformat, get_config
 from .schema import initial_sql, apache_config
+from .util import normalize_pvname
 
 HELP_MESSAGE = """pvarch: control EpicsArchiver processes
     pvarch -h              shows this message.
@@ -33,11 +34,20 @@ HELP_MESSAGE = """pvarch: control EpicsArchiver processes
     pvarch set_runinfo [n] set the run information for the most recent run [10]
     pvarch save [folder] [n]  save sql for cache and most recent data archives(s) [., 1]
     pvarch save_zarr [n]   save zarray zip file for recent, not-current data archives(s) [1]
+                           use '--workers N' to set the number of processes reading tables,
+                           and '--codec C' to set the zarr codec (gzip, shuffle, xor)
+    pvarch save_zarr live [period]  export new values of the current archive to its sidecar zarr store,
+                           repeating every period seconds if given
+    pvarch migrate [db]    convert data tables of an archive (current) to indexed / partitioned layout
+    pvarch rollup [check|rebuild] [db]  compare rollup tables of an archive (current) with its data, or rebuild them
 
     pvarch unconnected_pvs show unconnected PVs in cache
     pvarch add_pv          add a PV to the cache and archive
     pvarch add_pvfile      read a file of PVs to add to the Archiver
     pvarch drop_pv         remove a PV from cahce and archive
+    pvarch capture [pv [size]] archive every update of a PV (ring buffer of size) or show captured PVs
+    pvarch capture_off pv  stop archiving every update of a PV
+    pvarch compression [pv [policy [tolerance]]] set compression (none, deadband, swinging_door) or show PVs not using deadband
 
     pvarch sql_init [filename] write sql for initial setup of databases to file [pvarch_init.sql]
     pvarch web_init [filename] write apache config file and stub wsgi app [pvarch.conf/pvarch.wsgi]
@@ -94,6 +104,10 @@ def pvarch_main():
                         default=60, help='time for activity and status ')
     parser.add_argument('-n', '--nruns', dest='nruns', type=int,
                         default=0, help='number of runs for list and set_runinfo')
+    parser.add_argument('-w', '--workers', dest='workers', type=int,
+                        default=None, help='number of processes for save_zarr')
+    parser.add_argument('-c', '--codec', dest='codec', default=None,
+                        help='zarr codec for save_zarr: gzip, shuffle, or xor')
     parser.add_argument('options', nargs='*')
 
     args = parser.parse_args()
@@ -172,6 +186,7 @@ def pvarch_main():
     if 'status' == cmd:
         cache.show_status(cache_time=args.time_ago,
                           archive_time=args.time_ago)
+        archiver.show_spool_status()
 
     elif 'check' == cmd:
         print(cache.get_narchived(time_ago=args.time_ago))
@@ -271,6 +286,18 @@ def pvarch_main():
             subprocess.run(cmds, stdout=open(outfile, 'w'))
             subprocess.run(['gzip', '-f', outfile])
 
+    elif 'save_zarr' == cmd and len(args.options) > 0 and args.options[0] == 'live':
+        args.options.pop(0)
+        period = 0
+        if len(args.options) > 0:
+            period = float(args.options.pop(0))
+        while True:
+            dbname = cache.get_info(process='archive').db
+            archiver.save_zarr(dbname, live=True, workers=args.workers)
+            if period <= 0:
+                break
+            time.sleep(period)
+
     elif 'save_zarr' == cmd:
         nruns = 1
         if len(args.options) > 0:
@@ -288,12 +315,64 @@ def pvarch_main():
             for dbname in reversed(dbnames):
                 if dbname == archiver.dbname:
                     continue
-                archiver.save_zarr(dbname, install=True)
+                archiver.save_zarr(dbname, install=True, workers=args.workers,
+                                   codec=args.codec)
                 nsaved += 1
                 if nsaved >= nruns:
                     break
 
 
+    elif 'migrate' == cmd:
+        dbname = None
+        if len(args.options) > 0:
+            dbname = args.options.pop(0)
+        archiver.migrate_archive(dbname)
+
+    elif 'rollup' == cmd:
+        action = 'check'
+        if len(args.options) > 0 and args.options[0] in ('check', 'rebuild'):
+            action = args.options.pop(0)
+        dbname = None
+        if len(args.options) > 0:
+            dbname = args.options.pop(0)
+        archiver.check_rollups(dbname, rebuild=(action == 'rebuild'))
+
+    elif 'capture' == cmd:
+        if len(args.options) > 0:
+            pvname = args.options.pop(0)
+            size = None
+            if len(args.options) > 0:
+                size = int(args.options.pop(0))
+            cache.set_capture(pvname, size=size)
+        out = [['PV', 'buffer size', 'overflows']]
+        for pvname, conf in cache.get_capture_settings().items():
+            out.append([pvname, conf.get('size', ''), conf.get('overflows', 0)])
+        print(tabulate(out, headers='firstrow', tablefmt='simple_grid'))
+
+    elif 'capture_off' == cmd:
+        for pvname in args.options:
+            cache.clear_capture(pvname)
+
+    elif 'compression' == cmd:
+        if len(args.options) > 1:
+            pvname, policy = args.options[:2]
+            tol = None
+            if len(args.options) > 2:
+                tol = float(args.options[2])
+            archiver.set_compression(pvname, policy, tolerance=tol)
+        pvnames = [normalize_pvname(p) for p in args.options[:1]]
+        if len(pvnames) == 0:
+            pvnames = [name for name, info in archiver.pvinfo.items()
+                       if info.get('compression', 'deadband') != 'deadband']
+        out = [['PV', 'compression', 'tolerance', 'deadband', 'deadtime']]
+        for pvname in pvnames:
+            info = archiver.pvinfo.get(pvname, None)
+            if info is not None:
+                out.append([pvname, info.get('compression', 'deadband'),
+                            info.get('tolerance', None), info['deadband'],
+                            info['deadtime']])
+        print(tabulate(out, headers='firstrow', tablefmt='simple_grid'))
+
     elif 'list' == cmd:
         nruns = args.nruns
         if nruns == 0:
@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+"""
+Archive state of PVs held as arrays indexed by PV id, so that the
+archiver can decide which of a batch of changed values to save with a
+few vectorized comparisons.
+
+Values waiting out a deadtime ('limbo') and forced writes of unchanged
+values are scheduled with heaps keyed on their due time, holding at
+most one entry per PV.  As a PV's due time can only move later, an
+entry found to be early is pushed back with the current due time.
+
+Each PV has a compression policy, one of
+    none           archive every change (subject to the deadtime)
+    deadband       archive changes larger than the deadband (subject to the
+                   deadtime), the default
+    swinging_door  archive only the points needed for linear interpolation
+                   between archived points to be within `tolerance` of
+                   every value seen.  The deadtime is not used.
+For swinging_door, an archived point ends a segment only when a later
+value shows it is needed, so the newest segment is written with a delay.
+A value held for `max_hold` seconds with no later value is archived,
+and starts a new segment.
+"""
+import time
+import heapq
+import numpy as np
+
+from .util import get_force_update_time
+
+COMPRESSION = ('none', 'deadband', 'swinging_door')
+NONE, DEADBAND, SWINGING_DOOR = range(3)
+
+def as_float(val):
+    "float value or nan"
+    try:
+        return float(val)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class PVState:
+    """archive state for all PVs, as arrays indexed by pv id
+
+    Arguments
+    ----------
+    size    initial number of PV ids [1024], grown as needed
+
+    Attributes
+    ----------
+    last_ts     time of last archived value
+    last_val    last archived value, if numeric (else nan)
+    deadtime    minimum time (sec) between archived values
+    deadband    minimum change of numeric values to archive
+    force_at    time at which the current value will be archived if unchanged
+    numeric     whether deadband applies (PV type 'double')
+    active      whether PV is being archived
+    policy      compression policy (index into COMPRESSION)
+    tolerance   tolerance for swinging_door compression
+    door_t, door_v    start of current swinging_door segment
+    held_t, held_v    last value seen, which may be needed to end the segment
+    door_hi, door_lo  upper and lower slopes of the 'doors'
+
+    PVs not yet archived by this process get a first forced write at a
+    random time within `first_force` seconds [300].  Values held for
+    swinging_door are archived after `max_hold` seconds [60].
+    """
+    fields = (('last_ts', 0.0, np.float64), ('last_val', np.nan, np.float64),
+              ('deadtime', 0.0, np.float64), ('deadband', 0.0, np.float64),
+              ('force_at', np.inf, np.float64), ('numeric', False, bool),
+              ('active', False, bool), ('policy', DEADBAND, np.int8),
+              ('tolerance', 0.0, np.float64),
+              ('door_t', 0.0, np.float64), ('door_v', np.nan, np.float64),
+              ('held_t', 0.0, np.float64), ('held_v', np.nan, np.float64),
+              ('door_hi', np.inf, np.float64), ('door_lo', -np.inf, np.float64))
+
+    def __init__(self, size=1024, first_force=300.0, max_hold=60.0):
+        self.size = 0
+        self.first_force = first_force
+        self.max_hold = max_hold
+        self.limbo_heap = []
+        self.limbo_ids = set()
+        self.hold_heap = []
+        self.hold_ids = set()
+        self.force_heap = []
+        for attr, fill, dtype in self.fields:
+            setattr(self, attr, np.zeros(0, dtype=dtype))
+        self.resize(size)
+
+    def resize(self, size):
+        "grow arrays to hold at least `size` PV ids"
+        if size <= self.size:
+            return
+        nsize = max(size, 2*self.size)
+        for attr, fill, dtype in self.fields:
+            arr = np.full(nsize, fill, dtype=dtype)
+            arr[:self.size] = getattr(self, attr)
+            setattr(self, attr, arr)
+        self.size = nsize
+
+    def configure(self, pvid, deadtime, deadband, dtype, active,
+                  compression='deadband', tolerance=None):
+        """set archive settings for a PV from its row of the pv table.
+        A tolerance of None or 0 uses the deadband."""
+        self.resize(pvid+1)
+        self.deadtime[pvid] = as_float(deadtime)
+        self.deadband[pvid] = abs(as_float(deadband))
+        self.numeric[pvid] = dtype in ('double', 'float')
+        self.active[pvid] = active != 'no'
+        policy = COMPRESSION.index(compression) if compression in COMPRESSION else DEADBAND
+        if policy != self.policy[pvid]:
+            self.door_v[pvid] = np.nan
+        self.policy[pvid] = policy
+        tol = abs(as_float(tolerance))
+        self.tolerance[pvid] = tol if tol > 0 else self.deadband[pvid]
+        if np.isinf(self.force_at[pvid]):
+            self.force_at[pvid] = time.time() + self.first_force*np.random.random()
+            heapq.heappush(self.force_heap, (self.force_at[pvid], pvid))
+
+    def decide(self, ids, ts, values):
+        """decide which values in a batch of changes to archive
+
+        Arguments
+        ----------
+        ids      array of pv ids, each id at most once
+        ts       array of timestamps
+        values   array of float values (nan for non-numeric values)
+
+        Returns
+        -------
+        save     bool array, values to archive now
+        limbo    bool array, changed values inside the deadtime
+        held     bool array, for swinging_door: archive the value seen
+                 before this one for the PV
+        """
+        last_ts = self.last_ts[ids]
+        policy = self.policy[ids]
+        save = ts > last_ts + self.deadtime[ids]
+        # deadband applies only when both values are numbers: a value
+        # that cannot be compared is always saved
+        numeric = self.numeric[ids] & ~np.isnan(values)
+        check = save & numeric & (policy == DEADBAND)
+        last_val = self.last_val[ids]
+        check &= ~np.isnan(last_val)
+        save[check] = np.abs(values[check] - last_val[check]) > self.deadband[ids[check]]
+        limbo = ~save & (ts > last_ts + 0.001)
+
+        held = np.zeros(len(ids), dtype=bool)
+        door = numeric & (policy == SWINGING_DOOR)
+        if door.any():
+            idx = np.where(door)[0]
+            dsave, dheld = self.swinging_door(ids[idx], ts[idx], values[idx])
+            save[idx] = dsave
+            held[idx] = dheld
+            limbo[idx] = False
+        return save, limbo, held
+
+    def swinging_door(self, ids, ts, values):
+        """swinging door compression for a batch of numeric values,
+        returns arrays (save, held) as for decide()
+
+        A segment starts at an archived value.  The 'doors' are the range
+        of slopes from the start of the segment that pass within tolerance
+        of every value between the start and the held value.  A new value
+        can end the segment if its slope from the start is within the
+        doors.  Otherwise the held value is archived and starts the next
+        segment.
+        """
+        tol = self.tolerance[ids]
+        t0, v0 = self.door_t[ids], self.door_v[ids]
+        th, vh = self.held_t[ids], self.held_v[ids]
+        hi, lo = self.door_hi[ids], self.door_lo[ids]
+        # first value: start a segment
+        save = np.isnan(v0)
+        # values must be later than the held value
+        valid = ~save & (ts > np.maximum(t0, th))
+        hasheld = valid & ~np.isnan(vh)
+        # held value is now between the start and the new value
+        dth = np.where(hasheld, th - t0, 1.0)
+        hi = np.where(hasheld, np.minimum(hi, (vh + tol - v0)/dth), hi)
+        lo = np.where(hasheld, np.maximum(lo, (vh - tol - v0)/dth), lo)
+        slope = (values - v0)/np.where(valid, ts - t0, 1.0)
+        held = hasheld & ((slope > hi) | (slope < lo))
+
+        # start new segments at archived values (new or held)
+        t0 = np.where(save, ts, np.where(held, th, t0))
+        v0 = np.where(save, values, np.where(held, vh, v0))
+        reset = save | held
+        hi[reset] = np.inf
+        lo[reset] = -np.inf
+
+        upd = save | valid
+        uids = ids[upd]
+        self.door_t[uids] = t0[upd]
+        self.door_v[uids] = v0[upd]
+        self.door_hi[uids] = hi[upd]
+        self.door_lo[uids] = lo[upd]
+        self.held_t[uids] = ts[upd]
+        self.held_v[uids] = np.where(save, np.nan, values)[upd]
+        return save, held
+
+    def archived(self, ids, ts, values):
+        "record values as archived"
+        self.last_ts[ids] = ts
+        self.last_val[ids] = values
+        self.force_at[ids] = ts + np.array([get_force_update_time() for i in ids])
+
+    def add_limbo(self, ids):
+        "schedule release of PVs with values held in limbo"
+        for pvid in ids:
+            pvid = int(pvid)
+            if pvid not in self.limbo_ids:
+                self.limbo_ids.add(pvid)
+                due = self.last_ts[pvid] + self.deadtime[pvid]
+                heapq.heappush(self.limbo_heap, (due, pvid))
+
+    def due_limbo(self, tnow):
+        "list of ids of PVs whose deadtime has passed since being put in limbo"
+        out = []
+        heap = self.limbo_heap
+        while len(heap) > 0 and heap[0][0] < tnow:
+            _t, pvid = heapq.heappop(heap)
+            due = self.last_ts[pvid] + self.deadtime[pvid]
+            if due < tnow:
+                self.limbo_ids.discard(pvid)
+                out.append(pvid)
+            else:
+                heapq.heappush(heap, (due, pvid))
+        return out
+
+    def add_held(self, ids):
+        "schedule archiving of values held for swinging_door"
+        for pvid in ids:
+            pvid = int(pvid)
+            if pvid not in self.hold_ids:
+                self.hold_ids.add(pvid)
+                heapq.heappush(self.hold_heap, (self.held_t[pvid] + self.max_hold, pvid))
+
+    def due_held(self, tnow):
+        """list of ids of PVs whose held value has been held for max_hold,
+        each starting a new segment at its held value, which should be
+        archived"""
+        out = []
+        heap = self.hold_heap
+        while len(heap) > 0 and heap[0][0] < tnow:
+            _t, pvid = heapq.heappop(heap)
+            if np.isnan(self.held_v[pvid]) or self.policy[pvid] != SWINGING_DOOR:
+                self.hold_ids.discard(pvid)
+                continue
+            due = self.held_t[pvid] + self.max_hold
+            if due < tnow:
+                self.hold_ids.discard(pvid)
+                self.door_t[pvid] = self.held_t[pvid]
+                self.door_v[pvid] = self.held_v[pvid]
+                self.door_hi[pvid] = np.inf
+                self.door_lo[pvid] = -np.inf
+                self.held_v[pvid] = np.nan
+                out.append(pvid)
+            else:
+                heapq.heappush(heap, (due, pvid))
+        return out
+
+    def due_forced(self, tnow):
+        """list of ids of PVs due for a forced write, scheduling the
+        next forced write for each of these"""
+        out = []
+        heap = self.force_heap
+        while len(heap) > 0 and heap[0][0] < tnow:
+            tdue, pvid = heapq.heappop(heap)
+            if self.force_at[pvid] > tdue:
+                heapq.heappush(heap, (self.force_at[pvid], pvid))
+                continue
+            self.force_at[pvid] = tnow + get_force_update_time()
+            heapq.heappush(heap, (self.force_at[pvid], pvid))
+            out.append(pvid)
+        return out
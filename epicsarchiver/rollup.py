@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+Rollup tables of an archive database: values of numeric PVs aggregated
+over buckets of 1 minute ('rollup_1m') and 1 hour ('rollup_1h').
+
+Each row holds, for one PV and bucket (with start time 'tbucket'), the
+number of values 'n', their 'vmin', 'vmax' and 'vsum', and the first and
+last values with their times.  The archiver adds each batch of values it
+writes to the rollups in the same transaction, with upserts that combine
+the new values with those already in a bucket, so that batches can be
+written in any order.
+"""
+import numpy as np
+from sqlalchemy import select, delete, case, func, bindparam
+from sqlalchemy.orm import Session
+
+from .pvstate import as_float
+from .schema import ROLLUPS
+
+COLUMNS = ('n', 'vmin', 'vmax', 'vsum', 'vfirst', 'tfirst', 'vlast', 'tlast')
+
+
+def has_rollups(tables):
+    "whether an archive database, given its table names, has rollup tables"
+    return all(name in tables for name, width in ROLLUPS)
+
+def rollup_for(resolution):
+    "(table name, width) of coarsest rollup no coarser than resolution, or None"
+    out = None
+    for name, width in ROLLUPS:
+        if width <= resolution:
+            out = (name, width)
+    return out
+
+def numeric_records(rows):
+    """arrays (pv_ids, times, values) of the finite numeric values in rows
+    of {data_table: list of dicts with pv_id, time, value}"""
+    pvids, times, values = [], [], []
+    for trows in rows.values():
+        for row in trows:
+            val = as_float(row['value'])
+            if np.isfinite(val):
+                pvids.append(row['pv_id'])
+                times.append(row['time'])
+                values.append(val)
+    return (np.array(pvids, dtype=np.int64), np.array(times, dtype=np.float64),
+            np.array(values, dtype=np.float64))
+
+def aggregate_records(pvids, times, values, width):
+    """aggregate values of several PVs into buckets of width seconds,
+    returns list of dicts with pv_id, tbucket and COLUMNS"""
+    if len(pvids) == 0:
+        return []
+    bucket = np.floor(times/width)
+    order = np.lexsort((times, bucket, pvids))
+    pvids, times, values, bucket = pvids[order], times[order], values[order], bucket[order]
+    new = (np.diff(pvids) != 0) | (np.diff(bucket) != 0)
+    starts = np.concatenate(([0], np.where(new)[0] + 1))
+    ends = np.append(starts[1:], len(pvids)) - 1
+    cols = {'pv_id': pvids[starts].tolist(),
+            'tbucket': (bucket[starts]*width).tolist(),
+            'n': (ends - starts + 1).tolist(),
+            'vmin': np.minimum.reduceat(values, starts).tolist(),
+            'vmax': np.maximum.reduceat(values, starts).tolist(),
+            'vsum': np.add.reduceat(values, starts).tolist(),
+            'vfirst': values[starts].tolist(), 'tfirst': times[starts].tolist(),
+            'vlast': values[ends].tolist(), 'tlast': times[ends].tolist()}
+    keys = list(cols.keys())
+    return [dict(zip(keys, vals)) for vals in zip(*cols.values())]
+
+def upsert_stmt(tab, dialect):
+    """insert statement for a rollup table that adds to an existing bucket.
+    With MySQL, assignments are made in order, so the first and last
+    values are set before their times."""
+    if dialect in ('mysql', 'mariadb'):
+        from sqlalchemy.dialects.mysql import insert
+        stmt = insert(tab)
+        new = stmt.inserted
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        stmt = insert(tab)
+        new = stmt.excluded
+    else:
+        from sqlalchemy.dialects.postgresql import insert
+        stmt = insert(tab)
+        new = stmt.excluded
+    least, greatest = func.least, func.greatest
+    if dialect == 'sqlite':
+        least, greatest = func.min, func.max
+    cur = tab.c
+    updates = [('n', cur.n + new.n),
+               ('vmin', least(cur.vmin, new.vmin)),
+               ('vmax', greatest(cur.vmax, new.vmax)),
+               ('vsum', cur.vsum + new.vsum),
+               ('vfirst', case((new.tfirst < cur.tfirst, new.vfirst), else_=cur.vfirst)),
+               ('tfirst', least(cur.tfirst, new.tfirst)),
+               ('vlast', case((new.tlast >= cur.tlast, new.vlast), else_=cur.vlast)),
+               ('tlast', greatest(cur.tlast, new.tlast))]
+    if dialect in ('mysql', 'mariadb'):
+        return stmt.on_duplicate_key_update(updates)
+    return stmt.on_conflict_do_update(index_elements=['pv_id', 'tbucket'],
+                                      set_=dict(updates))
+
+def update_rollups(session, db, rows):
+    """add values of rows of {data_table: list of dicts with pv_id, time,
+    value} to the rollup tables of a DatabaseConnection, in a session.
+    returns number of rollup rows written"""
+    pvids, times, values = numeric_records(rows)
+    if len(pvids) == 0:
+        return 0
+    dialect = db.engine.dialect.name
+    nrows = 0
+    for name, width in ROLLUPS:
+        stmt = db.statement(('rollup_upsert', name),
+                            lambda: upsert_stmt(db.tables[name], dialect))
+        records = aggregate_records(pvids, times, values, width)
+        session.execute(stmt, records)
+        nrows += len(records)
+    return nrows
+
+def rollup_query(tab):
+    """query for buckets of a PV in a rollup table overlapping a time
+    range, with parameters _pvid, _tmin (less the bucket width) and _tmax"""
+    query = select(tab.c.tbucket, tab.c.n, tab.c.vmin, tab.c.vmax,
+                   tab.c.vsum, tab.c.vfirst, tab.c.vlast)
+    query = query.where(tab.c.pv_id==bindparam('_pvid'))
+    query = query.where(tab.c.tbucket>bindparam('_tmin'))
+    query = query.where(tab.c.tbucket<=bindparam('_tmax'))
+    return query.order_by(tab.c.tbucket)
+
+def rollup_stats(rows):
+    """(bucket start times, dict of arrays for zarrstore.STATS) for rows
+    from rollup_query"""
+    dat = np.array(rows, dtype=np.float64).reshape(-1, 7)
+    count = dat[:, 1]
+    return dat[:, 0], {'count': count, 'min': dat[:, 2], 'max': dat[:, 3],
+                       'mean': dat[:, 4]/np.maximum(count, 1),
+                       'first': dat[:, 5], 'last': dat[:, 6]}
+
+def compare_rollups(expected, found, rtol=1.e-9):
+    """pv_ids whose rollup rows (lists of dicts, as from aggregate_records)
+    differ between expected and found"""
+    exp = {(r['pv_id'], r['tbucket']): r for r in expected}
+    fnd = {(r['pv_id'], r['tbucket']): r for r in found}
+    bad = set()
+    for key in set(exp.keys()) ^ set(fnd.keys()):
+        bad.add(key[0])
+    for key in set(exp.keys()) & set(fnd.keys()):
+        a, b = exp[key], fnd[key]
+        if a['n'] != b['n']:
+            bad.add(key[0])
+            continue
+        for col in ('vmin', 'vmax', 'vsum', 'vfirst', 'vlast'):
+            if b[col] is None or not np.isclose(a[col], b[col], rtol=rtol):
+                bad.add(key[0])
+                break
+    return bad
+
+def copy_open_rollups(src, dst, tnow, chunk=5000):
+    """copy rollup rows of buckets not yet complete at time tnow from the
+    archive database src to dst (DatabaseConnections), with pv_ids of dst
+    matched by PV name, in one transaction.  returns number of rows"""
+    src_ids = {row.id: row.name for row in src.get_rows('pv')}
+    dst_ids = {row.name: row.id for row in dst.get_rows('pv')}
+    pvmap = {pvid: dst_ids[name] for pvid, name in src_ids.items() if name in dst_ids}
+    nrows = 0
+    with Session(dst.engine) as session, session.begin():
+        for name, width in ROLLUPS:
+            stab = src.tables[name]
+            tstart = np.floor(tnow/width)*width
+            rows = src.execute(stab.select().where(stab.c.tbucket >= tstart)).fetchall()
+            records = []
+            for row in rows:
+                if row.pv_id in pvmap:
+                    rec = row._asdict()
+                    rec['pv_id'] = pvmap[row.pv_id]
+                    records.append(rec)
+            for i in range(0, len(records), chunk):
+                session.execute(dst.tables[name].insert(), records[i:i+chunk])
+            nrows += len(records)
+    return nrows
+
+def delete_rollups(tab, pvids, keep=None):
+    """statement to delete rollup rows for a list of pv_ids, except
+    those for the bucket starting at time keep"""
+    stmt = delete(tab).where(tab.c.pv_id.in_(pvids))
+    if keep is not None:
+        stmt = stmt.where(tab.c.tbucket != keep)
+    return stmt
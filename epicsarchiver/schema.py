@@ -2,6 +2,19 @@
 """
 text values for creating epicsarchiver databases
 """
+import math
+import time
+from .util import clean_bytes
+
+# Archived values are held in data tables, 128 of each kind, with the
+# table for a PV chosen from a hash of its name.  Archive databases of
+# schema version 1 hold all values as strings in the 'pvdat' tables.
+# Since schema version 2, double values are held in 'pvdbl' tables and
+# int and enum values in 'pvint' tables, with only string values (and
+# arrays) in 'pvdat' tables.
+NDATA_TABLES = 128
+DATA_TABLE_KINDS = {'pvdat': 'string', 'pvdbl': 'double', 'pvint': 'int'}
+TYPED_PREFIX = {'double': 'pvdbl', 'int': 'pvint', 'enum': 'pvint'}
 
 pvdat_init_pv = """create table pv(
   id           int(10) unsigned not null auto_increment,
@@ -15,12 +28,46 @@ pvdat_init_pv = """create table pv(
   graph_type   enum('normal','log','discrete') default null,
   type         enum('int','double','string','enum') not null,
   active       enum('yes','no') default 'yes',
+  compression  enum('none','deadband','swinging_door') not null default 'deadband',
+  tolerance    double default null,
   primary key (id), unique key name (name),   key name_idx (name));
 """
 
-pvdat_init_dat = """create table pvdat{idat:03d} (time double not null,  pv_id int(10) unsigned not null,
-                                   value varchar(4096),  key pv_idx (pv_id));
+# data tables.  With a time index, values for a PV over a time range are
+# read with an index range scan on (pv_id, time), and the oldest / newest
+# values of a table are found from the index on time.  On MariaDB/MySQL,
+# tables can also be partitioned by ranges of days, using a stored 'tday'
+# column, so that queries on a time range read only the partitions needed.
+pvdat_init_dat = """create table {name:s} (time double not null,  pv_id int(10) unsigned not null,
+                                   value {value:s},{tday:s}  {keys:s}){partitions:s};
 """
+DATA_VALUE_SQL = {'pvdat': 'varchar(4096)', 'pvdbl': 'double default null',
+                  'pvint': 'bigint default null'}
+PV_INDEX = 'key pv_idx (pv_id)'
+TIME_INDEX = 'key pv_time_idx (pv_id, time), key time_idx (time)'
+TDAY_COLUMN = "\n                                   tday int as (floor(time/86400)) stored,"
+
+# migration of data tables ('pvarch migrate'): while a data table is copied,
+# values inserted to it are also written to a delta table by a trigger,
+# and copied to the new table once it has replaced the old one
+migrate_trigger = """create trigger {trigger:s} after insert on {table:s} for each row
+  begin insert into {delta:s} (pv_id, time, value) values (new.pv_id, new.time, new.value); end"""
+
+# rollup tables: values of numeric PVs aggregated over buckets of 1 minute
+# and 1 hour, updated by the archiver as it writes values
+ROLLUPS = (('rollup_1m', 60.0), ('rollup_1h', 3600.0))
+
+rollup_init = """create table {name:s} (pv_id int(10) unsigned not null,
+  tbucket double not null,  n int unsigned not null default '0',
+  vmin double default null, vmax double default null, vsum double default null,
+  vfirst double default null, tfirst double default null,
+  vlast double default null, tlast double default null,
+  primary key (pv_id, tbucket));
+"""
+
+def rollup_sql():
+    "list of sql commands to create the rollup tables of an archive database"
+    return [rollup_init.format(name=name) for name, width in ROLLUPS]
 
 create_cachedb = """
 create database {cache_db:s};
@@ -48,8 +95,12 @@ create table cache (
   cvalue    varchar(4096) default null,
   ts        double default null,
   active    enum('yes','no') not null default 'yes',
+  seq       bigint unsigned not null default '0',
+  regseq    bigint unsigned not null default '0',
   primary key (id),
-  key pvname_id (pvname)
+  key pvname_id (pvname),
+  key seq_idx (seq),
+  key regseq_idx (regseq)
   );
 
 create table info (
@@ -67,6 +118,7 @@ create table info (
 insert into info values (1,'cache',   'offline','','',0, 0);
 insert into info values (2,'archive', 'offline','','',0, 0);
 insert into info values (3,'version', 'unknown','1','',0, 0);
+insert into info values (4,'registry','unknown','','',0, 0);
 
 create table pairs (
   id        int(10) unsigned not null auto_increment,
@@ -104,6 +156,31 @@ create table runs (
   )  ;
 """
 
+# upgrade of cache table from earlier versions: each write to the
+# cache is given a sequence number, so that consumers can ask for
+# exactly the rows changed since their last cursor
+cache_add_seq = """alter table cache add column seq bigint unsigned not null default '0',
+                  add key seq_idx (seq);
+"""
+
+# upgrade of cache table from earlier versions: adding, dropping, or
+# suspending a PV sets a new registry generation, held as 'ts' of the
+# 'registry' row of the info table, with 'pid' the generation of the
+# last drop.  Rows added or changed are given that generation as
+# 'regseq', so that PV registries read only those rows.
+cache_add_regseq = """alter table cache add column regseq bigint unsigned not null default '0',
+                  add key regseq_idx (regseq);
+"""
+info_add_registry = """insert into info (process, status, db, datetime, ts, pid)
+                  values ('registry', 'unknown', '', '', 0, 0);
+"""
+
+# upgrade of pv table from earlier versions: per-PV compression policy
+pv_add_compression = """alter table pv
+    add column compression enum('none','deadband','swinging_door') not null default 'deadband',
+    add column tolerance double default null;
+"""
+
 apache_config = """# apache wsgi configuration
 # this should be added to your Apache configuration, as with
 #   IncludeOptional {server_root:}/conf.d/pvarch.conf
@@ -119,6 +196,94 @@ WSGIScriptAlias /{web_url:s}  {web_dir:s}/pvarch.wsgi
 """
 
 
+def partition_days(tmin, tmax, ndays):
+    """list of day numbers (days since 1970) for partitions of ndays days
+    each, covering times tmin to tmax"""
+    ndays = max(1, int(ndays))
+    day0 = ndays*int(math.floor(tmin/86400.0)/ndays)
+    day1 = int(math.floor(tmax/86400.0)) + 1
+    return list(range(day0+ndays, day1+ndays, ndays))[:1024]
+
+def data_table_create(tablename, time_index=True, partitions=None, name=None):
+    """sql to create a data table
+
+    Arguments
+    ----------
+    tablename    name of data table, setting the value type
+    time_index   whether to index on (pv_id, time) and time [True]
+    partitions   list of day numbers (from partition_days()) for partitions
+                 by time ranges, MariaDB and MySQL only [None, no partitions]
+    name         name of table to create [None, tablename]
+    """
+    if name is None:
+        name = tablename
+    tday, parts = '', ''
+    if partitions is not None and len(partitions) > 0:
+        tday = TDAY_COLUMN
+        parts = [f"partition d{day:d} values less than ({day:d})" for day in partitions]
+        parts.append("partition dmax values less than maxvalue")
+        parts = " partition by range (tday) (%s)" % (', '.join(parts))
+    return pvdat_init_dat.format(name=name, value=DATA_VALUE_SQL[tablename[:5]],
+                                 tday=tday, partitions=parts,
+                                 keys=TIME_INDEX if time_index else PV_INDEX)
+
+def data_table_options(config, tmin, tmax):
+    """options (time_index, partitions) for data_table_create from config,
+    for a database with values from tmin to tmax"""
+    ndays = int(config.archive_partition_days)
+    partitions = None
+    if ndays > 0 and config.server.startswith(('maria', 'mysql')):
+        partitions = partition_days(tmin, tmax, ndays)
+    return {'time_index': str(config.archive_time_index).lower() in ('yes', 'true', '1'),
+            'partitions': partitions}
+
+def data_table_sql(typed=True, time_index=True, partitions=None):
+    "list of sql commands to create the data tables of an archive database"
+    prefixes = ('pvdat', 'pvdbl', 'pvint') if typed else ('pvdat',)
+    sql = []
+    for idat in range(1, NDATA_TABLES+1):
+        for prefix in prefixes:
+            sql.append(data_table_create(f'{prefix}{idat:03d}', time_index=time_index,
+                                         partitions=partitions))
+    return sql
+
+def data_table_name(pvtype, idat, typed=True):
+    """name of data table number idat (1 to 128) for a PV type,
+    ('double', 'int', 'enum', 'string') for a typed (version 2) archive
+    database or for an earlier archive database"""
+    prefix = TYPED_PREFIX.get(pvtype, 'pvdat') if typed else 'pvdat'
+    return f'{prefix}{idat:03d}'
+
+def data_table_kind(tablename):
+    "kind of values in a data table: 'double', 'int', or 'string'"
+    return DATA_TABLE_KINDS.get(tablename[:5], 'string')
+
+def data_tables(tablenames):
+    "sorted list of data tables from the table names of an archive database"
+    return sorted(name for name in tablenames
+                  if name[:5] in DATA_TABLE_KINDS and name[5:].isdigit())
+
+def is_typed(tablenames):
+    "whether an archive database has typed data tables (schema version 2)"
+    return 'pvdbl001' in tablenames
+
+def data_value(tablename, val):
+    """value to insert into a data table: a float or int for typed
+    tables (None if not a finite number), or a string"""
+    kind = data_table_kind(tablename)
+    if kind == 'string':
+        return clean_bytes(val)
+    if isinstance(val, bytes):
+        val = val.decode('utf-8')
+    try:
+        val = float(val)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(val):
+        return None
+    return int(round(val)) if kind == 'int' else val
+
+
 def initial_sql(config):
     """creates sql to initialize master cache database and
     first archive database
@@ -128,8 +293,10 @@ def initial_sql(config):
            "update info set db='{db:s}' where process='archive';".format(db=dbname),
            "create database {db:s}; use {db:s};".format(db=dbname),
            pvdat_init_pv]
-
-    for idat in range(1, 129):
-        sql.append(pvdat_init_dat.format(idat=idat))
+    tnow = time.time()
+    sql.extend(data_table_sql(typed=True, **data_table_options(config, tnow,
+                                                               tnow+365*86400)))
+    if config.archive_rollups.lower().startswith('y'):
+        sql.extend(rollup_sql())
     sql.append('; ')
     return '\n'.join(sql)
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+"""
+Shared-memory store of current PV values.
+
+The cache process publishes each write to the cache table into a
+memory-mapped file of fixed-size slots, indexed by the cache `id`.
+Other processes on the same host (archiver, web app, command line)
+can then read current values without SQL or locks.
+
+Each slot is guarded by a write counter (a 'seqlock'): the writer makes
+the counter odd before changing a slot and even afterwards, and readers
+re-read any slot whose counter was odd or changed while being copied.
+
+Between the header and the slots, a ring of (seq, id) change records,
+in order of sequence number, lets readers find the slots changed since
+a cursor without scanning all slots.  A reader whose cursor is older
+than the oldest record in the ring gets None from changes_since(), and
+has to read changes from the cache table instead.
+"""
+import os
+import time
+import mmap
+from collections import namedtuple
+
+import numpy as np
+
+SHM_MAGIC = b'pvarch_shm'
+SHM_VERSION = 2
+HEADER_SIZE = 256
+RING_SIZE = 65536
+VALUE_LEN = 512
+MIN_SLOTS = 1024
+
+header_dtype = np.dtype([('magic', 'S16'), ('version', '<u4'),
+                         ('nslots', '<u4'), ('pid', '<u4'),
+                         ('gen', '<u4'), ('seq', '<u8'),
+                         ('heartbeat', '<f8'), ('ring_size', '<u4'),
+                         ('rpos', '<u8')])
+
+ring_dtype = np.dtype([('seq', '<u8'), ('id', '<u4'), ('pad', '<u4')])
+
+slot_dtype = np.dtype([('wseq', '<u8'), ('seq', '<u8'), ('ts', '<f8'),
+                       ('id', '<u4'), ('active', 'u1'), ('trunc', 'u1'),
+                       ('type', 'S8'), ('pvname', 'S128'),
+                       ('value', f'S{VALUE_LEN}'), ('cvalue', f'S{VALUE_LEN}')])
+
+# same fields, in the same order, as rows of the cache table
+CacheRow = namedtuple('CacheRow', ('id', 'pvname', 'type', 'value',
+                                   'cvalue', 'ts', 'active', 'seq'))
+
+def as_bytes(val):
+    if isinstance(val, bytes):
+        return val
+    if val is None:
+        return b''
+    return str(val).encode('utf-8')
+
+def as_str(val):
+    return val.decode('utf-8', errors='replace')
+
+
+class SharedCacheWriter:
+    """writer for shared-memory cache, used only by the cache process
+
+    Arguments
+    ----------
+    filename    name of file to map, normally on a tmpfs such as /dev/shm
+    nslots      initial number of slots [1024], grown as needed
+    ring_size   number of change records in the ring [65536]
+    """
+    def __init__(self, filename, nslots=MIN_SLOTS, ring_size=RING_SIZE):
+        self.filename = filename
+        self.nslots = 0
+        self.ring_size = max(16, int(ring_size))
+        self.mm = self.fh = self.header = self.ring = self.slots = None
+
+        # create a new file and move it into place, so that
+        # readers of a previous file will see a new inode.
+        tmpname = f'{filename}.{os.getpid()}'
+        self.fh = open(tmpname, 'w+b')
+        self._map(max(MIN_SLOTS, nslots))
+        hdr = self.header
+        hdr['magic'] = SHM_MAGIC
+        hdr['version'] = SHM_VERSION
+        hdr['pid'] = os.getpid()
+        hdr['heartbeat'] = time.time()
+        hdr['ring_size'] = self.ring_size
+        os.replace(tmpname, filename)
+
+    def _map(self, nslots):
+        "(re)map file with nslots slots"
+        self.header = self.ring = self.slots = None
+        if self.mm is not None:
+            self.mm.flush()
+            self.mm.close()
+        offset = HEADER_SIZE + self.ring_size*ring_dtype.itemsize
+        self.fh.truncate(offset + nslots*slot_dtype.itemsize)
+        self.mm = mmap.mmap(self.fh.fileno(), 0)
+        self.header = np.frombuffer(self.mm, dtype=header_dtype, count=1)
+        self.ring = np.frombuffer(self.mm, dtype=ring_dtype, count=self.ring_size,
+                                  offset=HEADER_SIZE)
+        self.slots = np.frombuffer(self.mm, dtype=slot_dtype, count=nslots,
+                                   offset=offset)
+        self.nslots = nslots
+        self.header['nslots'] = nslots
+
+    def ensure_slots(self, maxid):
+        "make sure there is a slot for id=maxid"
+        if maxid >= self.nslots:
+            nslots = self.nslots
+            while nslots <= maxid:
+                nslots *= 2
+            self._map(nslots)
+
+    def register(self, rows):
+        """publish full rows of the cache table, including pvname,
+        type and active status.  Used at startup and for new PVs."""
+        if len(rows) == 0:
+            return
+        ids = np.array([row.id for row in rows], dtype='<u4')
+        self.ensure_slots(ids.max())
+        s = self.slots
+        s['wseq'][ids] += 1
+        s['id'][ids] = ids
+        s['pvname'][ids] = [as_bytes(row.pvname) for row in rows]
+        s['type'][ids] = [as_bytes(row.type) for row in rows]
+        s['active'][ids] = [row.active != 'no' for row in rows]
+        s['seq'][ids] = [getattr(row, 'seq', 0) for row in rows]
+        s['ts'][ids] = [float(row.ts or 0) for row in rows]
+        self._set_values(ids, [row.value for row in rows],
+                         [row.cvalue for row in rows])
+        s['wseq'][ids] += 1
+        self.header['gen'] += 1
+        seqs = s['seq'][ids]
+        new = seqs > self.header['seq'][0]
+        self._add_changes(seqs[new], ids[new])
+        self.header['seq'] = max(int(self.header['seq'][0]), int(s['seq'].max()))
+
+    def _add_changes(self, seqs, ids):
+        """add change records to the ring, in order of sequence number,
+        before the header seq is updated"""
+        if len(seqs) == 0:
+            return
+        order = seqs.argsort(kind='stable')
+        # records beyond the size of the ring are counted but not kept
+        rpos = int(self.header['rpos'][0]) + len(seqs)
+        seqs, ids = seqs[order][-self.ring_size:], ids[order][-self.ring_size:]
+        pos = (rpos - len(seqs) + np.arange(len(seqs))) % self.ring_size
+        self.ring['seq'][pos] = seqs
+        self.ring['id'][pos] = ids
+        self.header['rpos'] = rpos
+
+    def _set_values(self, ids, values, cvalues):
+        values = [as_bytes(v) for v in values]
+        cvalues = [as_bytes(v) for v in cvalues]
+        s = self.slots
+        s['value'][ids] = values
+        s['cvalue'][ids] = cvalues
+        s['trunc'][ids] = [(len(v) > VALUE_LEN or len(c) > VALUE_LEN)
+                           for v, c in zip(values, cvalues)]
+
+    def write(self, rows):
+        """publish new values, from a list of dicts with keys
+        'id', 'seq', 'ts', 'value', 'cvalue'"""
+        if len(rows) == 0:
+            return
+        ids = np.array([row['id'] for row in rows], dtype='<u4')
+        self.ensure_slots(ids.max())
+        s = self.slots
+        s['wseq'][ids] += 1
+        s['seq'][ids] = [row['seq'] for row in rows]
+        s['ts'][ids] = [float(row['ts']) for row in rows]
+        self._set_values(ids, [row['value'] for row in rows],
+                         [row['cvalue'] for row in rows])
+        s['wseq'][ids] += 1
+        self._add_changes(np.array([row['seq'] for row in rows], dtype='<u8'), ids)
+        self.header['seq'] = max(int(self.header['seq'][0]),
+                                 int(s['seq'][ids].max()))
+
+    def drop(self, cache_id):
+        "remove a PV (by cache id) from the store"
+        if cache_id < self.nslots:
+            s = self.slots
+            s['wseq'][cache_id] += 1
+            s['id'][cache_id] = 0
+            s['active'][cache_id] = 0
+            s['wseq'][cache_id] += 1
+            self.header['gen'] += 1
+
+    def heartbeat(self):
+        self.header['heartbeat'] = time.time()
+
+    def close(self):
+        "mark the store as stale and unmap it"
+        if self.mm is None:
+            return
+        self.header['heartbeat'] = 0
+        self.header = self.ring = self.slots = None
+        self.mm.flush()
+        self.mm.close()
+        self.fh.close()
+        self.mm = self.fh = None
+
+
+class SharedCacheReader:
+    """lock-free reader for shared-memory cache
+
+    Arguments
+    ----------
+    filename   name of mapped file written by SharedCacheWriter
+    max_age    time (sec) after last heartbeat to consider store stale [30]
+    fetch      function taking a list of cache ids and returning rows
+               of the cache table, used for values too long for a slot [None]
+
+    Notes
+    -----
+    methods mirror those of Cache, returning CacheRow tuples with the
+    same fields as rows of the cache table.
+    """
+    def __init__(self, filename, max_age=30.0, fetch=None):
+        self.filename = filename
+        self.max_age = max_age
+        self.fetch = fetch
+        self.mm = None
+        self._open()
+
+    @classmethod
+    def open(cls, filename, **kws):
+        "return reader, or None if no valid store exists"
+        if filename in (None, '') or not os.path.exists(filename):
+            return None
+        try:
+            return cls(filename, **kws)
+        except (OSError, ValueError):
+            return None
+
+    def _open(self):
+        self.header = self.ring = self.slots = None
+        if self.mm is not None:
+            self.mm.close()
+        with open(self.filename, 'rb') as fh:
+            self.inode = os.fstat(fh.fileno()).st_ino
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self.header = np.frombuffer(self.mm, dtype=header_dtype, count=1)
+        if (self.header['magic'][0] != SHM_MAGIC or
+            self.header['version'][0] != SHM_VERSION):
+            raise ValueError(f'not a pvarch shared cache: {self.filename}')
+        self.nslots = int(self.header['nslots'][0])
+        self.ring_size = int(self.header['ring_size'][0])
+        self.ring = np.frombuffer(self.mm, dtype=ring_dtype, count=self.ring_size,
+                                  offset=HEADER_SIZE)
+        self.slots = np.frombuffer(self.mm, dtype=slot_dtype, count=self.nslots,
+                                   offset=HEADER_SIZE + self.ring_size*ring_dtype.itemsize)
+        self.gen = -1
+        self.names = {}
+
+    def check(self):
+        """check for a new or resized store, re-opening as needed,
+        and return whether the store is being kept current"""
+        try:
+            if os.stat(self.filename).st_ino != self.inode:
+                self._open()
+            elif int(self.header['nslots'][0]) != self.nslots:
+                self._open()
+        except (OSError, ValueError):
+            return False
+        return time.time() < float(self.header['heartbeat'][0]) + self.max_age
+
+    @property
+    def seq(self):
+        "most recent sequence number published"
+        return int(self.header['seq'][0])
+
+    def _snapshot(self, idx):
+        "consistent copy of slots with indices idx"
+        s = self.slots
+        out = s[idx]
+        bad = (out['wseq'] % 2 == 1) | (out['wseq'] != s['wseq'][idx])
+        for i in range(20):
+            if not bad.any():
+                break
+            time.sleep(0)
+            redo = idx[bad]
+            out[bad] = s[redo]
+            bad[bad] = (out['wseq'][bad] % 2 == 1) | (out['wseq'][bad] != s['wseq'][redo])
+        return out
+
+    def _index(self):
+        "update pvname -> id lookup when PVs have been added or dropped"
+        gen = int(self.header['gen'][0])
+        if gen != self.gen:
+            ids = np.where(self.slots['id'] > 0)[0]
+            names = self.slots['pvname'][ids]
+            self.names = {as_str(name): int(i) for name, i in zip(names, ids)}
+            self.gen = gen
+        return self.names
+
+    def _rows(self, dat):
+        "convert slot data to list of CacheRow"
+        rows = []
+        trunc = []
+        for i, d in enumerate(dat):
+            if d['trunc']:
+                trunc.append(i)
+            rows.append(CacheRow(int(d['id']), as_str(d['pvname']),
+                                 as_str(d['type']), as_str(d['value']),
+                                 as_str(d['cvalue']), float(d['ts']),
+                                 'yes' if d['active'] else 'no', int(d['seq'])))
+        if len(trunc) > 0 and self.fetch is not None:
+            full = {row.id: row for row in self.fetch([rows[i].id for i in trunc])}
+            for i in trunc:
+                rows[i] = full.get(rows[i].id, rows[i])
+        return rows
+
+    def get_full(self, pvname):
+        "return CacheRow for a PV, or None"
+        cid = self._index().get(pvname, None)
+        if cid is None:
+            return None
+        return self._rows(self._snapshot(np.array([cid])))[0]
+
+    def get_full_many(self, pvnames):
+        "dict of {pvname: CacheRow} for a list of PVs, leaving out unknown PVs"
+        names = self._index()
+        ids = [names[p] for p in pvnames if p in names]
+        return {row.pvname: row for row in self._rows(self._snapshot(np.array(ids, dtype=int)))}
+
+    def get_pvnames(self):
+        return list(self._index().keys())
+
+    def get_values(self, all=False, time_ago=60.0, time_order=False):
+        "list of CacheRow, as Cache.get_values()"
+        s = self.slots
+        sel = s['id'] > 0
+        if not all:
+            sel &= s['ts'] > (time.time() - time_ago)
+        dat = self._snapshot(np.where(sel)[0])
+        if time_order:
+            dat = dat[dat['ts'].argsort(kind='stable')]
+        return self._rows(dat)
+
+    def get_values_dict(self, all=False, time_ago=60.0):
+        "dict of values, as Cache.get_values_dict()"
+        out = {}
+        for row in self.get_values(all=all, time_ago=time_ago):
+            out[row.pvname] = {'id': row.id, 'value': row.value,
+                               'cvalue': row.cvalue, 'dtype': row.type,
+                               'ts': row.ts}
+        return out
+
+    def changes_since(self, seq=0, limit=None):
+        """rows changed since sequence number `seq`, as Cache.changes_since(),
+        read from the slots named in the ring of change records, or None
+        if the ring no longer holds all changes since `seq`"""
+        # the writer adds change records and sets the header seq only
+        # after all slots of a write are complete, so only slots up to
+        # that seq are taken here.
+        top = self.seq
+        if top <= seq:
+            return [], seq
+        ring, size = self.ring, self.ring_size
+        rpos = int(self.header['rpos'][0])
+        lo = max(0, rpos - size)
+        # first record after seq: records are in order of seq
+        start, stop = lo, rpos
+        while start < stop:
+            mid = (start + stop)//2
+            if ring['seq'][mid % size] > seq:
+                stop = mid
+            else:
+                start = mid + 1
+        if start == lo and lo > 0:
+            return None
+        recs = ring[(start + np.arange(rpos - start)) % size]
+        if int(self.header['rpos'][0]) - size > start:
+            # records overwritten while being read
+            return None
+        recs = recs[recs['seq'] <= top]
+        dat = self._snapshot(np.unique(recs['id']).astype(int))
+        dat = dat[(dat['seq'] > seq) & (dat['seq'] <= top) & (dat['id'] > 0)]
+        dat = dat[dat['seq'].argsort()]
+        if limit is not None and len(dat) > limit:
+            dat = dat[:limit]
+            top = int(dat['seq'][-1])
+        return self._rows(dat), max(seq, top)
+
+    def close(self):
+        self.header = self.ring = self.slots = None
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
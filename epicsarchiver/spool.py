@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+"""
+Write-ahead spool for the archiver.
+
+Each batch of values to be archived is first appended to a local segment
+file, then written to the database and acknowledged.  Batches that were
+not acknowledged (database down or slow, or archiver stopped) are read
+back from the segment files and written later by Archiver.replay_spool().
+
+Segment files hold a header with the name of the archive database, then
+batches of:
+    batch header:  magic 'PVSB', number of records, payload size (bytes)
+    payload:       records of pv_id (u4), time (f8), value size (u2), value
+    crc32 of payload
+The offset acknowledged for each segment is kept in a '.ack' file next
+to it, saved at most once per `ack_interval` seconds, so that a few
+batches may be written twice after a crash.
+
+Values that cannot be written when replayed (for PVs not in the pv table
+of their archive database) are set aside in segment files in the 'held'
+subdirectory, one per database, which Spool.restore_held() returns to
+the spool to be replayed again.  The cache process likewise sets aside
+captured values it could not write when stopping (see set_aside()).
+"""
+import os
+import json
+import time
+import struct
+import zlib
+from pathlib import Path
+
+SEG_MAGIC = b'PVSPOOL1'
+BATCH_MAGIC = b'PVSB'
+BATCH_HEADER = struct.Struct('<4sII')
+RECORD = struct.Struct('<IdH')
+CRC = struct.Struct('<I')
+MAX_VALUE = 4096
+STATS_FILE = 'replay.json'
+HELD_DIR = 'held'
+
+def segment_files(dirname):
+    "sorted list of segment files in spool directory"
+    return sorted(Path(dirname).glob('*.seg'))
+
+def segment_header(dbname):
+    name = dbname.encode('utf-8')
+    return SEG_MAGIC + struct.pack('<H', len(name)) + name
+
+def read_ack(segfile):
+    try:
+        return int(Path(f'{segfile}.ack').read_text().strip())
+    except (OSError, ValueError):
+        return 0
+
+def write_ack(segfile, offset):
+    tmpfile = f'{segfile}.ack.tmp'
+    with open(tmpfile, 'w') as fh:
+        fh.write(f'{offset}\n')
+    os.replace(tmpfile, f'{segfile}.ack')
+
+def read_header(data):
+    "return (dbname, size of header) for segment data"
+    if data[:len(SEG_MAGIC)] != SEG_MAGIC:
+        raise ValueError('not a pvarch spool segment')
+    off = len(SEG_MAGIC)
+    nlen, = struct.unpack_from('<H', data, off)
+    off += 2
+    return data[off:off+nlen].decode('utf-8'), off + nlen
+
+def encode_batch(records):
+    "encode list of (pv_id, time, value) as one batch"
+    parts = []
+    for pvid, ts, value in records:
+        if not isinstance(value, bytes):
+            value = str(value).encode('utf-8')
+        value = value[:MAX_VALUE]
+        parts.append(RECORD.pack(pvid, ts, len(value)))
+        parts.append(value)
+    payload = b''.join(parts)
+    return b''.join([BATCH_HEADER.pack(BATCH_MAGIC, len(records), len(payload)),
+                     payload, CRC.pack(zlib.crc32(payload))])
+
+def decode_batches(data, offset):
+    """yield (start, end, records) for complete batches in segment data,
+    starting at offset.  stops at the first incomplete or bad batch."""
+    while offset + BATCH_HEADER.size <= len(data):
+        magic, nrec, nbytes = BATCH_HEADER.unpack_from(data, offset)
+        start = offset + BATCH_HEADER.size
+        end = start + nbytes + CRC.size
+        if magic != BATCH_MAGIC or end > len(data):
+            return
+        payload = data[start:start+nbytes]
+        if CRC.unpack_from(data, start+nbytes)[0] != zlib.crc32(payload):
+            return
+        records, pos = [], 0
+        for i in range(nrec):
+            pvid, ts, vlen = RECORD.unpack_from(payload, pos)
+            pos += RECORD.size
+            records.append((pvid, ts, payload[pos:pos+vlen].decode('utf-8')))
+            pos += vlen
+        yield offset, end, records
+        offset = end
+
+
+def set_aside(dirname, dbname, records, name=None):
+    """append list of (pv_id, time, value) that could not be written to
+    dbname to a file of held values in a spool directory, named for the
+    database or with name, returns the file name"""
+    if name is None:
+        name = Path(dbname).name
+    heldfile = Path(dirname) / HELD_DIR / f'{name}.seg'
+    heldfile.parent.mkdir(parents=True, exist_ok=True)
+    with open(heldfile, 'ab') as fh:
+        if fh.tell() == 0:
+            fh.write(segment_header(dbname))
+        fh.write(encode_batch(records))
+        fh.flush()
+        os.fsync(fh.fileno())
+    return heldfile
+
+
+class Spool:
+    """append-only spool of archive batches
+
+    Arguments
+    ----------
+    dirname        spool directory
+    dbname         name of archive database for new batches
+    segment_size   size (bytes) at which to start a new segment [64 MB]
+    ack_interval   time (sec) between saving acknowledged offsets [1]
+    """
+    def __init__(self, dirname, dbname, segment_size=64*1024*1024,
+                 ack_interval=1.0):
+        self.dirname = Path(dirname)
+        self.dirname.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.ack_interval = ack_interval
+        self.acked = {}      # segment file -> acknowledged offset
+        self.seg_end = {}    # segment file -> end of last complete batch
+        self.dirty = set()
+        self.last_ack_save = 0
+        self.fh = None
+        self.segfile = None
+        self.dbname = None
+        self.segno = 0
+        for segfile in segment_files(self.dirname):
+            self.acked[segfile] = read_ack(segfile)
+            self.segno = max(self.segno, int(segfile.stem))
+        self.new_segment(dbname)
+
+    def new_segment(self, dbname=None):
+        "start a new segment file, for writing to dbname"
+        if dbname is not None:
+            self.dbname = dbname
+        if self.fh is not None:
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+            self.fh.close()
+        self.segno += 1
+        self.segfile = self.dirname / f'{self.segno:010d}.seg'
+        header = segment_header(self.dbname)
+        self.fh = open(self.segfile, 'ab')
+        self.fh.write(header)
+        self.fh.flush()
+        self.size = len(header)
+        self.acked[self.segfile] = self.size
+        self.dirty.add(self.segfile)
+        self.save_acks(force=True)
+
+    def backlog(self):
+        "whether any batch has not been acknowledged"
+        for segfile, offset in self.acked.items():
+            if segfile != self.segfile or offset < self.size:
+                return True
+        return False
+
+    def append(self, records):
+        """append list of (pv_id, time, value) as a batch.
+        returns token to pass to ack()"""
+        if self.size > self.segment_size:
+            self.new_segment()
+        data = encode_batch(records)
+        start = self.size
+        self.fh.write(data)
+        self.fh.flush()
+        self.size += len(data)
+        return (self.segfile, start, self.size)
+
+    def ack(self, token):
+        "acknowledge a batch, and all before it in its segment, as written"
+        segfile, _start, end = token
+        if end > self.acked.get(segfile, 0):
+            self.acked[segfile] = end
+            self.dirty.add(segfile)
+        if segfile != self.segfile:
+            # finished with an old segment?
+            if end >= self.seg_end.get(segfile, os.path.getsize(segfile)):
+                self.remove(segfile)
+        self.save_acks()
+
+    def remove(self, segfile):
+        for fname in (segfile, Path(f'{segfile}.ack')):
+            try:
+                os.unlink(fname)
+            except FileNotFoundError:
+                pass
+        self.acked.pop(segfile, None)
+        self.seg_end.pop(segfile, None)
+        self.dirty.discard(segfile)
+
+    def save_acks(self, force=False):
+        if force or time.time() > self.last_ack_save + self.ack_interval:
+            for segfile in self.dirty:
+                write_ack(segfile, self.acked[segfile])
+            self.dirty = set()
+            self.last_ack_save = time.time()
+
+    def pending(self):
+        """yield (dbname, token, records) for all batches not yet
+        acknowledged, oldest first"""
+        for segfile in sorted(self.acked.keys()):
+            offset = self.acked.get(segfile, 0)
+            if segfile == self.segfile:
+                self.fh.flush()
+                end = self.size
+            else:
+                end = os.path.getsize(segfile)
+            if offset >= end and segfile != self.segfile:
+                self.remove(segfile)
+                continue
+            with open(segfile, 'rb') as fh:
+                data = fh.read(end)
+            try:
+                dbname, hsize = read_header(data)
+            except ValueError:
+                # not readable: set aside
+                os.replace(segfile, f'{segfile}.bad')
+                self.remove(segfile)
+                continue
+            offset = max(offset, hsize)
+            last = offset
+            for start, last, records in decode_batches(data, offset):
+                yield dbname, (segfile, start, last), records
+            if segfile != self.segfile:
+                # all complete batches have been read (a trailing partial
+                # batch from a crash is ignored): remove once acknowledged
+                self.seg_end[segfile] = last
+                if self.acked.get(segfile, 0) >= last:
+                    self.remove(segfile)
+
+    def set_aside(self, dbname, records):
+        """append list of (pv_id, time, value) that could not be written
+        to dbname to its file of held values, returns the file name"""
+        return set_aside(self.dirname, dbname, records)
+
+    def restore_held(self):
+        """return files of held values to the spool, to be replayed,
+        returns number of files"""
+        nfiles = 0
+        for heldfile in segment_files(self.dirname / HELD_DIR):
+            self.segno += 1
+            segfile = self.dirname / f'{self.segno:010d}.seg'
+            os.replace(heldfile, segfile)
+            self.acked[segfile] = 0
+            nfiles += 1
+        return nfiles
+
+    def save_replay_stats(self, nrows, seconds):
+        "save statistics of last replay, for status reports"
+        stats = {'time': time.time(), 'rows': nrows, 'seconds': seconds}
+        with open(self.dirname / STATS_FILE, 'w') as fh:
+            json.dump(stats, fh)
+
+    def close(self):
+        self.save_acks(force=True)
+        if self.fh is not None:
+            self.fh.flush()
+            os.fsync(self.fh.fileno())
+            self.fh.close()
+            self.fh = None
+
+
+def spool_status(dirname):
+    """summary of spool directory: number of segments, total size,
+    bytes not acknowledged, bytes of held values, and the last replay"""
+    out = {'segments': 0, 'bytes': 0, 'unacked': 0, 'held': 0, 'replay': None}
+    if dirname in (None, '') or not os.path.isdir(dirname):
+        return out
+    for segfile in segment_files(dirname):
+        size = os.path.getsize(segfile)
+        out['segments'] += 1
+        out['bytes'] += size
+        out['unacked'] += max(0, size - read_ack(segfile))
+    for heldfile in segment_files(Path(dirname) / HELD_DIR):
+        out['held'] += os.path.getsize(heldfile)
+    try:
+        with open(Path(dirname) / STATS_FILE, 'r') as fh:
+            out['replay'] = json.load(fh)
+    except (OSError, ValueError):
+        pass
+    return out
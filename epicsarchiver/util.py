@@ -3,11 +3,19 @@
 import os
 import toml
 import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
 from math import log10
 from random import randint
 
-from sqlalchemy import MetaData, create_engine, engine, text, and_
+from sqlalchemy import (MetaData, create_engine, engine, text, and_, bindparam,
+                        select, union_all)
 from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 MAX_EPOCH = 2147483647.0   # =  2**31 - 1.0 (max unix timestamp)
 SEC_DAY   = 86400.0
@@ -21,6 +29,12 @@ class Config:
     def __init__(self, **kws):
         self.logdir =  '/var/log/pvarch'
         self.zarrdir = '/var/data/pvarch'
+        self.zarr_chunk_size = '16384'
+        self.zarr_cache_size = '8'
+        self.zarr_levels = '60, 600, 3600, 86400'
+        self.zarr_export_workers = '4'
+        self.zarr_live_lag = '600'
+        self.zarr_codec = 'gzip'
 
         self.server = 'mariadb'
         self.host = 'localhost'
@@ -30,6 +44,11 @@ class Config:
 
         self.mail_server =  'localhost'
         self.mail_from = 'gsecars@millenia.aps.anl.gov'
+        self.mail_port = '25'
+        self.mail_queue_size = '1000'
+        self.mail_digest_time = '60'
+        self.mail_retries = '5'
+        self.mail_timeout = '10'
         self.cache_db = 'pvarch_master'
         self.dat_prefix = 'pvdata'
         self.dat_format = '%s_%.5d'
@@ -37,8 +56,25 @@ class Config:
         self.pv_deadtime_enum = '1'
         self.cache_alert_period = '15'
         self.cache_report_period = '300'
+        self.cache_batch_size = '5000'
+        self.cache_flush_interval = '0.05'
+        self.cache_latency_budget = ''
+        self.cache_shm_file = '/dev/shm/pvarch_cache'
+        self.cache_capture_size = '4096'
+        self.cache_capture_period = '5'
+        self.cache_connect_timeout = '10'
         self.cache_update_pvextra = '7200'
+        self.pair_flush_period = '10'
         self.archive_report_period = '300'
+        self.archive_batch_size = '5000'
+        self.archive_max_hold = '60'
+        self.archive_spool_dir = '/var/data/pvarch/spool'
+        self.archive_spool_segment_size = '67108864'
+        self.archive_time_index = 'yes'
+        self.db_cache_size = '16'
+        self.db_schema_dir = ''
+        self.archive_partition_days = '0'
+        self.archive_rollups = 'yes'
 
         self.cache_activity_time = '10'
         self.cache_activity_min_updates =  '2'
@@ -97,30 +133,146 @@ def get_dbengine(dbname, server='sqlite', create=False,
         return create_engine(conn_str % (user, password, host, port, dbname))
 
 
-class DatabaseConnection:
-    def __init__(self, dbname, config):
-        self.dbname = dbname
-        self.engine = get_dbengine(dbname,
-                                   server=config.server,
-                                   user=config.user,
-                                   password=config.password,
-                                   host=config.host)
-        self.engine.connect()
-        self.metadata = MetaData()
+class DatabaseRegistry:
+    """process-wide cache of database engines and reflected table
+    metadata, by database name, so that connecting to a database again
+    does not need a new engine or reflecting all of its tables.
+
+    Arguments
+    ----------
+    maxsize      maximum number of databases held, least recently used
+                 are disposed of first [16]
+    schema_dir   directory for saving reflected metadata between processes
+                 (MariaDB/MySQL only), checked against the column list of
+                 the database before use [None, not saved]
+
+    Each entry also holds a dict of statements that are built once and
+    reused (see DatabaseConnection.statement).
+    """
+    def __init__(self, maxsize=16, schema_dir=None):
+        self.maxsize = maxsize
+        self.schema_dir = schema_dir
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()   # dbname -> (engine, metadata, statements)
+
+    def get(self, dbname, config, refresh=False):
+        """(engine, metadata, statements) for a database, reflecting
+        tables if not held, or if refresh is True"""
+        key = (dbname, config.server, config.host, config.user)
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is not None and not refresh:
+                self.entries.move_to_end(key)
+                return entry
+        if entry is not None:
+            dbengine = entry[0]
+        else:
+            dbengine = get_dbengine(dbname, server=config.server,
+                                    user=config.user,
+                                    password=config.password,
+                                    host=config.host)
+        metadata = self.reflect(dbengine, dbname, refresh=refresh)
+        entry = (dbengine, metadata, {})
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                _key, (old_engine, _md, _st) = self.entries.popitem(last=False)
+                if old_engine is not dbengine:
+                    old_engine.dispose()
+        return entry
+
+    def fingerprint(self, dbengine, dbname):
+        "hash of the column list of a database, or None if not available"
+        if dbengine.dialect.name not in ('mysql', 'mariadb'):
+            return None
+        query = text("""select table_name, column_name, column_type
+              from information_schema.columns where table_schema=:db
+              order by table_name, ordinal_position""")
+        with dbengine.connect() as conn:
+            rows = conn.execute(query, {'db': dbname}).fetchall()
+        return hashlib.sha256(repr(rows).encode('utf-8')).hexdigest()
+
+    def reflect(self, dbengine, dbname, refresh=False):
+        "reflected metadata for a database, using saved metadata if current"
+        fname, fprint = None, None
+        if self.schema_dir not in (None, ''):
+            fname = os.path.join(self.schema_dir, f'{dbname}.schema.pkl')
+            fprint = self.fingerprint(dbengine, dbname)
+            if fprint is not None and not refresh and os.path.exists(fname):
+                try:
+                    with open(fname, 'rb') as fh:
+                        saved_fprint, metadata = pickle.load(fh)
+                    if saved_fprint == fprint:
+                        return metadata
+                except Exception:
+                    pass
+        dbengine.connect().close()
+        metadata = MetaData()
         try:
             time.sleep(0.05)
-            self.metadata.reflect(self.engine)
+            metadata.reflect(dbengine)
         except:
             time.sleep(0.25)
-            self.metadata.reflect(self.engine)
-            
+            metadata.reflect(dbengine)
+        if fname is not None and fprint is not None:
+            try:
+                os.makedirs(self.schema_dir, exist_ok=True)
+                tmpname = f'{fname}.{os.getpid()}.tmp'
+                with open(tmpname, 'wb') as fh:
+                    pickle.dump((fprint, metadata), fh)
+                os.replace(tmpname, fname)
+            except OSError:
+                pass
+        return metadata
+
+    def remove(self, dbname):
+        "forget a database, as after it has been dropped"
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == dbname]:
+                dbengine = self.entries.pop(key)[0]
+                dbengine.dispose()
+
+_registry = None
+
+def get_registry(config):
+    "the process-wide DatabaseRegistry"
+    global _registry
+    if _registry is None:
+        _registry = DatabaseRegistry(maxsize=int(config.db_cache_size),
+                                     schema_dir=config.db_schema_dir)
+    return _registry
+
+
+class DatabaseConnection:
+    """connection to a database, sharing engine and reflected tables with
+    other connections to the same database in this process
+
+    Arguments
+    ----------
+    dbname    name of database
+    config    Config
+    refresh   whether to reflect tables again, as after altering tables [False]
+    """
+    def __init__(self, dbname, config, refresh=False):
+        self.dbname = dbname
+        entry = get_registry(config).get(dbname, config, refresh=refresh)
+        self.engine, self.metadata, self.statements = entry
         self.tables  = self.metadata.tables
 
-    def execute(self, query, flush=True):
-        """general execute of query"""
+    def statement(self, key, build):
+        """statement for key, built with build() on first use and
+        reused by all connections to this database"""
+        stmt = self.statements.get(key, None)
+        if stmt is None:
+            stmt = self.statements[key] = build()
+        return stmt
+
+    def execute(self, query, flush=True, params=None):
+        """general execute of query, with optional dict of parameters"""
         result = None
         with Session(self.engine) as session, session.begin():
-            result = session.execute(query)
+            result = session.execute(query, params)
             if flush:
                 session.flush()
         return result
@@ -143,6 +295,116 @@ class DatabaseConnection:
                 session.execute(tab.insert().values(**kws))
             session.flush()
 
+    def upsert_many(self, tablename, rows, update_columns, key='id',
+                    chunksize=None):
+        """insert or update many rows of a table with set-based statements
+
+        Arguments
+        ----------
+        tablename      name of table
+        rows           list of dicts, each with a value for `key`
+        update_columns columns to overwrite when `key` already exists
+        key            name of unique/primary key column ['id']
+        chunksize      max number of rows per statement [None, all rows]
+
+        Notes
+        -----
+        uses 'insert ... on duplicate key update' for mysql/mariadb and
+        'insert ... on conflict do update' for postgresql and sqlite, so that
+        each chunk is sent as a single multi-row statement.
+        """
+        if len(rows) == 0:
+            return
+        tab = self.tables.get(tablename, None)
+        if tab is None:
+            self.table_error("no table found", tablename, 'upsert_many')
+        if chunksize is None or chunksize < 1:
+            chunksize = len(rows)
+
+        dialect = self.engine.dialect.name
+        if dialect in ('mysql', 'mariadb'):
+            stmt = mysql_insert(tab)
+            stmt = stmt.on_duplicate_key_update(
+                {col: stmt.inserted[col] for col in update_columns})
+        elif dialect in ('postgresql', 'sqlite'):
+            stmt = pg_insert(tab) if dialect == 'postgresql' else sqlite_insert(tab)
+            stmt = stmt.on_conflict_do_update(index_elements=[key],
+                      set_={col: stmt.excluded[col] for col in update_columns})
+        else:
+            stmt = tab.update().where(getattr(tab.c, key)==bindparam(f'_{key}'))
+            stmt = stmt.values({col: bindparam(col) for col in update_columns})
+            rows = [{f'_{key}': row[key], **{col: row[col] for col in update_columns}}
+                    for row in rows]
+
+        with Session(self.engine) as session, session.begin():
+            for i in range(0, len(rows), chunksize):
+                session.execute(stmt, rows[i:i+chunksize])
+            session.flush()
+
+    def update_many(self, tablename, rows, update_columns, key='id',
+                    chunksize=None):
+        """update many rows of a table, matched by key, with set-based
+        statements.  Unlike upsert_many(), rows whose key is not in the
+        table are not created.
+
+        Arguments
+        ----------
+        tablename      name of table
+        rows           list of dicts, each with a value for `key`
+        update_columns columns to set
+        key            name of unique/primary key column ['id']
+        chunksize      max number of rows per statement [None, all rows]
+
+        Returns
+        -------
+        number of statements sent
+
+        Notes
+        -----
+        for mysql/mariadb and sqlite, each chunk is sent as a single
+        statement joining the table to a derived table of the rows.  Chunks
+        are padded (repeating their last row) to a power of 2 rows, so that
+        statements are built and compiled once for each size.
+        """
+        if len(rows) == 0:
+            return 0
+        tab = self.tables.get(tablename, None)
+        if tab is None:
+            self.table_error("no table found", tablename, 'update_many')
+        columns = (key,) + tuple(update_columns)
+        if self.engine.dialect.name not in ('mysql', 'mariadb', 'sqlite'):
+            stmt = tab.update().where(getattr(tab.c, key)==bindparam(f'_{key}'))
+            stmt = stmt.values({col: bindparam(col) for col in update_columns})
+            with Session(self.engine) as session, session.begin():
+                session.execute(stmt, [{f'_{key}': row[key],
+                                        **{col: row[col] for col in update_columns}}
+                                       for row in rows])
+            return 1
+
+        def build(size):
+            sel = [select(*[bindparam(f'{col}_{i}', type_=tab.c[col].type).label(col)
+                            for col in columns]) for i in range(size)]
+            vals = union_all(*sel).subquery('vals') if size > 1 else sel[0].subquery('vals')
+            return tab.update().where(tab.c[key]==vals.c[key]).values(
+                {col: vals.c[col] for col in update_columns})
+
+        maxsize = 1 << max(0, len(rows).bit_length() - 1)
+        if chunksize is not None and chunksize > 0:
+            maxsize = min(maxsize, 1 << (int(chunksize).bit_length() - 1))
+        nstmt = 0
+        with Session(self.engine) as session, session.begin():
+            for i in range(0, len(rows), maxsize):
+                chunk = rows[i:i+maxsize]
+                size = 1 << (len(chunk) - 1).bit_length()
+                chunk = chunk + chunk[-1:]*(size - len(chunk))
+                stmt = self.statement(('update_many', tablename, columns, size),
+                                      lambda: build(size))
+                session.execute(stmt, {f'{col}_{j}': row[col] for j, row in enumerate(chunk)
+                                       for col in columns})
+                nstmt += 1
+            session.flush()
+        return nstmt
+
     def flush(self):
         with Session(self.engine) as session, session.begin():
             session.flush()
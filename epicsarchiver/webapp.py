@@ -12,6 +12,7 @@ from datetime import datetime
 import numpy as np
 
 from epicsarchiver import Archiver
+from epicsarchiver.cache import values_dict
 from epicsarchiver.util import get_config, tformat, hformat, clean_string
 
 from epicsarchiver.web_utils import (parse_times, chararray_as_string, ts2iso,
@@ -37,7 +38,7 @@ app.config.from_object(__name__)
 app.secret_key = pvarch_config['web_secret_key']
 
 archiver = cache = None
-last_refresh = age = 0
+last_refresh = age = last_seq = 0
 cache_data = {}
 enum_strings = {}
 
@@ -48,11 +49,12 @@ ago_choices = ['15 minutes', '30 minutes', '1 hour',
                '12 weeks', '26 weeks', '1 year']
 
 cull_message = """Warning: data for %s culled for plotting (%d to %d values)"""
+MAX_PLOT_BUCKETS = 7500
 
 def update_data(session, force_refresh=False):
     global pvarch_config, archiver, cache
     global cache_data, enum_strings
-    global last_refresh, age
+    global last_refresh, age, last_seq
     if archiver is None:
         archiver = Archiver(**pvarch_config)
         cache = archiver.cache
@@ -61,11 +63,13 @@ def update_data(session, force_refresh=False):
     now = time()
     age = now - last_refresh
     if len(cache_data) < 1 or age > 3600:
+        last_seq = cache.get_last_seq()
         cache_data = cache.get_values_dict(all=True)
         enum_strings = cache.get_enum_strings()
 
     else:
-        cache_data.update(cache.get_values_dict(time_ago=(5 + 2*age)))
+        rows, last_seq = cache.changes_since(last_seq)
+        cache_data.update(values_dict(rows))
     last_refresh = now
     cache_data.update({'pvarch_timestamp': {'id': 0, 'ts': now,
                                             'value': ctime(now),
@@ -109,8 +113,10 @@ def rawdata():
     """fetch data for javascript update"""
     update_data(session)
     data = {0: ctime()}
-    for val in cache.get_values_dict(time_ago=30).values():
-        data[val['id']] = val['cvalue']
+    tmin = time() - 30
+    for val in cache_data.values():
+        if val['ts'] > tmin:
+            data[val['id']] = val['cvalue']
     return jsonify(data)
 
 
@@ -377,15 +383,22 @@ def plot(date1, date2=None, pv1='', pv2='', pv3='', pv4='', time_ago=None):
             enum_labels = None
 
         force_ylog   = pvinfo['graph_type'].startswith('log')
+        # long time ranges of numeric PVs can be read from aggregated
+        # levels, with up to 4 points per bucket
+        resolution = None
+        if dtype != 'string':
+            resolution = (dt2.timestamp() - dt1.timestamp())/MAX_PLOT_BUCKETS
         try:
             t, y =  archiver.get_data(pv, with_current=with_current,
                                       tmin=dt1.timestamp(),
-                                      tmax=dt2.timestamp())
+                                      tmax=dt2.timestamp(),
+                                      resolution=resolution)
         except:
             time.sleep(0.25)
             t, y =  archiver.get_data(pv, with_current=with_current,
                                       tmin=dt1.timestamp(),
-                                      tmax=dt2.timestamp())
+                                      tmax=dt2.timestamp(),
+                                      resolution=resolution)
 
         if dtype == 'string' and table is None: # only show table of 1st string PV
             table = []
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+"""
+Codec pipelines for arrays of zarr files.
+
+   'gzip'     times and values compressed with gzip (the default, and the
+              layout of earlier files)
+   'shuffle'  times as integer microseconds, delta encoded; doubles byte
+              shuffled; ints run-length encoded; repeated strings
+              dictionary encoded; all compressed with zstd
+   'xor'      as 'shuffle', with each double XORed with the one before
+              (as in Gorilla) before the byte shuffle
+
+The pipeline used for a PV is recorded as its group attribute 'codec'.
+Filters and compressors are recorded in the zarr metadata of each array,
+so values are decoded when read, except for dictionary encoded strings
+(group attribute 'data_encoding' = 'dictionary'), where 'data' holds
+indices into the array 'labels' (see zarrstore.ZarrSeries).
+"""
+import numpy as np
+from numcodecs import Zstd, Blosc, Delta, FixedScaleOffset, GZip, register_codec
+from numcodecs.abc import Codec
+from numcodecs.compat import ensure_ndarray, ndarray_copy
+
+CODECS = ('gzip', 'shuffle', 'xor')
+ZSTD_LEVEL = 5
+
+
+class XorFloat(Codec):
+    """filter for float64 values, replacing the bits of each value with
+    their XOR with the bits of the value before, so that slowly changing
+    values give leading and trailing zero bytes"""
+    codec_id = 'pvarch_xorfloat'
+
+    def encode(self, buf):
+        bits = ensure_ndarray(buf).view('<u8').reshape(-1)
+        out = bits.copy()
+        out[1:] ^= bits[:-1]
+        return out
+
+    def decode(self, buf, out=None):
+        bits = ensure_ndarray(buf).view('<u8').reshape(-1)
+        dec = np.bitwise_xor.accumulate(bits).view('<f8')
+        return ndarray_copy(dec, out)
+
+
+class RunLength(Codec):
+    """run-length encoding of integer values: the number of runs, then
+    the value and the length of each run
+
+    Arguments
+    ----------
+    dtype    dtype of values
+    """
+    codec_id = 'pvarch_runlength'
+
+    def __init__(self, dtype='<i8'):
+        self.dtype = np.dtype(dtype).str
+
+    def get_config(self):
+        return {'id': self.codec_id, 'dtype': self.dtype}
+
+    def encode(self, buf):
+        vals = ensure_ndarray(buf).view(self.dtype).reshape(-1)
+        if len(vals) == 0:
+            return np.zeros(1, dtype='<i8').tobytes()
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(vals)) + 1))
+        lengths = np.diff(np.append(starts, len(vals))).astype('<i8')
+        return b''.join((np.array([len(starts)], dtype='<i8').tobytes(),
+                         vals[starts].astype(self.dtype).tobytes(), lengths.tobytes()))
+
+    def decode(self, buf, out=None):
+        buf = ensure_ndarray(buf).view('u1').reshape(-1)
+        nruns = int(buf[:8].view('<i8')[0])
+        nval = nruns*np.dtype(self.dtype).itemsize
+        vals = buf[8:8+nval].view(self.dtype)
+        lengths = buf[8+nval:8+nval+8*nruns].view('<i8')
+        return ndarray_copy(np.repeat(vals, lengths), out)
+
+
+register_codec(XorFloat)
+register_codec(RunLength)
+
+
+def array_options(codec, name, dtype):
+    """dict of 'filters' and 'compressor' for an array of a PV group
+    ('ts' or 'data') with a codec pipeline"""
+    dtype = np.dtype(dtype)
+    if codec == 'gzip':
+        return {'filters': None, 'compressor': GZip()}
+    if codec not in CODECS:
+        raise ValueError(f"unknown zarr codec '{codec}': use one of {CODECS}")
+    zstd = Zstd(level=ZSTD_LEVEL)
+    if name == 'ts':
+        return {'filters': [FixedScaleOffset(offset=0, scale=1.e6, dtype='<f8', astype='<i8'),
+                            Delta(dtype='<i8')],
+                'compressor': zstd}
+    if dtype.kind == 'f':
+        shuffle = Blosc(cname='zstd', clevel=ZSTD_LEVEL, shuffle=Blosc.SHUFFLE)
+        filters = [XorFloat()] if (codec == 'xor' and dtype.itemsize == 8) else None
+        return {'filters': filters, 'compressor': shuffle}
+    if dtype.kind in 'iub':
+        return {'filters': [RunLength(dtype)], 'compressor': zstd}
+    return {'filters': None, 'compressor': zstd}
+
+def dictionary_encode(values, max_fraction=0.5):
+    """(indices, labels) for an array of bytes with no more distinct values
+    than max_fraction of all values (and at most 65535), or None"""
+    if values.dtype.kind != 'S' or len(values) == 0:
+        return None
+    labels, indices = np.unique(values, return_inverse=True)
+    if len(labels) > min(65535, max_fraction*len(values)):
+        return None
+    itype = np.uint8 if len(labels) < 256 else np.uint16
+    return indices.astype(itype).reshape(-1), labels
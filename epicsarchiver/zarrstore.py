@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+"""
+Zarr files of archived data, one zipped file per archive database.
+
+Each PV is a group 'pvarch/<pvname>' with arrays 'ts' and 'data', sorted
+by time and stored in chunks of `chunk_size` values, and 'tindex' holding
+the first and last time of each chunk.  Reading a time range finds the
+chunks needed with a binary search of 'tindex', and only decompresses
+those.  Files written by earlier versions (not sorted, no 'tindex') are
+read in full.
+
+While a database is exported (see export.py), values exported so far are
+held in a 'sidecar' zarr store in an SQLite file, '<dbname>_zarr.sqlite',
+without levels, and with the time up to which values of each PV have been
+exported as the group attribute 'exported_to'.
+
+For numeric PVs, 'levels/<width>' groups hold pre-aggregated values over
+time buckets of `width` seconds (by default 1 minute, 10 minutes, 1 hour
+and 1 day): the start time of each bucket 't', and 'count', 'min', 'max',
+'mean', 'first' and 'last' of the values in it.  Levels with no fewer
+buckets than a quarter of the number of values are not written.
+
+The codec pipeline of the 'ts' and 'data' arrays is chosen per export
+(see zarrcodecs.py), and recorded as the group attribute 'codec'.
+"""
+import os
+import warnings
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import zarr
+
+from .zarrcodecs import array_options, dictionary_encode
+
+CHUNK_SIZE = 16384
+LEVELS = (60, 600, 3600, 86400)
+STATS = ('count', 'min', 'max', 'mean', 'first', 'last')
+
+
+def aggregate(times, values, width):
+    """aggregate sorted times and float values into buckets of width
+    seconds, returns (bucket start times, dict of arrays for STATS).
+    nan values are skipped."""
+    good = ~np.isnan(values)
+    times, values = times[good], values[good]
+    if len(times) == 0:
+        return np.zeros(0), {name: np.zeros(0) for name in STATS}
+    bucket = np.floor(times/width)
+    starts = np.concatenate(([0], np.where(np.diff(bucket) > 0)[0] + 1))
+    ends = np.append(starts[1:], len(times)) - 1
+    count = ends - starts + 1
+    stats = {'count': count,
+             'min': np.minimum.reduceat(values, starts),
+             'max': np.maximum.reduceat(values, starts),
+             'mean': np.add.reduceat(values, starts)/count,
+             'first': values[starts],
+             'last': values[ends]}
+    return bucket[starts]*width, stats
+
+def level_points(tbucket, stats, width):
+    """(times, values) for plotting aggregated values: the first, min, max
+    and last value of each bucket, spread over the bucket, or the one
+    value of buckets with one value"""
+    if len(tbucket) == 0:
+        return np.zeros(0), np.zeros(0)
+    offsets = np.array([0, 0.25, 0.5, 0.75])*width
+    times = (tbucket[:, None] + offsets[None, :])
+    values = np.column_stack([stats[name] for name in ('first', 'min', 'max', 'last')])
+    keep = np.ones(times.shape, dtype=bool)
+    keep[stats['count'] == 1, 1:] = False
+    return times[keep], values[keep]
+
+def parse_levels(levels):
+    "list of level widths (sec) from a config value: a list or a string"
+    if isinstance(levels, str):
+        levels = levels.replace(',', ' ').split()
+    return sorted(float(width) for width in levels)
+
+def write_levels(grp, times, values, levels=LEVELS, chunk_size=CHUNK_SIZE):
+    "write aggregated levels for sorted numeric values to a PV group"
+    if values.dtype.kind not in 'fiub' or len(times) == 0:
+        return
+    values = values.astype(np.float64)
+    lgrp = None
+    for width in levels:
+        tbucket, stats = aggregate(times, values, width)
+        if len(tbucket) > len(times)/4:
+            continue
+        if lgrp is None:
+            lgrp = grp.create_group('levels')
+        g = lgrp.create_group(f'{width:g}')
+        g.create_dataset('t', data=tbucket, chunks=(chunk_size,), compression='gzip')
+        for name in STATS:
+            g.create_dataset(name, data=stats[name], chunks=(chunk_size,),
+                             compression='gzip')
+
+
+def chunk_index(times, chunk_size):
+    "array of the first and last of sorted times for each chunk"
+    starts = np.arange(0, len(times), chunk_size)
+    ends = np.minimum(starts + chunk_size, len(times)) - 1
+    tindex = np.zeros((len(starts), 2), dtype=np.float64)
+    if len(starts) > 0:
+        tindex[:, 0], tindex[:, 1] = times[starts], times[ends]
+    return tindex
+
+def sort_series(times, values):
+    "(times, values) arrays sorted by time"
+    times = np.asarray(times, dtype=np.float64)
+    values = np.asarray(values)
+    torder = times.argsort(kind='stable')
+    return times[torder], values[torder]
+
+def write_arrays(grp, times, values, chunk_size=CHUNK_SIZE, codec='gzip'):
+    """write 'ts', 'data' and 'tindex' arrays for sorted values to a PV
+    group, with a codec pipeline (see zarrcodecs.py).  returns dict of
+    attributes for the group to record the codec, not yet written"""
+    attrs = {}
+    if codec != 'gzip':
+        attrs['codec'] = codec
+        encoded = dictionary_encode(values)
+        if encoded is not None:
+            values, labels = encoded
+            grp.create_dataset('labels', data=labels, overwrite=True)
+            attrs['data_encoding'] = 'dictionary'
+    grp.create_dataset('ts', data=times, chunks=(chunk_size,), overwrite=True,
+                       **array_options(codec, 'ts', times.dtype))
+    grp.create_dataset('data', data=values, chunks=(chunk_size,), overwrite=True,
+                       **array_options(codec, 'data', values.dtype))
+    grp.create_dataset('tindex', data=chunk_index(times, chunk_size), overwrite=True)
+    return attrs
+
+def write_series(zpv, pvname, times, values, attrs=None, chunk_size=CHUNK_SIZE,
+                 levels=LEVELS, codec='gzip'):
+    """write time series for a PV to a zarr group, sorted by time, with
+    its chunk index and aggregated levels.  returns the new group"""
+    times, values = sort_series(times, values)
+    chunk_size = max(1, int(chunk_size))
+    grp = zpv.create_group(pvname)
+    attrs = {} if attrs is None else dict(attrs)
+    attrs.update(write_arrays(grp, times, values, chunk_size=chunk_size, codec=codec))
+    # set attributes once: zip files cannot replace them
+    if len(attrs) > 0:
+        grp.attrs.update(attrs)
+    write_levels(grp, times, values, levels=levels, chunk_size=chunk_size)
+    return grp
+
+def can_append(dtype, values):
+    "whether values can be appended to an array of dtype without loss"
+    if len(values) == 0:
+        return True
+    if dtype.kind == 'f':
+        return values.dtype.kind in 'fiub'
+    if dtype.kind == 'i':
+        return values.dtype.kind in 'iub'
+    if dtype.kind == 'S':
+        return values.dtype.kind == 'S' and values.dtype.itemsize <= dtype.itemsize
+    return False
+
+def as_bytes(values):
+    "array of bytes for values, as for strings mixed with numbers"
+    if values.dtype.kind == 'S':
+        return values
+    return np.array([str(val).encode('utf-8') for val in values.tolist()], dtype=bytes)
+
+def append_series(grp, times, values, after=None):
+    """append values with times later than `after` to the 'ts', 'data' and
+    'tindex' arrays of a PV group (without levels), first removing any
+    values later than `after`, as left by an interrupted export.
+    returns number of values appended"""
+    times, values = sort_series(times, values)
+    if after is not None:
+        keep = times > after
+        times, values = times[keep], values[keep]
+    ts, data = grp['ts'], grp['data']
+    chunk_size = ts.chunks[0]
+    npts = ts.shape[0]
+    n0, k0 = npts, 0
+    if after is not None and npts > 0:
+        tindex = grp['tindex'][()]
+        k0 = int(np.searchsorted(tindex[:, 1], after, side='right'))
+        lo = min(k0*chunk_size, npts)
+        n0 = lo + int(np.searchsorted(ts[lo:npts], after, side='right'))
+    if not can_append(data.dtype, values):
+        # new value type: write all values again
+        old_t, old_v = ts[:n0], data[:n0]
+        if data.dtype.kind != values.dtype.kind and 'S' in (data.dtype.kind, values.dtype.kind):
+            old_v, values = as_bytes(old_v), as_bytes(values)
+        write_arrays(grp, np.concatenate((old_t, times)),
+                     np.concatenate((old_v, values)), chunk_size=chunk_size)
+        return len(times)
+    if n0 < npts:
+        ts.resize((n0,))
+        data.resize((n0,))
+    if len(times) > 0:
+        ts.append(times)
+        data.append(values.astype(data.dtype))
+    # chunk index from the first chunk changed
+    k0 = n0 // chunk_size
+    tindex = grp['tindex']
+    tindex.resize((k0, 2))
+    tindex.append(chunk_index(ts[k0*chunk_size:], chunk_size))
+    return len(times)
+
+
+def open_sidecar(fname):
+    "zarr store for a sidecar SQLite file, which may be written by another process"
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        store = zarr.SQLiteStore(fname, timeout=30)
+    store.db.execute('pragma journal_mode=wal')
+    return store
+
+
+class ZarrSeries:
+    """time series for a PV in a zarr file, reading only the chunks needed
+
+    Arguments
+    ----------
+    grp    zarr group for the PV, with 'ts', 'data', and optionally 'tindex'
+    """
+    def __init__(self, grp):
+        self.grp = grp
+        self.labels = None
+        if grp.attrs.get('data_encoding', None) == 'dictionary':
+            self.labels = grp['labels'][()]
+        self.levels = []
+        if 'levels' in grp:
+            self.levels = sorted(float(width) for width in grp['levels'].group_keys())
+        self.ts = grp['ts']
+        self.data = grp['data']
+        self.npts = self.ts.shape[0]
+        self.tindex = None
+        if 'tindex' in grp:
+            self.tindex = grp['tindex'][()]
+            self.chunk_size = self.ts.chunks[0]
+        else:
+            # earlier layout: read and sort all values
+            times = self.ts[()]
+            torder = times.argsort(kind='stable')
+            self.ts, self.data = times[torder], self.data[()][torder]
+
+    def level_for(self, resolution):
+        "width of coarsest level no coarser than resolution (sec), or None"
+        widths = [w for w in self.levels if w <= resolution]
+        return widths[-1] if len(widths) > 0 else None
+
+    def level_range(self, width, tmin, tmax):
+        """(bucket start times, dict of arrays for STATS) for the buckets
+        of a level that overlap tmin to tmax"""
+        g = self.grp[f'levels/{width:g}']
+        tbucket = g['t'][()]
+        i0 = np.searchsorted(tbucket, tmin - width, side='right')
+        i1 = np.searchsorted(tbucket, tmax, side='right')
+        return tbucket[i0:i1], {name: g[name][i0:i1] for name in STATS}
+
+    def range(self, tmin, tmax, resolution=None):
+        """(times, values) arrays for tmin <= time <= tmax.  With a
+        resolution (sec), values from the coarsest aggregated level with
+        buckets no wider than that are used, if available (see level_points)"""
+        if resolution is not None:
+            width = self.level_for(resolution)
+            if width is not None:
+                tbucket, stats = self.level_range(width, tmin, tmax)
+                return level_points(tbucket, stats, width)
+        lo, hi = 0, self.npts
+        if self.tindex is not None:
+            # chunks with last time >= tmin and first time <= tmax
+            k0 = np.searchsorted(self.tindex[:, 1], tmin, side='left')
+            k1 = np.searchsorted(self.tindex[:, 0], tmax, side='right')
+            if k1 <= k0:
+                return self.ts[0:0], self.values(0, 0)
+            lo, hi = k0*self.chunk_size, min(k1*self.chunk_size, self.npts)
+        times = self.ts[lo:hi]
+        i0 = np.searchsorted(times, tmin, side='left')
+        i1 = np.searchsorted(times, tmax, side='right')
+        return times[i0:i1], self.values(lo+i0, lo+i1)
+
+    def values(self, i0, i1):
+        "values from index i0 to i1, decoding dictionary encoded values"
+        data = self.data[i0:i1]
+        if self.labels is not None:
+            data = self.labels[data]
+        return data
+
+    def before(self, t):
+        "(time, value) of the last value before time t, or None"
+        lo, hi = 0, self.npts
+        if self.tindex is not None:
+            k = np.searchsorted(self.tindex[:, 0], t, side='left') - 1
+            if k < 0:
+                return None
+            lo, hi = k*self.chunk_size, min((k+1)*self.chunk_size, self.npts)
+        times = self.ts[lo:hi]
+        i = np.searchsorted(times, t, side='left') - 1
+        if i < 0:
+            return None
+        return float(times[i]), self.values(lo+i, lo+i+1).tolist()[0]
+
+
+class ZarrFiles:
+    """zarr files for archive databases, kept open for later reads
+
+    Arguments
+    ----------
+    zarrdir    folder of zarr files
+    maxsize    maximum number of files kept open, least recently used
+               are closed first [8]
+
+    A file replaced since it was opened (as by save_zarr) is opened again.
+    Sidecar stores are opened once for each thread reading them.
+    """
+    def __init__(self, zarrdir, maxsize=8):
+        self.zarrdir = zarrdir
+        self.maxsize = maxsize
+        self.lock = threading.RLock()
+        self.files = OrderedDict()   # dbname -> (mtime, store, root)
+        self.local = threading.local()
+
+    def filename(self, dbname):
+        return os.path.abspath(os.path.join(self.zarrdir, f'{dbname}_zarr.zip'))
+
+    def sidecar_filename(self, dbname):
+        return os.path.abspath(os.path.join(self.zarrdir, f'{dbname}_zarr.sqlite'))
+
+    def sidecar_series(self, dbname, pvname):
+        """(ZarrSeries, exported_to) for a PV in the sidecar store of a
+        database being exported, or None"""
+        fname = self.sidecar_filename(dbname)
+        stores = getattr(self.local, 'sidecars', None)
+        if stores is None:
+            stores = self.local.sidecars = {}
+        if not os.path.exists(fname):
+            store = stores.pop(dbname, None)
+            if store is not None:
+                store.close()
+            return None
+        try:
+            store = stores.get(dbname, None)
+            if store is None:
+                store = stores[dbname] = open_sidecar(fname)
+            grp = zarr.open_group(store=store, mode='r')[f'pvarch/{pvname}']
+            tdone = grp.attrs.get('exported_to', None)
+            if tdone is None:
+                return None
+            return ZarrSeries(grp), float(tdone)
+        except Exception:
+            return None
+
+    def open(self, dbname):
+        "root group of zarr file for an archive database, or None"
+        fname = self.filename(dbname)
+        try:
+            mtime = os.stat(fname).st_mtime
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.files.get(dbname, None)
+            if entry is not None and entry[0] == mtime:
+                self.files.move_to_end(dbname)
+                return entry[2]
+            if entry is not None:
+                self.close(dbname)
+            try:
+                store = zarr.ZipStore(fname, mode='r')
+                root = zarr.open_group(store=store, mode='r')
+            except Exception:
+                return None
+            self.files[dbname] = (mtime, store, root)
+            while len(self.files) > self.maxsize:
+                self.close(next(iter(self.files)))
+        return root
+
+    def series(self, dbname, pvname):
+        "ZarrSeries for a PV in the zarr file for a database, or None"
+        root = self.open(dbname)
+        if root is None:
+            return None
+        try:
+            return ZarrSeries(root[f'pvarch/{pvname}'])
+        except KeyError:
+            return None
+
+    def close(self, dbname=None):
+        "close file (and this thread's sidecar store) for a database, or all files"
+        with self.lock:
+            names = list(self.files.keys()) if dbname is None else [dbname]
+            for name in names:
+                entry = self.files.pop(name, None)
+                if entry is not None:
+                    entry[1].close()
+        stores = getattr(self.local, 'sidecars', {})
+        for name in list(stores.keys()) if dbname is None else [dbname]:
+            store = stores.pop(name, None)
+            if store is not None:
+                store.close()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+compression_benchmark: compare archive compression policies
+
+Replays archived (or synthetic) data for PVs through the archiver's
+decision engine with compression policies 'none', 'deadband' and
+'swinging_door' (at several tolerances), and reports the number of
+rows that would be stored and the error of reconstructing every
+replayed value from the stored rows, by holding the last value ('hold')
+and by linear interpolation ('linear').
+
+Usage:
+   compression_benchmark.py [--hours H] [--tol T1,T2,...] PV1 PV2 ...
+   compression_benchmark.py --synthetic N [--tol T1,T2,...]
+
+Note that archived data has already been reduced by the deadband and
+deadtime used when it was archived.
+"""
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+from tabulate import tabulate
+
+from epicsarchiver.pvstate import PVState
+
+
+def replay(ts, values, compression, deadtime, deadband, tolerance=None):
+    """replay values through a PVState for one PV, returns
+    arrays of times and values that would be archived"""
+    state = PVState(size=4, first_force=1.e99)
+    state.configure(1, deadtime, deadband, 'double', 'yes',
+                    compression=compression, tolerance=tolerance)
+    ids = np.array([1])
+    out_t, out_v = [], []
+    limbo = None
+    prev = None
+    def archive(t, v):
+        out_t.append(t)
+        out_v.append(v)
+        state.archived(ids, np.array([t]), np.array([v]))
+
+    for t, v in zip(ts, values):
+        if limbo is not None and t > state.last_ts[1] + state.deadtime[1]:
+            archive(*limbo)
+            limbo = None
+        save, inlimbo, held = state.decide(ids, np.array([t]), np.array([v]))
+        if held[0]:
+            archive(*prev)
+        if save[0]:
+            archive(t, v)
+            limbo = None
+        elif inlimbo[0]:
+            limbo = (t, v)
+        prev = (t, v)
+    # the archiver would write these later: include for reconstruction
+    if limbo is not None:
+        archive(*limbo)
+    elif compression == 'swinging_door' and prev is not None and out_t[-1] != prev[0]:
+        archive(*prev)
+    return np.array(out_t), np.array(out_v)
+
+
+def reconstruct_errors(ts, values, arch_t, arch_v):
+    "max and rms errors for hold and linear reconstruction"
+    idx = np.searchsorted(arch_t, ts, side='right') - 1
+    hold = arch_v[np.clip(idx, 0, len(arch_v)-1)]
+    linear = np.interp(ts, arch_t, arch_v)
+    ehold, elin = np.abs(hold - values), np.abs(linear - values)
+    return (ehold.max(), np.sqrt((ehold**2).mean()),
+            elin.max(), np.sqrt((elin**2).mean()))
+
+
+def synthetic_data(npts, seed=1):
+    "slowly drifting, noisy signal sampled at 10 Hz"
+    rng = np.random.default_rng(seed)
+    ts = time.time() - npts/10.0 + np.arange(npts)/10.0
+    drift = np.cumsum(rng.normal(scale=0.002, size=npts))
+    values = 25.0 + 0.5*np.sin(np.arange(npts)/3000.0) + drift
+    values += rng.normal(scale=0.002, size=npts)
+    return ts, values
+
+
+def benchmark(label, ts, values, deadtime, deadband, tolerances):
+    rows = [[f'{label}  ({len(ts)} values)', 'rows', 'fraction',
+             'max err (hold)', 'rms err (hold)',
+             'max err (linear)', 'rms err (linear)', 'time (sec)']]
+    cases = [('none', None), ('deadband', None)]
+    cases.extend([('swinging_door', tol) for tol in tolerances])
+    for compression, tol in cases:
+        t0 = time.time()
+        arch_t, arch_v = replay(ts, values, compression, deadtime,
+                                deadband, tolerance=tol)
+        dt = time.time() - t0
+        name = compression if tol is None else f'{compression} tol={tol:g}'
+        errs = reconstruct_errors(ts, values, arch_t, arch_v)
+        rows.append([name, len(arch_t), f'{len(arch_t)/len(ts):.4f}',
+                     *[f'{e:.4g}' for e in errs], f'{dt:.2f}'])
+    print(tabulate(rows, headers='firstrow', tablefmt='simple_grid'))
+
+
+def main():
+    parser = ArgumentParser(prog='compression_benchmark',
+                            description='compare archive compression policies')
+    parser.add_argument('--hours', type=float, default=24.0,
+                        help='hours of archived data to replay [24]')
+    parser.add_argument('--tol', default=None,
+                        help='comma-separated tolerances for swinging_door [deadband*(1,10,100)]')
+    parser.add_argument('--deadtime', type=float, default=None,
+                        help='deadtime [PV setting, or 0 for synthetic data]')
+    parser.add_argument('--deadband', type=float, default=None,
+                        help='deadband [PV setting, or 0.001 for synthetic data]')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='use N points of synthetic data')
+    parser.add_argument('pvnames', nargs='*')
+    args = parser.parse_args()
+
+    datasets = []
+    if args.synthetic > 0:
+        ts, values = synthetic_data(args.synthetic)
+        deadtime = 0.0 if args.deadtime is None else args.deadtime
+        deadband = 0.001 if args.deadband is None else args.deadband
+        datasets.append(('synthetic', ts, values, deadtime, deadband))
+    if len(args.pvnames) > 0:
+        from epicsarchiver import Archiver
+        from epicsarchiver.util import normalize_pvname
+        arch = Archiver()
+        tmax = time.time()
+        tmin = tmax - 3600*args.hours
+        for pvname in args.pvnames:
+            pvname = normalize_pvname(pvname)
+            ts, values = arch.get_data(pvname, tmin=tmin, tmax=tmax,
+                                       with_current=False)
+            try:
+                ts, values = np.array(ts, dtype=float), np.array(values, dtype=float)
+            except ValueError:
+                print(f"skipping {pvname}: not numeric")
+                continue
+            info = arch.pvinfo.get(pvname, {})
+            deadtime = args.deadtime
+            if deadtime is None:
+                deadtime = float(info.get('deadtime', 0))
+            deadband = args.deadband
+            if deadband is None:
+                deadband = float(info.get('deadband', 0))
+            datasets.append((pvname, ts, values, deadtime, deadband))
+
+    if len(datasets) == 0:
+        parser.print_help()
+        return
+
+    for label, ts, values, deadtime, deadband in datasets:
+        if len(ts) < 2:
+            print(f"not enough data for {label}")
+            continue
+        if args.tol is not None:
+            tolerances = [float(t) for t in args.tol.split(',')]
+        else:
+            tolerances = [max(deadband, 1.e-12)*f for f in (1, 10, 100)]
+        benchmark(label, ts, values, deadtime, deadband, tolerances)
+
+
+if __name__ == '__main__':
+    main()
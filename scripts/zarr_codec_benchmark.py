@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+zarr_codec_benchmark: compare zarr codec pipelines on an archive
+
+Reads all PVs from a zarr file written by 'pvarch save_zarr', writes them
+again with each codec pipeline ('gzip', 'shuffle', 'xor', see
+epicsarchiver/zarrcodecs.py) to a temporary file, and reports the file
+size, the time to write, and the rate of reading all values back, along
+with the largest change to times (from rounding to microseconds) and
+whether all values were read back unchanged.
+
+Usage:
+   zarr_codec_benchmark.py [--max-pvs N] [--codecs C1,C2,...] ZARRFILE
+   zarr_codec_benchmark.py [--max-pvs N] [--codecs C1,C2,...] DBNAME
+
+A DBNAME is found as '<DBNAME>_zarr.zip' in the configured zarrdir.
+"""
+import os
+import time
+import tempfile
+from argparse import ArgumentParser
+
+import numpy as np
+import zarr
+from tabulate import tabulate
+
+from epicsarchiver.zarrstore import ZarrSeries, write_series, CHUNK_SIZE
+from epicsarchiver.zarrcodecs import CODECS
+
+
+def read_all(root, pvnames):
+    "dict of {pvname: (times, values)} for PVs of a zarr file"
+    out = {}
+    for pvname in pvnames:
+        zser = ZarrSeries(root[f'pvarch/{pvname}'])
+        out[pvname] = zser.range(-np.inf, np.inf)
+    return out
+
+def same_values(a, b):
+    if a.dtype.kind == 'f' and b.dtype.kind == 'f':
+        return np.array_equal(a, b, equal_nan=True)
+    return np.array_equal(a, b)
+
+def benchmark(fname, codecs, max_pvs=None, chunk_size=CHUNK_SIZE):
+    store = zarr.ZipStore(fname, mode='r')
+    root = zarr.open_group(store=store, mode='r')
+    pvnames = sorted(root['pvarch'].group_keys())
+    if max_pvs is not None:
+        pvnames = pvnames[:max_pvs]
+    source = read_all(root, pvnames)
+    attrs = {pvname: dict(root[f'pvarch/{pvname}'].attrs) for pvname in pvnames}
+    store.close()
+    nvals = sum(len(t) for t, v in source.values())
+
+    rows = [[f'{os.path.basename(fname)}  ({len(pvnames)} PVs, {nvals} values)',
+             'size (kB)', 'bytes/value', 'write (sec)', 'read (values/sec)',
+             'max time change (sec)', 'values unchanged']]
+    tmpdir = tempfile.mkdtemp(prefix='zarr_codecs_')
+    for codec in codecs:
+        tfile = os.path.join(tmpdir, f'{codec}_zarr.zip')
+        t0 = time.time()
+        tstore = zarr.ZipStore(tfile, mode='w')
+        zpv = zarr.group(store=tstore).create_group('pvarch')
+        for pvname in pvnames:
+            times, values = source[pvname]
+            pvattrs = {k: v for k, v in attrs[pvname].items()
+                       if k not in ('codec', 'data_encoding')}
+            write_series(zpv, pvname, times, values, attrs=pvattrs,
+                         chunk_size=chunk_size, levels=(), codec=codec)
+        tstore.close()
+        twrite = time.time() - t0
+        size = os.stat(tfile).st_size
+
+        tstore = zarr.ZipStore(tfile, mode='r')
+        t0 = time.time()
+        result = read_all(zarr.open_group(store=tstore, mode='r'), pvnames)
+        tread = max(1.e-6, time.time() - t0)
+        tstore.close()
+        dtmax, same = 0.0, True
+        for pvname in pvnames:
+            t_in, v_in = source[pvname]
+            t_out, v_out = result[pvname]
+            if len(t_in) > 0:
+                dtmax = max(dtmax, float(np.abs(t_out - t_in).max()))
+            same = same and same_values(v_in, v_out)
+        rows.append([codec, f'{size/1024:.1f}', f'{size/max(1, nvals):.2f}',
+                     f'{twrite:.2f}', f'{nvals/tread:.0f}', f'{dtmax:.2g}',
+                     'yes' if same else 'no'])
+        os.unlink(tfile)
+    os.rmdir(tmpdir)
+    print(tabulate(rows, headers='firstrow', tablefmt='simple_grid'))
+
+
+def main():
+    parser = ArgumentParser(prog='zarr_codec_benchmark',
+                            description='compare zarr codec pipelines on an archive')
+    parser.add_argument('--max-pvs', dest='max_pvs', type=int, default=None,
+                        help='use only the first N PVs [all]')
+    parser.add_argument('--codecs', default=','.join(CODECS),
+                        help=f"comma-separated codecs [{','.join(CODECS)}]")
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=CHUNK_SIZE,
+                        help=f'values per chunk [{CHUNK_SIZE}]')
+    parser.add_argument('source', nargs='?', help='zarr file or archive database name')
+    args = parser.parse_args()
+    if args.source is None:
+        parser.print_help()
+        return
+    fname = args.source
+    if not os.path.exists(fname):
+        from epicsarchiver.util import get_config
+        fname = os.path.join(get_config().zarrdir, f'{args.source}_zarr.zip')
+    if not os.path.exists(fname):
+        print(f"cannot find zarr file for {args.source}")
+        return
+    codecs = [c.strip() for c in args.codecs.split(',')]
+    benchmark(fname, codecs, max_pvs=args.max_pvs, chunk_size=args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+import re
+import email
+import socket
+import sqlite3
+import threading
+import socketserver
+
+import pytest
+from sqlalchemy import text
+
+from epicsarchiver import schema
+from epicsarchiver.alerts import AlertEngine
+from epicsarchiver.archiver import Archiver
+from epicsarchiver.cache import Cache, PVRegistry
+from epicsarchiver.pvstate import PVState
+from epicsarchiver.util import Config, DatabaseConnection
+
+def sqlite_statements(sql):
+    """statements of MariaDB schema SQL (as in schema.py), adapted so
+    that sqlite will run them"""
+    sql = re.sub(r'\bunsigned\b', '', sql)
+    sql = re.sub(r'int\(\d+\)', 'integer', sql)
+    sql = re.sub(r'\bauto_increment\b', '', sql)
+    sql = re.sub(r"enum\([^)]*\)", 'varchar(8)', sql)
+    sql = re.sub(r'unique key \w+ \((\w+)\(\d+\)\)', r'unique (\1)', sql)
+    sql = re.sub(r'unique key \w+ \(', 'unique (', sql)
+    sql = re.sub(r',\s*key \w+ \([^)]*\)', '', sql)
+    sql = re.sub(r'\)\s*(ENGINE|DEFAULT CHARSET)[^;]*;', ');', sql)
+    out = []
+    for stmt in sql.split(';'):
+        stmt = stmt.strip()
+        if stmt.lower().startswith(('create table', 'insert')):
+            out.append(stmt)
+    return out
+
+@pytest.fixture
+def config():
+    return Config(server='sqlite', host='', user='', password='')
+
+@pytest.fixture
+def sqlite_ddl(monkeypatch):
+    "DatabaseConnection.sql_execute running schema SQL adapted for sqlite"
+    def sql_execute(self, sql, flush=True):
+        for stmt in sqlite_statements(sql):
+            self.execute(text(stmt), flush=flush)
+    monkeypatch.setattr(DatabaseConnection, 'sql_execute', sql_execute)
+
+@pytest.fixture
+def make_db(tmp_path, config):
+    """function making an sqlite database from schema SQL, as DatabaseConnection,
+    with the name of its file in tmp_path as database name"""
+    def make(name, sql):
+        fname = str(tmp_path / name)
+        conn = sqlite3.connect(fname)
+        for stmt in sqlite_statements(sql):
+            conn.execute(stmt)
+        conn.commit()
+        conn.close()
+        return DatabaseConnection(fname, config)
+    return make
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    """small SMTP server on localhost, keeping received messages.
+
+    fail_mail    number of following MAIL commands to refuse
+    drop()       closes all open client connections, as an idle timeout would
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPHandler)
+        self.port = self.server_address[1]
+        self.messages = []
+        self.connections = 0
+        self.fail_mail = 0
+        self.clients = []
+        self.lock = threading.Lock()
+
+    def drop(self):
+        with self.lock:
+            for sock in self.clients:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            self.clients = []
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, text):
+        self.wfile.write(f'{text}\r\n'.encode('ascii'))
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+            server.clients.append(self.request)
+        self.reply('220 localhost test SMTP')
+        mail_from, rcpts = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            cmd = line.decode('ascii').strip()
+            verb = cmd.split(' ', 1)[0].upper()
+            if verb in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif verb == 'MAIL':
+                with server.lock:
+                    refuse = server.fail_mail > 0
+                    server.fail_mail -= int(refuse)
+                if refuse:
+                    self.reply('451 try again later')
+                else:
+                    mail_from, rcpts = cmd[10:], []
+                    self.reply('250 ok')
+            elif verb == 'RCPT':
+                rcpts.append(cmd[8:].strip('<>'))
+                self.reply('250 ok')
+            elif verb == 'DATA':
+                self.reply('354 end with .')
+                lines = []
+                while True:
+                    line = self.rfile.readline()
+                    if line in (b'.\r\n', b''):
+                        break
+                    lines.append(line)
+                msg = email.message_from_bytes(b''.join(lines))
+                with server.lock:
+                    server.messages.append((rcpts, msg))
+                self.reply('250 queued')
+            elif verb == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+@pytest.fixture
+def smtp_server():
+    server = SMTPStandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.drop()
+    server.shutdown()
+    server.server_close()
+
+
+def archive_sql(rollups=True):
+    "schema SQL for an archive database"
+    sql = [schema.pvdat_init_pv] + schema.data_table_sql()
+    if rollups:
+        sql.extend(schema.rollup_sql())
+    return '\n'.join(sql)
+
+def add_archive_pvs(db, pvs):
+    """add PVs to the pv table of an archive database, from a list of
+    (name, type) or dicts of pv table columns"""
+    for pv in pvs:
+        if not isinstance(pv, dict):
+            pv = {'name': pv[0], 'type': pv[1]}
+        pv = dict(pv)
+        idat = len(db.get_rows('pv')) % schema.NDATA_TABLES + 1
+        pv.setdefault('data_table', schema.data_table_name(pv['type'], idat))
+        db.insert('pv', **pv)
+
+@pytest.fixture
+def make_archiver(config):
+    """function making an Archiver (without a Cache) for an archive
+    database, with log messages kept in its 'logged' list"""
+    def make(db, **attrs):
+        arch = Archiver.__new__(Archiver)
+        arch.config = config
+        arch.logged = []
+        arch.log = lambda msg, level='info': arch.logged.append((level, msg))
+        arch.dbname = db.dbname
+        arch.db = db
+        arch.typed = schema.is_typed(db.tables)
+        arch.dtime_limbo = {}
+        arch.capture_pvs = set()
+        arch.insert_stmts = {}
+        arch.batch_size = 100
+        arch.rollups = True
+        arch.spool = None
+        arch.pvinfo = {}
+        arch.pvnames = {}
+        arch.door_held = {}
+        arch.state = PVState()
+        arch.reset_stats()
+        for key, val in attrs.items():
+            setattr(arch, key, val)
+        for row in db.get_rows('pv'):
+            arch.set_pvinfo(row)
+        return arch
+    return make
+
+@pytest.fixture
+def make_cache(config):
+    """function making a Cache (not connecting to PVs) for a cache
+    database, with log messages kept in its 'logged' list"""
+    def make(db, **attrs):
+        cache = Cache.__new__(Cache)
+        cache.config = config
+        cache.logged = []
+        cache.log = lambda msg, level='info': cache.logged.append((level, msg))
+        cache.db, cache.tables = db, db.tables
+        cache.registry = PVRegistry(db)
+        cache.pvtypes, cache.pvids = cache.registry.types, cache.registry.ids
+        cache.pvs, cache.data = {}, {}
+        cache.data_cond = threading.Condition()
+        cache.alert_engine = AlertEngine([])
+        cache.shm_writer = None
+        cache.batch_size = 5000
+        cache.seq = 0
+        cache.reset_stats()
+        for key, val in attrs.items():
+            setattr(cache, key, val)
+        cache.registry.reload()
+        return cache
+    return make
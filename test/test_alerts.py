@@ -0,0 +1,78 @@
+import operator
+import itertools
+
+import numpy as np
+
+from epicsarchiver.alerts import AlertEngine, OPCODES
+
+PYOPS = {'eq': operator.eq, 'ne': operator.ne, 'le': operator.le,
+         'lt': operator.lt, 'ge': operator.ge, 'gt': operator.gt}
+
+def make_alert(aid, pvname, compare, trippoint, status='ok', timeout=30,
+               active='yes'):
+    return {'id': aid, 'pvname': pvname, 'name': f'alert {aid}',
+            'mailto': 'a@b.c', 'mailmsg': '', 'compare': compare,
+            'trippoint': trippoint, 'timeout': timeout, 'status': status,
+            'active': active}
+
+def test_numeric_operators_match_scalar_compare():
+    trips = (-1.0, 0.0, 2.5)
+    alerts = [make_alert(i, f'PV:{i}', op, str(trip)) for i, (op, trip)
+              in enumerate(itertools.product(OPCODES, trips), start=1)]
+    for value in (-3, -1.0, 0, 1.25, 2.5, 7):
+        engine = AlertEngine(alerts)
+        values = {a['pvname']: value for a in alerts}
+        transitions, notices = engine.evaluate(values, now=1000.0)
+        alarms = {alert['id'] for alert, val, status in transitions
+                  if status == 'alarm'}
+        expected = {a['id'] for a in alerts
+                    if PYOPS[a['compare']](float(value), float(a['trippoint']))}
+        assert alarms == expected
+        assert {alert['id'] for alert, val in notices} == expected
+
+def test_string_values_compare_as_strings():
+    alerts = [make_alert(1, 'PV:mode', 'eq', 'Closed'),
+              make_alert(2, 'PV:mode', 'ne', b'Open'),
+              make_alert(3, 'PV:num', 'gt', '10')]
+    engine = AlertEngine(alerts)
+    transitions, _ = engine.evaluate({'PV:mode': 'Closed', 'PV:num': 'abc'})
+    assert sorted((a['id'], s) for a, v, s in transitions) == [(1, 'alarm'),
+                                                               (2, 'alarm'),
+                                                               (3, 'alarm')]
+
+def test_only_transitions_reported():
+    engine = AlertEngine([make_alert(1, 'PV:a', 'gt', '5')])
+    assert engine.evaluate({'PV:a': 1.0}, now=1010.0) == ([], [])
+    transitions, notices = engine.evaluate({'PV:a': 6.0}, now=1020.0)
+    assert [(v, s) for a, v, s in transitions] == [(6.0, 'alarm')]
+    assert len(notices) == 1
+    assert engine.evaluate({'PV:a': 7.0}, now=1030.0) == ([], [])
+    transitions, notices = engine.evaluate({'PV:a': 2.0}, now=1040.0)
+    assert [(v, s) for a, v, s in transitions] == [(2.0, 'ok')]
+    assert notices == []
+    assert engine.alerts[0]['status'] == 'ok'
+
+def test_notice_timeout_and_previous_engine():
+    alert = make_alert(1, 'PV:a', 'gt', '5', timeout=100)
+    engine = AlertEngine([alert])
+    assert len(engine.evaluate({'PV:a': 6}, now=1000.0)[1]) == 1
+    engine.evaluate({'PV:a': 0}, now=1010.0)
+    transitions, notices = engine.evaluate({'PV:a': 6}, now=1050.0)
+    assert len(transitions) == 1 and notices == []
+
+    # a recompiled engine keeps the time of the last notice
+    renewed = AlertEngine([dict(alert, status='ok')], previous=engine)
+    assert renewed.last_notice[0] == 1000.0
+    assert renewed.evaluate({'PV:a': 6}, now=1090.0)[1] == []
+    assert len(renewed.evaluate({'PV:a': 0, 'PV:b': 1}, now=1095.0)[0]) == 1
+    assert len(renewed.evaluate({'PV:a': 6}, now=1101.0)[1]) == 1
+
+def test_inactive_and_unknown_pvs_ignored():
+    engine = AlertEngine([make_alert(1, 'PV:a', 'gt', '5', active='no'),
+                          make_alert(2, 'PV:b', 'lt', 'nan')])
+    assert 'PV:a' not in engine
+    assert 'PV:b' in engine
+    assert engine.evaluate({'PV:a': 10, 'PV:c': 10}) == ([], [])
+    # an alert on a numeric value with no numeric trip point compares strings
+    transitions, _ = engine.evaluate({'PV:b': np.float64(1.0)})
+    assert [(a['id'], s) for a, v, s in transitions] == [(2, 'alarm')]
@@ -0,0 +1,120 @@
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from sqlalchemy import text, inspect
+
+from epicsarchiver import schema
+from epicsarchiver.shmcache import CacheRow
+from conftest import archive_sql, add_archive_pvs
+
+class CacheFeed:
+    "stands in for Cache, feeding rows to Archiver.collect()"
+    def __init__(self):
+        self.rows = []
+        self.seq = 0
+
+    def put(self, pvname, value, ts):
+        self.seq += 1
+        self.rows.append(CacheRow(0, pvname, 'double', str(value), str(value),
+                                  ts, 'yes', self.seq))
+
+    def changes_since(self, seq):
+        "latest row for each PV changed since seq"
+        rows = {row.pvname: row for row in self.rows if row.seq > seq}
+        return list(rows.values()), self.seq
+
+    def get_full_many(self, pvnames):
+        return {}
+
+def archived_values(db, arch, pvname):
+    info = arch.pvinfo[pvname]
+    rows = db.get_rows(info['data_table'], where={'pv_id': info['id']},
+                       order_by='time')
+    return [(row.time, row.value) for row in rows]
+
+def test_collect_archives_held_values(make_db, make_archiver):
+    db = make_db('arch_1', archive_sql())
+    add_archive_pvs(db, [{'name': 'PV:door.VAL', 'type': 'double', 'deadtime': 0,
+                          'compression': 'swinging_door', 'tolerance': 0.1}])
+    cache = CacheFeed()
+    arch = make_archiver(db, cache=cache, last_seq=0, force_checktime=np.inf)
+    arch.state.max_hold = 0.5
+    pvname = 'PV:door.VAL'
+
+    t0 = time.time()
+    for dt, val in ((0, 1.0), (0.01, 1.0), (0.02, 1.02)):
+        cache.put(pvname, val, t0 + dt)
+        arch.collect()
+    assert archived_values(db, arch, pvname) == [(t0, 1.0)]
+    assert pvname in arch.door_held
+
+    # held for longer than max_hold: archived with the next pass
+    time.sleep(0.6)
+    arch.collect()
+    assert archived_values(db, arch, pvname) == [(t0, 1.0), (t0 + 0.02, 1.02)]
+    assert pvname not in arch.door_held
+    arch.collect()
+    assert len(archived_values(db, arch, pvname)) == 2
+
+@pytest.fixture
+def migrate_db(make_db, make_archiver, sqlite_ddl):
+    "archive database with two data tables, and its Archiver"
+    sql = [schema.pvdat_init_pv] + [schema.data_table_create(name)
+                                    for name in ('pvdbl001', 'pvdat002')]
+    db = make_db('arch_1', '\n'.join(sql))
+    add_archive_pvs(db, [{'name': 'PV:a.VAL', 'type': 'double', 'data_table': 'pvdbl001'},
+                         {'name': 'PV:b.VAL', 'type': 'double', 'data_table': 'pvdbl001'},
+                         {'name': 'PV:s.VAL', 'type': 'string', 'data_table': 'pvdat002'}])
+    cachedb = make_db('cache', schema.create_cachedb.format(cache_db='cache'))
+    arch = make_archiver(db, cache=SimpleNamespace(db=cachedb), rollups=False)
+    rows = {}
+    for name, info in arch.pvinfo.items():
+        for i in range(10 if name == 'PV:b.VAL' else 25):
+            rows.setdefault(info['data_table'], []).append(
+                {'pv_id': info['id'], 'time': 1000.0 + i, 'value': f'{i}'})
+    arch.write_rows(rows)
+    return db, arch
+
+def table_values(db, tabname):
+    rows = db.execute(text(f"select pv_id, time, value from {tabname}")).fetchall()
+    return sorted(tuple(row) for row in rows)
+
+def table_names(db):
+    return sorted(inspect(db.engine).get_table_names())
+
+def test_migrate_keeps_values_written_during_copy(migrate_db):
+    db, arch = migrate_db
+    before = {tab: table_values(db, tab) for tab in ('pvdbl001', 'pvdat002')}
+    copy = arch._copy_pv_values
+    late = []
+    def copy_and_write(execute, tabname, *args):
+        # values written while the copy runs, with times older than values copied
+        if tabname == 'pvdbl001' and len(late) == 0:
+            late.extend([(1, 1000.5, 7.0), (2, 900.0, 8.0), (1, 2000.0, 9.0)])
+            arch.write_rows({tabname: [{'pv_id': p, 'time': t, 'value': v}
+                                       for p, t, v in late]})
+        return copy(execute, tabname, *args)
+    arch._copy_pv_values = copy_and_write
+    arch.migrate_archive(chunk=4)
+    assert table_names(db) == ['pv', 'pvdat002', 'pvdbl001']
+    assert table_values(db, 'pvdbl001') == sorted(before['pvdbl001'] + late)
+    assert table_values(db, 'pvdat002') == before['pvdat002']
+    # values are written to the new tables
+    arch.write_rows({'pvdbl001': [{'pv_id': 2, 'time': 3000.0, 'value': 1.0}]})
+    assert (2, 3000.0, 1.0) in table_values(db, 'pvdbl001')
+
+def test_migrate_keeps_old_table_if_counts_differ(migrate_db):
+    db, arch = migrate_db
+    copy = arch._copy_pv_values
+    def copy_and_write(execute, tabname, newtab, delta, pvid, chunk):
+        # a second value for a time already in the table, before it is copied
+        if tabname == 'pvdbl001' and pvid == 1:
+            arch.write_rows({tabname: [{'pv_id': 2, 'time': 1003.0, 'value': 3.0}]})
+        return copy(execute, tabname, newtab, delta, pvid, chunk)
+    arch._copy_pv_values = copy_and_write
+    arch.migrate_archive(chunk=4)
+    assert table_names(db) == ['pv', 'pvdat002', 'pvdbl001', 'pvdbl001_delta',
+                               'pvdbl001_old']
+    assert len(table_values(db, 'pvdbl001_old')) == 36
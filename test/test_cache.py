@@ -0,0 +1,60 @@
+import time
+from decimal import Decimal
+
+from epicsarchiver import schema
+
+def cache_values(db):
+    "dict of pvname: (value, seq) of the cache table, with values as str"
+    out = {}
+    for row in db.get_rows('cache'):
+        value = row.value.decode() if isinstance(row.value, bytes) else row.value
+        out[row.pvname] = (value, row.seq)
+    return out
+
+def test_update_cache(make_db, make_cache):
+    db = make_db('cache', schema.create_cachedb.format(cache_db='cache'))
+    for i in range(1, 12):
+        db.insert('cache', pvname=f'PV:{i}.VAL', type='double', value='0',
+                  cvalue='0', ts=0)
+    cache = make_cache(db, batch_size=4)
+    nbatch = []
+    update_many = db.update_many
+    def counted(*args, **kws):
+        nbatch.append(update_many(*args, **kws))
+        return nbatch[-1]
+    db.update_many = counted
+
+    # a PV added since the registry was read is updated by pvname
+    db.insert('cache', pvname='PV:new.VAL', type='double', value='0', cvalue='0', ts=0)
+    # a PV dropped while its values were pending is not re-created
+    db.delete_rows('cache', where={'pvname': 'PV:3.VAL'})
+    tnow = time.time()
+    names = [f'PV:{i}.VAL' for i in range(1, 12)] + ['PV:new.VAL']
+    cache.data = {name: (i+0.5, f'{i+0.5}', tnow, time.monotonic())
+                  for i, name in enumerate(names)}
+    assert cache.update_cache() == 12
+    assert cache.data == {}
+
+    found = cache_values(db)
+    assert 'PV:3.VAL' not in found
+    assert found['PV:new.VAL'] == ('11.5', 12)
+    assert found['PV:1.VAL'] == ('0.5', 1) and found['PV:11.VAL'] == ('10.5', 11)
+    assert cache.seq == 12
+    # 11 rows in chunks of at most 4 rows
+    assert nbatch == [3]
+    assert cache.stats['batches'] == 4 and cache.stats['rows'] == 12
+    row = db.get_rows('cache', where={'pvname': 'PV:5.VAL'}, limit_one=True)
+    assert abs(float(row.ts) - tnow) < 1.e-3 and row.cvalue == b'4.5000'
+
+def test_update_many_sizes(make_db):
+    db = make_db('cache', schema.create_cachedb.format(cache_db='cache'))
+    for i in range(1, 40):
+        db.insert('cache', pvname=f'PV:{i}', value='0', cvalue='0', ts=0)
+    for nrows in (1, 2, 3, 7, 17, 39):
+        rows = [{'id': i, 'value': f'{nrows}', 'cvalue': 'x', 'ts': Decimal(nrows),
+                 'seq': nrows} for i in range(1, nrows+1)]
+        rows.append({'id': 1000, 'value': 'none', 'cvalue': 'x', 'ts': 0, 'seq': 0})
+        db.update_many('cache', rows, ('value', 'cvalue', 'ts', 'seq'), chunksize=10)
+        found = cache_values(db)
+        assert all(found[f'PV:{i}'] == (f'{nrows}', nrows) for i in range(1, nrows+1))
+        assert len(found) == 39
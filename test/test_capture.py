@@ -0,0 +1,85 @@
+from threading import Condition
+
+from sqlalchemy import text
+
+from epicsarchiver import schema
+from epicsarchiver import cache as cache_module
+from epicsarchiver.cache import Cache
+from epicsarchiver.capture import RingBuffer
+from epicsarchiver.spool import Spool, HELD_DIR
+from conftest import archive_sql, add_archive_pvs
+
+def capture_cache(make_db, config, tmp_path):
+    "Cache with capture buffers for PVs of an archive database"
+    config.archive_spool_dir = str(tmp_path / 'spool')
+    arch = make_db('arch_1', archive_sql())
+    add_archive_pvs(arch, [('PV:a.VAL', 'double'), ('PV:b.VAL', 'int')])
+    cachedb = make_db('cache', schema.create_cachedb.format(cache_db='cache'))
+    cachedb.execute(text(f"update info set db='{arch.dbname}' where process='archive'"))
+    cache = Cache.__new__(Cache)
+    cache.config = config
+    cache.db = cachedb
+    cache.tables = cachedb.tables
+    cache.data_cond = Condition()
+    cache.capture = {'PV:a.VAL': RingBuffer(16), 'PV:b.VAL': RingBuffer(16)}
+    cache.capture_pending = {}
+    cache.archdb = None
+    cache.archive_pvinfo = {}
+    cache.logged = []
+    cache.log = lambda msg, level='info': cache.logged.append((level, msg))
+    return cache, arch
+
+def archived(arch):
+    out = []
+    for row in arch.get_rows('pv'):
+        out.extend((row.name, r.time, float(r.value))
+                   for r in arch.get_rows(row.data_table, where={'pv_id': row.id}))
+    return sorted(out)
+
+def capture(cache, t0, n):
+    expected = []
+    for i in range(n):
+        for pvname, buf in cache.capture.items():
+            buf.append(t0 + i, i)
+            expected.append((pvname, t0 + i, float(i)))
+    return expected
+
+def test_captures_kept_when_write_fails(make_db, config, tmp_path, monkeypatch):
+    cache, arch = capture_cache(make_db, config, tmp_path)
+    update_rollups = cache_module.update_rollups
+    def down(*args):
+        raise IOError('database is down')
+    monkeypatch.setattr(cache_module, 'update_rollups', down)
+    expected = capture(cache, 1000.0, 5)
+    assert cache.drain_captures() == 0
+    assert archived(arch) == []
+    assert cache.logged[-1][0] == 'warn' and 'keeping 10' in cache.logged[-1][1]
+
+    # values captured during the outage are written with the next drain
+    expected += capture(cache, 1005.0, 3)
+    monkeypatch.setattr(cache_module, 'update_rollups', update_rollups)
+    assert cache.drain_captures() == 16
+    assert archived(arch) == sorted(expected)
+    assert cache.capture_pending == {}
+    assert cache.drain_captures() == 0
+
+def test_captures_set_aside_when_stopping(make_db, make_archiver, config, tmp_path,
+                                          monkeypatch):
+    cache, arch = capture_cache(make_db, config, tmp_path)
+    expected = capture(cache, 1000.0, 2)
+    assert cache.drain_captures() == 4
+    def down(*args):
+        raise IOError('database is down')
+    monkeypatch.setattr(cache_module, 'update_rollups', down)
+    expected += capture(cache, 1002.0, 3)
+    assert cache.drain_captures(final=True) == 0
+    assert cache.capture_pending == {}
+    assert len(list((tmp_path / 'spool' / HELD_DIR).glob('*.seg'))) == 1
+
+    # the archiver replays set aside values
+    monkeypatch.undo()
+    archiver = make_archiver(arch)
+    archiver.spool = Spool(config.archive_spool_dir, arch.dbname, ack_interval=0)
+    assert archiver.spool.restore_held() == 1
+    assert archiver.replay_spool() == 6
+    assert archived(arch) == sorted(expected)
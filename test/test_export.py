@@ -0,0 +1,122 @@
+import os
+import time
+
+import numpy as np
+import pytest
+import zarr
+
+from epicsarchiver import schema
+from epicsarchiver import archiver as archiver_module
+from epicsarchiver.export import ZarrSidecar
+from epicsarchiver.zarrstore import open_sidecar, write_arrays, append_series
+from conftest import archive_sql, add_archive_pvs
+
+def test_append_series_after_checkpoint(tmp_path):
+    "values past the checkpoint, as left by an interrupted export, are replaced"
+    store = open_sidecar(str(tmp_path / 'side.sqlite'))
+    grp = zarr.open_group(store=store, mode='a').create_group('pv')
+    times = np.arange(100.0)
+    write_arrays(grp, times[:30], times[:30], chunk_size=8)
+    # values 30 to 39 written by an export interrupted before its checkpoint
+    append_series(grp, times[30:40], times[30:40])
+    assert append_series(grp, times[20:], times[20:], after=29.5) == 70
+    assert (grp['ts'][()] == times).all() and (grp['data'][()] == times).all()
+    tindex = grp['tindex'][()]
+    assert len(tindex) == 13
+    assert (tindex[:, 0] == times[::8]).all()
+    assert tindex[-1, 1] == 99.0
+    store.close()
+
+@pytest.fixture
+def export_db(make_db, make_archiver, config, tmp_path):
+    "archive database with values for PVs in several data tables, and its Archiver"
+    config.zarrdir = str(tmp_path)
+    config.zarr_chunk_size = '16'
+    db = make_db('arch', archive_sql(rollups=False))
+    add_archive_pvs(db, [('PV:a.VAL', 'double'), ('PV:b.VAL', 'int'),
+                         ('PV:c.VAL', 'double'), ('PV:d.VAL', 'double')])
+    arch = make_archiver(db, rollups=False)
+    rng = np.random.default_rng(2)
+    tnow = time.time()
+    rows = {}
+    for info in arch.pvinfo.values():
+        for t in np.sort(tnow - rng.uniform(0, 3600, size=50)):
+            tab = info['data_table']
+            rows.setdefault(tab, []).append(
+                {'pv_id': info['id'], 'time': float(t),
+                 'value': schema.data_value(tab, rng.normal()*100)})
+    arch.write_rows(rows)
+    return db, arch
+
+def db_values(db):
+    "dict of {pvname: (times, values)} of an archive database"
+    out = {}
+    for pvrow in db.get_rows('pv'):
+        rows = db.get_rows(pvrow.data_table, where={'pv_id': pvrow.id}, order_by='time')
+        out[pvrow.name] = (np.array([r.time for r in rows]),
+                           np.array([float(r.value) for r in rows]))
+    return out
+
+def zip_values(fname):
+    store = zarr.ZipStore(fname, mode='r')
+    zpv = zarr.open_group(store=store, mode='r')['pvarch']
+    out = {name: (grp['ts'][()], grp['data'][()]) for name, grp in zpv.groups()}
+    store.close()
+    return out
+
+def check_export(db):
+    zfile = f'{db.dbname}_zarr.zip'
+    found = zip_values(zfile)
+    expected = db_values(db)
+    assert sorted(found) == sorted(expected)
+    for name, (times, values) in expected.items():
+        assert np.allclose(found[name][0], times, rtol=0, atol=1.e-6)
+        assert np.allclose(found[name][1], values)
+
+def test_export_resumes_after_interruption(export_db, monkeypatch):
+    db, arch = export_db
+    ntables = len({info['data_table'] for info in arch.pvinfo.values()})
+    assert ntables > 2
+    write_table = ZarrSidecar.write_table
+    done = []
+    def interrupted(self, pvrows, *args):
+        if len(done) == 2:
+            raise KeyboardInterrupt
+        write_table(self, pvrows, *args)
+        done.append(pvrows[0].data_table)
+    monkeypatch.setattr(ZarrSidecar, 'write_table', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        arch.save_zarr(dbname=db.dbname, install=True, workers=1)
+
+    # resumed export reads only the tables not yet exported
+    monkeypatch.setattr(ZarrSidecar, 'write_table', write_table)
+    read_tables = archiver_module.read_tables
+    tables = []
+    def tracked(dbname, config, tabnames, **kws):
+        tables.extend(tabnames)
+        return read_tables(dbname, config, tabnames, **kws)
+    monkeypatch.setattr(archiver_module, 'read_tables', tracked)
+    arch.save_zarr(dbname=db.dbname, install=True, workers=1)
+    assert len(tables) == ntables - 2
+    assert not set(tables) & set(done)
+    check_export(db)
+
+def test_live_export_continued(export_db, config):
+    db, arch = export_db
+    config.zarr_live_lag = '1800'
+    arch.save_zarr(dbname=db.dbname, live=True, workers=1)
+    sidecar = ZarrSidecar(f'{db.dbname}_zarr.sqlite')
+    checkpoints = sidecar.checkpoints()
+    sidecar.close()
+    assert sorted(checkpoints) == sorted(arch.pvinfo)
+    tlive = min(checkpoints.values())
+
+    # a late value before the checkpoint (as replayed from the spool),
+    # and a new value after it
+    info = arch.pvinfo['PV:a.VAL']
+    arch.write_rows({info['data_table']: [
+        {'pv_id': info['id'], 'time': tlive - 10.0, 'value': 1.5},
+        {'pv_id': info['id'], 'time': time.time(), 'value': 2.5}]})
+    arch.save_zarr(dbname=db.dbname, workers=1)
+    check_export(db)
+    assert not os.path.exists(f'{db.dbname}_zarr.sqlite')
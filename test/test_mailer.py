@@ -0,0 +1,123 @@
+import time
+
+from epicsarchiver.mailer import AlertMailer
+
+def make_mailer(server, config, **kws):
+    opts = {'mail_server': '127.0.0.1', 'mail_port': str(server.port),
+            'mail_from': 'pvarch@localhost', 'mail_queue_size': '100',
+            'mail_digest_time': '0.5', 'mail_retries': '2', 'mail_timeout': '5'}
+    opts.update(kws)
+    for key, val in opts.items():
+        setattr(config, key, val)
+    return AlertMailer(config, log=lambda msg, level='info': None)
+
+def wait_for(test, timeout=5.0):
+    t0 = time.time()
+    while not test():
+        assert time.time() < t0 + timeout
+        time.sleep(0.01)
+
+def test_digest_per_recipient(smtp_server, config):
+    mailer = make_mailer(smtp_server, config)
+    for i in range(3):
+        assert mailer.submit('a@localhost', f'alert {i}', f'value {i}')
+    assert mailer.submit('b@localhost', 'alert b', 'value b')
+    mailer.start()
+    try:
+        wait_for(lambda: len(smtp_server.messages) == 2)
+        mails = {rcpts[0]: msg for rcpts, msg in smtp_server.messages}
+        assert mails['a@localhost']['Subject'] == '[Epics Alert] 3 alerts'
+        body = mails['a@localhost'].get_payload()
+        assert all(f'value {i}' in body for i in range(3))
+        assert mails['b@localhost']['Subject'] == 'alert b'
+
+        # within the digest time, mail to a recipient is held
+        tsent = mailer.last_sent['a@localhost']
+        mailer.submit('a@localhost', 'alert 4', 'value 4')
+        wait_for(lambda: len(smtp_server.messages) == 3)
+        assert time.time() >= tsent + 0.5
+    finally:
+        mailer.stop()
+    assert mailer.stats['sent'] == 5
+    assert mailer.stats['mails'] == 3
+    assert mailer.stats['digests'] == 1
+    assert mailer.depth == 0
+
+def test_stop_flushes_held_mail(smtp_server, config):
+    mailer = make_mailer(smtp_server, config, mail_digest_time='600')
+    mailer.last_sent['a@localhost'] = time.time()
+    mailer.start()
+    mailer.submit('a@localhost', 'alert', 'value')
+    time.sleep(0.1)
+    assert smtp_server.messages == []
+    mailer.stop()
+    assert len(smtp_server.messages) == 1
+
+def test_reconnect_after_idle_disconnect(smtp_server, config):
+    mailer = make_mailer(smtp_server, config)
+    msgs = [('alert', 'value', time.time())]
+    assert mailer.send('a@localhost', msgs)
+    assert mailer.send('a@localhost', msgs)
+    assert smtp_server.connections == 1
+
+    smtp_server.drop()
+    assert mailer.send('a@localhost', msgs)
+    assert smtp_server.connections == 2
+    assert len(smtp_server.messages) == 3
+    mailer.disconnect()
+
+def test_retry_with_backoff(smtp_server, config):
+    mailer = make_mailer(smtp_server, config)
+    mailer.submit('a@localhost', 'alert', 'value')
+    mailer.pending['a@localhost'] = [mailer.queue.get_nowait()[1:]]
+    mailer.nheld = 1
+
+    # each send tries twice (reconnecting once) before counting as failed
+    smtp_server.fail_mail = 4
+    t0 = time.time()
+    mailer.deliver()
+    assert mailer.attempts['a@localhost'] == 1
+    assert 2.0 <= mailer.retry_at['a@localhost'] - t0 < 3.0
+    mailer.deliver()
+    assert mailer.attempts['a@localhost'] == 1
+
+    mailer.retry_at['a@localhost'] = t0 = time.time()
+    mailer.deliver()
+    assert mailer.attempts['a@localhost'] == 2
+    assert 4.0 <= mailer.retry_at['a@localhost'] - t0 < 5.0
+    assert smtp_server.messages == []
+
+    mailer.retry_at['a@localhost'] = time.time()
+    mailer.deliver()
+    assert len(smtp_server.messages) == 1
+    assert mailer.stats['retries'] == 2
+    assert mailer.stats['sent'] == 1
+    assert 'a@localhost' not in mailer.retry_at
+    assert mailer.depth == 0
+    mailer.disconnect()
+
+def test_give_up_after_retries(smtp_server, config):
+    mailer = make_mailer(smtp_server, config, mail_retries='1')
+    mailer.pending['a@localhost'] = [('alert', 'value', time.time())]
+    mailer.nheld = 1
+    smtp_server.fail_mail = 100
+    mailer.deliver()
+    mailer.retry_at['a@localhost'] = time.time()
+    mailer.deliver()
+    assert mailer.stats['failed'] == 1
+    assert mailer.depth == 0
+    assert 'a@localhost' not in mailer.pending
+    mailer.disconnect()
+
+def test_drop_when_queue_full(smtp_server, config):
+    mailer = make_mailer(smtp_server, config, mail_queue_size='2')
+    assert mailer.submit('a@localhost', 'alert 1', 'value')
+    assert mailer.submit('a@localhost', 'alert 2', 'value')
+    assert not mailer.submit('a@localhost', 'alert 3', 'value')
+    assert not mailer.submit(' \r\n', 'alert 4', 'value')
+    assert mailer.stats['dropped'] == 1
+    assert mailer.stats['submitted'] == 2
+    assert mailer.depth == 2
+    mailer.start()
+    mailer.stop()
+    assert [msg['Subject'] for rcpts, msg in smtp_server.messages] == ['[Epics Alert] 2 alerts']
@@ -0,0 +1,46 @@
+import atexit
+
+from epicsarchiver import schema
+from epicsarchiver.pairs import PairGraph
+
+def pairs_db(make_db):
+    db = make_db('cache', schema.create_cachedb.format(cache_db='cache'))
+    db.insert_many('pairs', [{'pv1': 'PV:a', 'pv2': 'PV:b', 'score': 5},
+                             {'pv1': 'PV:c', 'pv2': 'PV:a', 'score': 7},
+                             {'pv1': 'PV:a', 'pv2': 'PV:c', 'score': 3}])
+    return db
+
+def table_scores(db):
+    rows = db.execute(db.tables['pairs'].select()).fetchall()
+    return sorted((row.pv1, row.pv2, row.score) for row in rows)
+
+def test_readers_start_no_thread(make_db, monkeypatch):
+    registered = []
+    monkeypatch.setattr(atexit, 'register', registered.append)
+    graph = PairGraph(pairs_db(make_db), flush_period=600)
+    assert graph.related('PV:a') == {'PV:c': 7, 'PV:b': 5}
+    assert graph.get_score('PV:b', 'PV:a') == 5
+    assert graph.thread is None
+    assert registered == []
+
+    graph.update('PV:a', 'PV:b', increment=1)
+    graph.update('PV:a', 'PV:d', minscore=10)
+    assert graph.thread.is_alive()
+    assert registered == [graph.flush]
+
+def test_flush_merges_changes(make_db, monkeypatch):
+    monkeypatch.setattr(atexit, 'register', lambda func: None)
+    db = pairs_db(make_db)
+    graph = PairGraph(db, flush_period=600)
+    other = PairGraph(db, flush_period=600)
+    graph.update('PV:b', 'PV:a', increment=2)
+    graph.update('PV:a', 'PV:d', minscore=10)
+    other.update('PV:a', 'PV:b', increment=1)
+    assert graph.get_score('PV:a', 'PV:b') == 7
+    assert other.flush() == 1
+    assert graph.flush() == 2
+    assert graph.flush() == 0
+    assert ('PV:a', 'PV:b', 8) in table_scores(db)
+    assert ('PV:a', 'PV:d', 10) in table_scores(db)
+    graph.load()
+    assert graph.related('PV:a', limit=2) == {'PV:d': 10, 'PV:b': 8}
@@ -0,0 +1,130 @@
+import numpy as np
+
+from epicsarchiver.pvstate import PVState, DEADBAND
+
+def old_decide(info, ts, value, is_double):
+    """per-PV decision of earlier versions of Archiver.collect():
+    returns (save, limbo)"""
+    do_save = ts > float(info['last_ts']) + float(info['deadtime'])
+    if do_save and is_double:
+        try:
+            v, o = float(value), float(info['last_value'])
+            do_save = abs(v - o) > abs(info['deadband'])
+        except (TypeError, ValueError):
+            do_save = True
+    limbo = not do_save and ts > (0.001 + float(info['last_ts']))
+    return do_save, limbo
+
+def test_decide_matches_per_pv_logic():
+    rng = np.random.default_rng(7)
+    npvs = 40
+    state = PVState(size=8)
+    info = {}
+    for pvid in range(1, npvs+1):
+        deadtime = rng.choice([0.0, 0.5, 2.0])
+        deadband = rng.choice([0.0, 0.01, 0.2])
+        dtype = 'double' if pvid % 4 else 'string'
+        state.configure(pvid, deadtime, deadband, dtype, 'yes')
+        info[pvid] = {'last_ts': 0.0, 'deadtime': deadtime, 'deadband': deadband,
+                      'last_value': None, 'dtype': dtype}
+    assert (state.policy[1:npvs+1] == DEADBAND).all()
+
+    tnow = 1000.0
+    for step in range(200):
+        tnow += rng.uniform(0.05, 0.5)
+        ids = rng.choice(np.arange(1, npvs+1), size=10, replace=False)
+        ts = tnow + rng.uniform(-0.02, 0, size=len(ids))
+        values = np.round(rng.normal(size=len(ids))*0.1, 3)
+        strvals = [str(v) for v in values]
+        for j in np.where(rng.random(len(ids)) < 0.05)[0]:
+            strvals[j] = 'not a number'
+            values[j] = np.nan
+        save, limbo, held = state.decide(ids, ts, values)
+        assert not held.any()
+        for j, pvid in enumerate(ids):
+            is_double = info[pvid]['dtype'] == 'double'
+            assert (save[j], limbo[j]) == old_decide(info[pvid], ts[j], strvals[j],
+                                                     is_double)
+        state.archived(ids[save], ts[save], values[save])
+        for j in np.where(save)[0]:
+            info[ids[j]]['last_ts'] = ts[j]
+            info[ids[j]]['last_value'] = strvals[j]
+
+def test_limbo_released_after_deadtime():
+    state = PVState()
+    state.configure(3, 5.0, 0.0, 'double', 'yes')
+    state.archived(np.array([3]), np.array([100.0]), np.array([1.0]))
+    save, limbo, _ = state.decide(np.array([3]), np.array([101.0]), np.array([2.0]))
+    assert not save[0] and limbo[0]
+    state.add_limbo(np.array([3]))
+    state.add_limbo(np.array([3]))
+    assert len(state.limbo_heap) == 1
+    assert state.due_limbo(104.0) == []
+    # archived again in the meantime: the release moves later
+    state.archived(np.array([3]), np.array([102.0]), np.array([2.0]))
+    assert state.due_limbo(106.0) == []
+    assert state.due_limbo(107.5) == [3]
+    assert state.due_limbo(200.0) == []
+
+def test_forced_writes_scheduled():
+    state = PVState(first_force=10.0)
+    for pvid in (1, 2):
+        state.configure(pvid, 1.0, 0.0, 'double', 'yes')
+    t0 = state.force_at[1:3].max()
+    assert sorted(state.due_forced(t0 + 1)) == [1, 2]
+    assert state.due_forced(t0 + 2) == []
+    # archiving a value pushes the next forced write later
+    state.archived(np.array([1]), np.array([t0 + 2]), np.array([0.0]))
+    assert state.force_at[1] > t0 + 3600
+
+def door_archive(state, pvid, times, values, tnow_lag=None):
+    """archived points for values fed one at a time, with swinging door
+    compression, archiving held values when due if tnow_lag is given"""
+    out = []
+    held = None
+    for t, v in zip(times, values):
+        if tnow_lag is not None:
+            for _ in state.due_held(t + tnow_lag):
+                out.append(held)
+        ids = np.array([pvid])
+        save, limbo, hold = state.decide(ids, np.array([t]), np.array([v]))
+        assert not limbo[0]
+        if hold[0]:
+            out.append(held)
+        if save[0]:
+            out.append((t, v))
+            state.archived(ids, np.array([t]), np.array([v]))
+        else:
+            held = (t, v)
+            state.add_held(ids)
+    return out
+
+def test_swinging_door_within_tolerance():
+    rng = np.random.default_rng(3)
+    state = PVState(max_hold=1.e9)
+    tol = 0.05
+    state.configure(5, 0.0, 0.0, 'double', 'yes', compression='swinging_door',
+                    tolerance=tol)
+    times = np.cumsum(rng.uniform(0.1, 1.0, size=2000))
+    values = np.sin(times/50.0) + rng.normal(size=len(times))*0.01
+    archived = door_archive(state, 5, times, values)
+    # the last value is held: archive it as if held too long
+    archived.append((times[-1], values[-1]))
+    assert len(archived) < len(times)/10
+    at, av = np.array(archived).T
+    assert (np.diff(at) > 0).all()
+    assert np.abs(np.interp(times, at, av) - values).max() <= tol + 1.e-9
+
+def test_held_value_archived_after_max_hold():
+    state = PVState(max_hold=30.0)
+    state.configure(2, 0.0, 0.0, 'double', 'yes', compression='swinging_door',
+                    tolerance=0.1)
+    times = np.array([0.0, 1.0, 2.0, 3.0, 100.0, 101.0, 102.0, 200.0])
+    values = np.array([0.0, 0.0, 0.0, 0.05, 5.0, 5.0, 5.0, 5.0])
+    archived = door_archive(state, 2, times, values, tnow_lag=0.0)
+    # the value at 3 is archived after being held for 30 sec, and starts
+    # a new segment, which is ended by the value at 102 in the same way
+    assert archived == [(0.0, 0.0), (3.0, 0.05), (102.0, 5.0)]
+    assert state.due_held(231.0) == [2]
+    assert np.isnan(state.held_v[2]) and state.door_t[2] == 200.0
+    assert state.due_held(1000.0) == []
@@ -0,0 +1,75 @@
+import pytest
+from sqlalchemy import text
+
+from epicsarchiver import schema
+from epicsarchiver.cache import PVRegistry
+
+class CountingDB:
+    "database connection counting queries on the cache table"
+    def __init__(self, db):
+        self.db = db
+        self.tables = db.tables
+        self.cache_queries = 0
+
+    def execute(self, query, **kws):
+        if 'FROM cache' in str(query):
+            self.cache_queries += 1
+        return self.db.execute(query, **kws)
+
+    def __getattr__(self, attr):
+        return getattr(self.db, attr)
+
+@pytest.fixture
+def cachedb(make_db):
+    db = make_db('cache', schema.create_cachedb.format(cache_db='cache'))
+    for i in range(1, 6):
+        db.insert('cache', pvname=f'PV:{i}.VAL', type='double', value='0',
+                  cvalue='0', ts=0, seq=i)
+    return db
+
+def test_value_writes_not_reread(cachedb):
+    db = CountingDB(cachedb)
+    registry = PVRegistry(db)
+    assert len(registry.reload()) == 5
+    nquery = db.cache_queries
+    # new values bump seq, but not the registry generation
+    for i in range(1, 6):
+        db.update('cache', where={'id': i}, value='1', seq=10+i)
+    assert registry.refresh(force=True) == []
+    assert db.cache_queries == nquery
+
+    generation = registry.next_generation()
+    db.insert('cache', pvname='PV:new.VAL', type='int', value='0', cvalue='0',
+              ts=0, regseq=generation)
+    registry.set_generation(generation)
+    assert registry.refresh(force=True) == ['PV:new.VAL']
+    assert registry.types['PV:new.VAL'] == 'int'
+    assert db.cache_queries == nquery + 1
+    assert registry.refresh(force=True) == []
+    assert db.cache_queries == nquery + 1
+
+def test_requests_seen_by_registry(cachedb, make_cache):
+    cache = make_cache(cachedb, seq=5)
+    other = PVRegistry(cachedb)
+    other.reload()
+
+    cache.pvs['PV:2.VAL'] = type('PV', (), {'clear_callbacks': lambda self: None})()
+    cachedb.insert('requests', pvname='PV:2.VAL', action='suspend')
+    cachedb.insert('requests', pvname='PV:4.VAL', action='drop')
+    cache.process_requests()
+    assert cachedb.get_rows('requests') == []
+    assert 'PV:4.VAL' not in cache.pvids and 'PV:4.VAL' not in cache.pvtypes
+
+    assert other.refresh(force=True) == []
+    assert sorted(other.ids) == ['PV:1.VAL', 'PV:2.VAL', 'PV:3.VAL', 'PV:5.VAL']
+    assert other.active['PV:2.VAL'] == 'no'
+    # the suspend did not take a sequence number of the change feed
+    assert cache.seq == 5
+
+def test_registry_row_added(cachedb, make_cache, monkeypatch):
+    "an existing cache database is given the registry info row"
+    cachedb.delete_rows('info', where={'process': 'registry'})
+    cache = make_cache(cachedb)
+    monkeypatch.setattr(cachedb, 'sql_execute', lambda sql: cachedb.execute(text(sql)))
+    cache.check_cache_schema()
+    assert cache.registry.get_generation() == (0, 0)
@@ -0,0 +1,191 @@
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from sqlalchemy import text
+
+from epicsarchiver import schema
+from epicsarchiver import cache as cache_module
+from epicsarchiver.cache import Cache
+from epicsarchiver.rollup import aggregate_records, compare_rollups, rollup_stats
+from epicsarchiver.zarrstore import level_points
+from epicsarchiver.util import DatabaseConnection, MAX_EPOCH
+from conftest import archive_sql, add_archive_pvs
+
+def one_pass(pvids, times, values, width):
+    "rollups computed value by value"
+    out = {}
+    for pvid, t, v in sorted(zip(pvids.tolist(), times.tolist(), values.tolist()),
+                             key=lambda x: x[1]):
+        key = (pvid, np.floor(t/width)*width)
+        if key not in out:
+            out[key] = {'pv_id': pvid, 'tbucket': key[1], 'n': 0, 'vmin': v, 'vmax': v,
+                        'vsum': 0.0, 'vfirst': v, 'tfirst': t}
+        r = out[key]
+        r['n'] += 1
+        r['vmin'], r['vmax'] = min(r['vmin'], v), max(r['vmax'], v)
+        r['vsum'] += v
+        r['vlast'], r['tlast'] = v, t
+    return list(out.values())
+
+def random_values(rng, npts, pvids=(1, 2, 3), t0=1.7e9, span=7200.0):
+    pvids = rng.choice(np.array(pvids), size=npts)
+    times = t0 + np.sort(rng.uniform(0, span, size=npts))
+    values = rng.normal(size=npts)
+    return pvids, times, values
+
+def test_aggregate_matches_one_pass():
+    rng = np.random.default_rng(11)
+    pvids, times, values = random_values(rng, 3000)
+    shuffle = rng.permutation(len(pvids))
+    for width in (60.0, 3600.0):
+        expected = one_pass(pvids, times, values, width)
+        found = aggregate_records(pvids[shuffle], times[shuffle], values[shuffle], width)
+        assert len(found) == len(expected)
+        assert compare_rollups(expected, found) == set()
+        assert {r['tfirst'] for r in found} == {r['tfirst'] for r in expected}
+
+def rollup_rows(db, name):
+    return [row._asdict() for row in db.get_rows(name)]
+
+def test_upsert_batches_in_any_order(make_db, make_archiver):
+    db = make_db('arch', archive_sql())
+    add_archive_pvs(db, [('PV:a.VAL', 'double'), ('PV:b.VAL', 'int'),
+                         ('PV:c.VAL', 'double')])
+    arch = make_archiver(db)
+    rng = np.random.default_rng(5)
+    pvids, times, values = random_values(rng, 2000)
+    tables = {info['id']: info['data_table'] for info in arch.pvinfo.values()}
+    order = rng.permutation(len(pvids))
+    for batch in np.array_split(order, 13):
+        rows = {}
+        for i in batch:
+            tabname = tables[pvids[i]]
+            rows.setdefault(tabname, []).append(
+                {'pv_id': int(pvids[i]), 'time': float(times[i]),
+                 'value': schema.data_value(tabname, values[i])})
+        arch.write_rows(rows)
+    # int tables hold values rounded to integers
+    ints = pvids == 2
+    values[ints] = np.round(values[ints])
+    for name, width in (('rollup_1m', 60.0), ('rollup_1h', 3600.0)):
+        expected = one_pass(pvids, times, values, width)
+        assert compare_rollups(expected, rollup_rows(db, name)) == set()
+
+@pytest.fixture
+def rollover(tmp_path, make_db, config, sqlite_ddl):
+    "Cache for a cache database and a current archive with rollups"
+    config.dat_prefix = str(tmp_path / 'pvdata')
+    config.dat_format = '%s_%.5d'
+    config.cache_db = str(tmp_path / 'cache')
+    cachedb = make_db('cache', schema_sql())
+    old = make_db('pvdata_00001', archive_sql())
+    # leave a gap in pv ids, so ids in the new database differ
+    pvtab = old.tables['pv']
+    add_archive_pvs(old, [('PV:gone.VAL', 'double'), ('PV:a.VAL', 'double'),
+                          ('PV:b.VAL', 'double')])
+    old.execute(pvtab.delete().where(pvtab.c.name == 'PV:gone.VAL'))
+    cachedb.execute(text(f"update info set db='{old.dbname}' where process='archive'"))
+    cachedb.insert('runs', db=old.dbname, notes='', start_time=time.time() - 86400,
+                   stop_time=MAX_EPOCH)
+
+    cache = Cache.__new__(Cache)
+    cache.config = config
+    cache.db = cachedb
+    cache.tables = cachedb.tables
+    cache.logged = []
+    cache.log = lambda msg, level='info': cache.logged.append((level, msg))
+    return cache, old
+
+def schema_sql():
+    return schema.create_cachedb.format(cache_db='cache')
+
+def test_next_archive_copies_open_rollups(rollover, make_archiver):
+    cache, old = rollover
+    arch = make_archiver(old)
+    tnow = time.time()
+    rows = {}
+    for name, info in arch.pvinfo.items():
+        # values of past hours, and values in buckets not yet complete
+        for t in (tnow - 4*3600, tnow - 3*3600, tnow - 0.002, tnow - 0.001):
+            rows.setdefault(info['data_table'], []).append(
+                {'pv_id': info['id'], 'time': t, 'value': t % 7})
+    arch.write_rows(rows)
+
+    dbname = cache.create_next_archive()
+    assert dbname.endswith('pvdata_00002')
+    new = DatabaseConnection(dbname, cache.config)
+    old_ids = {row.id: row.name for row in old.get_rows('pv')}
+    new_ids = {row.name: row.id for row in new.get_rows('pv')}
+    assert sorted(new_ids) == ['PV:a.VAL', 'PV:b.VAL']
+    assert set(old_ids) != set(new_ids.values())
+
+    for name, width in (('rollup_1m', 60.0), ('rollup_1h', 3600.0)):
+        tstart = np.floor(tnow/width)*width
+        expected = []
+        for row in rollup_rows(old, name):
+            if row['tbucket'] >= tstart:
+                row['pv_id'] = new_ids[old_ids[row['pv_id']]]
+                expected.append(row)
+        found = rollup_rows(new, name)
+        assert len(found) == len(expected) >= 2
+        assert compare_rollups(expected, found) == set()
+    assert cache.get_info('archive').db == dbname
+    assert [run.db for run in cache.db.get_rows('runs')] == [old.dbname, dbname]
+
+    # plots over the rollover read each bucket once, from the run it ends in
+    new_arch = make_archiver(new, cache=cache)
+    info = new_arch.pvinfo['PV:a.VAL']
+    new_arch.write_rows({info['data_table']: [{'pv_id': info['id'], 'time': tnow + 200,
+                                                'value': 3.0}]})
+    times, values = new_arch.get_data('PV:a.VAL', tmin=tnow - 5*3600, tmax=tnow + 400,
+                                      resolution=60, with_current=False, use_zarr=False)
+    raw = []
+    for db in (old, new):
+        pvrow = db.get_rows('pv', where={'name': 'PV:a.VAL'}, limit_one=True)
+        raw += [(r.time, r.value) for r in db.get_rows(pvrow.data_table,
+                                                       where={'pv_id': pvrow.id})]
+    rt, rv = np.array(raw).T
+    buckets = aggregate_records(np.ones(len(rt), dtype=np.int64), rt, rv, 60.0)
+    rows = [(b['tbucket'], b['n'], b['vmin'], b['vmax'], b['vsum'], b['vfirst'],
+             b['vlast']) for b in buckets]
+    etimes, evalues = level_points(*rollup_stats(rows), 60.0)
+    assert np.allclose(times, etimes) and np.allclose(values, evalues)
+
+    # the copied buckets are not checked against the values of the new run
+    before = rollup_rows(new, 'rollup_1m')
+    new_arch.check_rollups(dbname, rebuild=True)
+    assert compare_rollups(before, rollup_rows(new, 'rollup_1m')) == set()
+
+def test_rollup_tables_backfilled(make_db, make_archiver, sqlite_ddl):
+    "rollup tables added to an archive database hold the values archived before"
+    db = make_db('arch', archive_sql(rollups=False))
+    add_archive_pvs(db, [('PV:a.VAL', 'double'), ('PV:b.VAL', 'int')])
+    cachedb = make_db('cache', schema_sql())
+    arch = make_archiver(db, cache=SimpleNamespace(db=cachedb), rollups=False)
+    rng = np.random.default_rng(9)
+    pvids, times, values = random_values(rng, 500, pvids=(1, 2))
+    values[pvids == 2] = np.round(values[pvids == 2])
+    rows = {}
+    for pvid, t, v in zip(pvids.tolist(), times.tolist(), values.tolist()):
+        tabname = arch.pvinfo[arch.pvnames[pvid]]['data_table']
+        rows.setdefault(tabname, []).append({'pv_id': pvid, 'time': t, 'value': v})
+    arch.write_rows(rows)
+
+    arch.rollups = True
+    arch.check_pv_schema()
+    for name, width in (('rollup_1m', 60.0), ('rollup_1h', 3600.0)):
+        expected = one_pass(pvids, times, values, width)
+        assert compare_rollups(expected, rollup_rows(arch.db, name)) == set()
+
+def test_next_archive_refused_if_copy_fails(rollover, monkeypatch):
+    cache, old = rollover
+    def fail(*args, **kws):
+        raise IOError('lost connection')
+    monkeypatch.setattr(cache_module, 'copy_open_rollups', fail)
+    with pytest.raises(IOError):
+        cache.create_next_archive()
+    assert cache.get_info('archive').db == old.dbname
+    assert [run.db for run in cache.db.get_rows('runs')] == [old.dbname]
+    assert cache.logged[-1][0] == 'error'
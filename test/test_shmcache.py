@@ -0,0 +1,196 @@
+import time
+import threading
+from threading import Condition
+
+import numpy as np
+
+from epicsarchiver import schema
+from epicsarchiver.cache import Cache
+from epicsarchiver.shmcache import (SharedCacheWriter, SharedCacheReader,
+                                    CacheRow, VALUE_LEN)
+
+def cache_row(cid, pvname, value, seq=0, ts=1.e9, dtype='double'):
+    return CacheRow(cid, pvname, dtype, str(value), str(value), ts, 'yes', seq)
+
+def test_register_and_read(tmp_path):
+    fname = str(tmp_path / 'shm')
+    writer = SharedCacheWriter(fname)
+    writer.register([cache_row(1, 'PV:a', 1.5, seq=1),
+                     cache_row(5000, 'PV:b', 'x', seq=2, dtype='string')])
+    reader = SharedCacheReader.open(fname)
+    assert reader.check()
+    assert reader.seq == 2
+    row = reader.get_full('PV:b')
+    assert (row.id, row.type, row.value, row.seq) == (5000, 'string', 'x', 2)
+    assert reader.get_full('PV:c') is None
+    assert sorted(reader.get_pvnames()) == ['PV:a', 'PV:b']
+
+    # a new PV grows the file: the reader re-maps it
+    writer.register([cache_row(9000, 'PV:c', 3, seq=3)])
+    assert reader.check()
+    assert reader.get_full('PV:c').value == '3'
+    writer.close()
+    assert not reader.check()
+    reader.close()
+
+def test_changes_since(tmp_path):
+    fname = str(tmp_path / 'shm')
+    writer = SharedCacheWriter(fname)
+    writer.register([cache_row(i, f'PV:{i}', 0, seq=i) for i in range(1, 6)])
+    reader = SharedCacheReader(fname)
+    writer.write([{'id': 2, 'seq': 6, 'ts': 2.e9, 'value': 'a', 'cvalue': 'a'},
+                  {'id': 4, 'seq': 7, 'ts': 2.e9, 'value': 'b', 'cvalue': 'b'}])
+    rows, seq = reader.changes_since(5)
+    assert [(r.pvname, r.value) for r in rows] == [('PV:2', 'a'), ('PV:4', 'b')]
+    assert seq == 7
+    rows, seq = reader.changes_since(3, limit=2)
+    assert [r.seq for r in rows] == [5, 6] and seq == 6
+    assert reader.changes_since(7) == ([], 7)
+
+def test_truncated_values_fetched(tmp_path):
+    fname = str(tmp_path / 'shm')
+    long_value = 'x'*(VALUE_LEN + 10)
+    full = cache_row(3, 'PV:long', long_value, seq=1)
+    writer = SharedCacheWriter(fname)
+    writer.register([full])
+    reader = SharedCacheReader(fname, fetch=lambda ids: [full])
+    assert reader.get_full('PV:long').value == long_value
+    assert len(SharedCacheReader(fname).get_full('PV:long').value) == VALUE_LEN
+
+def test_seqlock_consistent_snapshots(tmp_path):
+    "readers never see a slot with value and cvalue from different writes"
+    fname = str(tmp_path / 'shm')
+    nslots = 64
+    writer = SharedCacheWriter(fname)
+    writer.register([cache_row(i, f'PV:{i}', 0) for i in range(1, nslots)])
+    reader = SharedCacheReader(fname)
+    ids = np.arange(1, nslots)
+    done = threading.Event()
+
+    def write():
+        i = 0
+        while not done.is_set():
+            i += 1
+            writer.write([{'id': cid, 'seq': i, 'ts': i, 'value': str(i),
+                           'cvalue': str(i)} for cid in ids])
+
+    thread = threading.Thread(target=write)
+    thread.start()
+    try:
+        t0 = time.time()
+        while time.time() < t0 + 1.0:
+            dat = reader._snapshot(ids)
+            stable = dat['wseq'] % 2 == 0
+            assert (dat['value'][stable] == dat['cvalue'][stable]).all()
+    finally:
+        done.set()
+        thread.join()
+
+def test_update_cache_publishes_all_rows(tmp_path, make_db):
+    "rows written by pvname (no cache id yet) are also published"
+    db = make_db('cache', schema.create_cachedb.format(cache_db='cache'))
+    for name in ('PV:a', 'PV:b'):
+        db.insert('cache', pvname=name, type='double', value='0', cvalue='0', ts=0)
+    fname = str(tmp_path / 'shm')
+    cache = Cache.__new__(Cache)
+    cache.db = db
+    cache.tables = db.tables
+    cache.data_cond = Condition()
+    cache.alert_engine = set()
+    cache.pvtypes = {'PV:a': 'double', 'PV:b': 'double'}
+    cache.pvids = {'PV:a': 1}
+    cache.seq = 0
+    cache.batch_size = 100
+    cache.reset_stats()
+    cache.shm_writer = SharedCacheWriter(fname)
+    cache.shm_writer.register(db.execute(db.tables['cache'].select()).fetchall())
+    reader = SharedCacheReader(fname)
+
+    now = time.time()
+    cache.data = {'PV:a': (1.0, '1', now, time.monotonic()),
+                  'PV:b': (2.0, '2', now, time.monotonic())}
+    assert cache.update_cache() == 2
+    rows, seq = reader.changes_since(0)
+    assert seq == 2
+    assert [(r.pvname, r.seq, float(r.value)) for r in rows] == [('PV:a', 1, 1.0),
+                                                                 ('PV:b', 2, 2.0)]
+    dbrows = db.execute(db.tables['cache'].select()).fetchall()
+    assert sorted((r.pvname, r.seq) for r in dbrows) == [('PV:a', 1), ('PV:b', 2)]
+
+def test_get_full_many(tmp_path, make_db):
+    db = make_db('cache', schema.create_cachedb.format(cache_db='cache'))
+    for name in ('PV:a.VAL', 'PV:b.VAL', 'PV:c.VAL'):
+        db.insert('cache', pvname=name, type='double', value=name[3],
+                  cvalue=name[3], ts=1.e9)
+    rows = db.execute(db.tables['cache'].select()).fetchall()
+    fname = str(tmp_path / 'shm')
+    writer = SharedCacheWriter(fname)
+    writer.register(rows)
+    reader = SharedCacheReader(fname)
+    found = reader.get_full_many(['PV:a.VAL', 'PV:c.VAL', 'PV:x.VAL'])
+    assert {k: v.value for k, v in found.items()} == {'PV:a.VAL': 'a', 'PV:c.VAL': 'c'}
+
+    # without shared memory, from the cache table
+    cache = Cache.__new__(Cache)
+    cache.db = db
+    cache.tables = db.tables
+    cache.shm, cache.shm_retry = None, np.inf
+    cache.pvids = {row.pvname: row.id for row in rows}
+    found = cache.get_full_many(['PV:b', 'PV:c.VAL'])
+    assert {k: v.value for k, v in found.items()} == {'PV:b': 'b', 'PV:c.VAL': 'c'}
+
+def slot_changes(reader, seq):
+    "changes since seq from a scan of all slots"
+    rows = [row for row in reader.get_values(all=True) if row.seq > seq]
+    return sorted(rows, key=lambda row: row.seq)
+
+def test_changes_from_ring(tmp_path):
+    "change records give the rows a scan of all slots would"
+    rng = np.random.default_rng(12)
+    fname = str(tmp_path / 'shm')
+    writer = SharedCacheWriter(fname, ring_size=64)
+    writer.register([cache_row(i, f'PV:{i}', 0, seq=i) for i in range(1, 41)])
+    reader = SharedCacheReader(fname)
+    seq, cursor = 40, 40
+    for step in range(30):
+        ids = rng.choice(np.arange(1, 41), size=rng.integers(1, 20), replace=False)
+        rows = []
+        for cid in ids:
+            seq += 1
+            rows.append({'id': int(cid), 'seq': seq, 'ts': 1.e9 + seq,
+                         'value': str(seq), 'cvalue': str(seq)})
+        writer.write(rows)
+        since = cursor - int(rng.integers(0, 10))
+        found, top = reader.changes_since(since)
+        assert top == seq
+        assert found == slot_changes(reader, since)
+        cursor = top
+    # reading with a limit gives the same rows in parts
+    since = cursor - 30
+    parts, top = [], since
+    while top < cursor:
+        rows, top = reader.changes_since(top, limit=4)
+        assert len(rows) <= 4
+        parts.extend(rows)
+    assert parts == slot_changes(reader, since)
+
+def test_ring_wrapped(tmp_path, make_db):
+    "a cursor older than the ring is served from the cache table"
+    db = make_db('cache', schema.create_cachedb.format(cache_db='cache'))
+    for i in range(1, 21):
+        db.insert('cache', pvname=f'PV:{i}', type='double', value='0', cvalue='0',
+                  ts=0, seq=i)
+    fname = str(tmp_path / 'shm')
+    writer = SharedCacheWriter(fname, ring_size=16)
+    writer.register(db.execute(db.tables['cache'].select()).fetchall())
+    reader = SharedCacheReader(fname)
+    assert [r.seq for r in reader.changes_since(10)[0]] == list(range(11, 21))
+    assert reader.changes_since(2) is None
+
+    cache = Cache.__new__(Cache)
+    cache.db = db
+    cache.tables = db.tables
+    cache.shm, cache.shm_retry = reader, np.inf
+    cache.shm_reader = lambda: reader
+    rows, top = cache.changes_since(2)
+    assert [r.seq for r in rows] == list(range(3, 21)) and top == 20
@@ -0,0 +1,105 @@
+import os
+
+import numpy as np
+
+from epicsarchiver.spool import (Spool, encode_batch, decode_batches, segment_files,
+                                 spool_status, read_header, read_ack, HELD_DIR)
+from conftest import archive_sql, add_archive_pvs
+
+RECORDS = [(1, 1.5e9, '1.25'), (2, 1.5e9 + 0.125, 'some text'),
+           (70000, 1.6e9, b'\xc2\xb5A'), (3, 1.7e9, 'x'*5000)]
+
+def test_batch_round_trip():
+    data = encode_batch(RECORDS[:2]) + encode_batch(RECORDS[2:])
+    batches = list(decode_batches(data, 0))
+    assert len(batches) == 2
+    assert batches[0][0] == 0 and batches[1][1] == len(data)
+    records = batches[0][2] + batches[1][2]
+    assert records[:2] == RECORDS[:2]
+    assert records[2] == (70000, 1.6e9, 'µA')
+    # values are cut to 4096 bytes
+    assert records[3][2] == 'x'*4096
+
+def test_bad_crc_and_partial_batch_stop_decode():
+    first, second = encode_batch(RECORDS[:1]), encode_batch(RECORDS[1:2])
+    data = bytearray(first + second + encode_batch(RECORDS[2:3]))
+    data[len(first) + 20] ^= 0xff
+    assert [b[2] for b in decode_batches(bytes(data), 0)] == [RECORDS[:1]]
+    partial = first + second[:-3]
+    assert [b[1] for b in decode_batches(partial, 0)] == [len(first)]
+
+def test_append_ack_and_reopen(tmp_path):
+    spool = Spool(tmp_path, 'arch_1', ack_interval=0)
+    tok1 = spool.append(RECORDS[:1])
+    tok2 = spool.append(RECORDS[1:2])
+    assert spool.backlog()
+    spool.ack(tok1)
+    assert [tok for db, tok, recs in spool.pending()] == [tok2]
+    spool.close()
+
+    # a crash leaves a partial batch: it is ignored
+    with open(tok2[0], 'ab') as fh:
+        fh.write(encode_batch(RECORDS[2:3])[:-5])
+    spool = Spool(tmp_path, 'arch_2', ack_interval=0)
+    pending = list(spool.pending())
+    assert [(db, recs) for db, tok, recs in pending] == [('arch_1', RECORDS[1:2])]
+    spool.ack(pending[0][1])
+    # the old segment is removed once all of it is acknowledged
+    assert segment_files(tmp_path) == [spool.segfile]
+    assert not spool.backlog()
+    tok3 = spool.append(RECORDS[2:3])
+    assert [recs for db, tok, recs in spool.pending()] == [[(70000, 1.6e9, 'µA')]]
+    spool.ack(tok3)
+    spool.close()
+    assert read_ack(spool.segfile) == os.path.getsize(spool.segfile)
+    assert spool_status(str(tmp_path))['unacked'] == 0
+
+def test_held_values_restored(tmp_path):
+    spool = Spool(tmp_path, 'arch_1', ack_interval=0)
+    heldfile = spool.set_aside('arch_1', RECORDS[:2])
+    spool.set_aside('arch_1', RECORDS[2:3])
+    assert heldfile.parent == tmp_path / HELD_DIR
+    assert list(spool.pending()) == []
+    assert spool_status(str(tmp_path))['held'] == os.path.getsize(heldfile)
+    with open(heldfile, 'rb') as fh:
+        assert read_header(fh.read())[0] == 'arch_1'
+    spool.close()
+
+    spool = Spool(tmp_path, 'arch_2', ack_interval=0)
+    assert spool.restore_held() == 1
+    assert not heldfile.exists()
+    pending = list(spool.pending())
+    assert [(db, recs) for db, tok, recs in pending] == [('arch_1', RECORDS[:2]),
+                                                         ('arch_1', [(70000, 1.6e9, 'µA')])]
+    for db, tok, recs in pending:
+        spool.ack(tok)
+    assert not spool.backlog()
+
+def test_replay_sets_aside_unknown_pvs(tmp_path, make_db, make_archiver):
+    db = make_db('arch_1', archive_sql())
+    add_archive_pvs(db, [('PV:a.VAL', 'double'), ('PV:b.VAL', 'string')])
+    arch = make_archiver(db)
+    arch.spool = Spool(tmp_path / 'spool', db.dbname, ack_interval=0)
+    arch.spool.append([(1, 1.e9, '1.5'), (2, 1.e9, 'abc'), (9, 1.e9, '2')])
+    # a PV added to the pv table after the archiver read it
+    add_archive_pvs(db, [('PV:c.VAL', 'int')])
+    arch.spool.append([(3, 1.e9 + 1, '7'), (9, 1.e9 + 1, '3')])
+
+    assert arch.replay_spool() == 3
+    assert not arch.spool.backlog()
+    values = {}
+    for pvid, tabname in arch.data_tables(db.dbname, refresh=True).items():
+        for row in db.get_rows(tabname):
+            values[row.pv_id] = row.value
+    assert values == {1: 1.5, 2: b'abc', 3: 7}
+    assert [level for level, msg in arch.logged if 'set aside' in msg] == ['warn']
+    assert '2 spooled values for 1 PVs' in arch.logged[0][1]
+
+    # once the PV exists, restoring held values replays them
+    add_archive_pvs(db, [{'id': 9, 'name': 'PV:d.VAL', 'type': 'double'}])
+    assert arch.spool.restore_held() == 1
+    assert arch.replay_spool() == 2
+    dtab = arch.data_tables(db.dbname, refresh=True)[9]
+    rows = db.get_rows(dtab, where={'pv_id': 9})
+    assert sorted(float(r.value) for r in rows) == [2.0, 3.0]
+    assert np.isclose(sum(r.time for r in rows), 2.e9 + 1)
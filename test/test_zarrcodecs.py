@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+import zarr
+from numcodecs import get_codec
+
+from epicsarchiver.zarrcodecs import XorFloat, RunLength, CODECS, dictionary_encode
+from epicsarchiver.zarrstore import write_series, ZarrSeries
+
+def special_floats(rng):
+    vals = np.cumsum(rng.normal(size=500))*1.e-3 + 20.0
+    vals[::50] = vals[1::50]
+    return np.concatenate((vals, [0.0, -0.0, np.nan, np.inf, -np.inf, 5.e-324,
+                                  -1.7e308, 1.e-300], rng.normal(size=20)*1.e10))
+
+def test_xorfloat_round_trip():
+    codec = XorFloat()
+    vals = special_floats(np.random.default_rng(4))
+    enc = codec.encode(vals)
+    # repeated values give all zero bits
+    assert (enc[1:500:50] == 0).all()
+    dec = codec.decode(enc)
+    assert (dec.view('<u8') == vals.view('<u8')).all()
+    out = np.empty_like(vals)
+    codec.decode(enc.tobytes(), out=out)
+    assert (out.view('<u8') == vals.view('<u8')).all()
+    assert len(codec.decode(codec.encode(np.zeros(0)))) == 0
+    assert isinstance(get_codec(codec.get_config()), XorFloat)
+
+@pytest.mark.parametrize('dtype', ['<i8', '<i4', '<i2', '|u1', '|b1'])
+def test_runlength_round_trip(dtype):
+    rng = np.random.default_rng(6)
+    info = np.iinfo(dtype) if dtype != '|b1' else None
+    vals = np.repeat(rng.integers(0, 2 if info is None else 100, size=200),
+                     rng.integers(1, 30, size=200)).astype(dtype)
+    if info is not None:
+        vals[:3] = [info.min, info.max, info.min]
+    codec = get_codec(RunLength(dtype).get_config())
+    assert codec.dtype == np.dtype(dtype).str
+    enc = codec.encode(vals)
+    assert len(enc) < vals.nbytes
+    assert (codec.decode(enc).view(dtype) == vals).all()
+    for short in (vals[:0], vals[:1]):
+        dec = codec.decode(codec.encode(short))
+        assert (dec.view(dtype) == short).all() and len(dec) == len(short)
+
+@pytest.mark.parametrize('codec', CODECS)
+def test_series_round_trip(codec):
+    rng = np.random.default_rng(8)
+    npts = 1000
+    times = 1.7e9 + np.cumsum(rng.uniform(0.001, 10, size=npts))
+    # times are kept to the microsecond
+    times = np.round(times*1.e6)/1.e6
+    series = {'double': special_floats(rng)[:npts],
+              'int': np.repeat(np.arange(100), 10) - 50,
+              'string': np.array([b'open', b'closed', b'moving'])[rng.integers(0, 3, size=npts)],
+              'text': np.array([f'value {i}'.encode() for i in range(npts)])}
+    zpv = zarr.group(store=zarr.MemoryStore()).create_group('pvarch')
+    for name, values in series.items():
+        write_series(zpv, name, times[:len(values)], values, chunk_size=128,
+                     levels=[], codec=codec)
+        zs = ZarrSeries(zpv[name])
+        found_t, found_v = zs.range(times[0], times[-1])
+        assert (found_t == times[:len(values)]).all()
+        if values.dtype.kind == 'f':
+            assert (found_v.view('<u8') == values.view('<u8')).all()
+        else:
+            assert (found_v == values).all()
+        encoded = zs.labels is not None
+        assert encoded == (codec != 'gzip' and name == 'string')
+
+def test_dictionary_encode():
+    values = np.array([b'a', b'b', b'a', b'a'])
+    indices, labels = dictionary_encode(values)
+    assert (labels[indices] == values).all() and indices.dtype == np.uint8
+    assert dictionary_encode(np.array([b'a', b'b'])) is None
+    assert dictionary_encode(np.arange(4.0)) is None